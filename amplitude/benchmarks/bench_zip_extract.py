@@ -0,0 +1,83 @@
+# Import libraries
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Make the pipeline modules importable when the benchmark is run from the amplitude folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import modules
+from modules.amplitude_zip_file_extract import amplitude_zip_file_extract
+from benchmarks.synthetic_export import build_synthetic_export
+
+def run_extract(zip_source: str, streaming: bool, max_workers: int = 1):
+    '''
+    Copies zip_source into a fresh working directory and times amplitude_zip_file_extract on it.
+
+    Args:
+        zip_source (str): Path of the synthetic export.
+        streaming (bool): Extraction mode passed to amplitude_zip_file_extract.
+        max_workers (int): Number of extraction processes passed to amplitude_zip_file_extract.
+
+    Returns:
+        dict: Wall time in seconds and decompressed bytes written.
+    '''
+
+    work_dir = tempfile.mkdtemp()
+    original_dir = os.getcwd()
+    try:
+        # Extract function deletes the source zip on success, so each run works on its own copy
+        os.makedirs(os.path.join(work_dir, 'downloaded_data'))
+        shutil.copy(zip_source, os.path.join(work_dir, 'downloaded_data', os.path.basename(zip_source)))
+        os.chdir(work_dir)
+
+        start = time.perf_counter()
+        success = amplitude_zip_file_extract('downloaded_data', streaming=streaming, max_workers=max_workers)
+        wall_time = time.perf_counter() - start
+
+        output_bytes = sum(entry.stat().st_size for entry in os.scandir('extracted_data'))
+        return {'success': success, 'seconds': wall_time, 'output_bytes': output_bytes}
+
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(work_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare temp-directory, single-pass streaming and parallel streaming extraction on a synthetic Amplitude export.')
+    parser.add_argument('--size-mb', type=int, default=512, help='Approximate uncompressed export size in MB.')
+    parser.add_argument('--hours', type=int, default=24, help='Number of hourly .gz members.')
+    parser.add_argument('--compresslevel', type=int, default=6, help='gzip level used when generating members.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Processes used for the parallel streaming run.')
+    args = parser.parse_args()
+
+    source_dir = tempfile.mkdtemp()
+    try:
+        zip_path = os.path.join(source_dir, 'amplitude_20240101T00_20240101T23.zip')
+        print(f'Generating ~{args.size_mb}MB synthetic export...')
+        build_synthetic_export(zip_path, args.size_mb, args.hours, compresslevel=args.compresslevel)
+        zip_size = os.path.getsize(zip_path)
+
+        # Temp-directory mode writes every compressed member to disk before decompressing it
+        results = {
+            'tempdir': run_extract(zip_path, streaming=False),
+            'streaming': run_extract(zip_path, streaming=True),
+            f'parallel x{args.workers}': run_extract(zip_path, streaming=True, max_workers=args.workers),
+        }
+
+        print()
+        print(f'Archive size: {zip_size / 1024 / 1024:.1f}MB')
+        for mode, result in results.items():
+            intermediate = zip_size if mode == 'tempdir' else 0
+            print(f'{mode:>14}: {result["seconds"]:.2f}s, {result["output_bytes"] / 1024 / 1024 / result["seconds"]:.1f} MB/s out, '
+                  f'{intermediate / 1024 / 1024:.1f}MB intermediate disk, success={result["success"]}')
+        for mode, result in results.items():
+            print(f'{mode:>14} speedup over tempdir: {results["tempdir"]["seconds"] / result["seconds"]:.2f}x')
+
+    finally:
+        shutil.rmtree(source_dir)
+
+if __name__ == '__main__':
+    main()
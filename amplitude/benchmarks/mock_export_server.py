@@ -0,0 +1,232 @@
+# Import libraries
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+import argparse
+import io
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+# Make the benchmark helpers importable when the server is run from the amplitude folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import modules
+from benchmarks.synthetic_export import build_export_window, HOUR_FORMAT
+from modules.amplitude_sharded_download import amplitude_shard_plan
+
+# Bytes written per socket write when a bandwidth limit is set
+WRITE_CHUNK_SIZE = 64 * 1024
+
+class MockExportServer:
+    '''
+    Local stand-in for the Amplitude export API. GET /api/2/export?start=...&end=... returns a synthetic export for the requested window, generated on first request and cached. Call prepare to generate exports before they are requested. GET /stats returns the request counts as JSON.
+    Faults can be injected to exercise retry and backoff: a share of requests answered with 429 or 5xx, a share of transfers dropped halfway, a delay before the first byte, and a bandwidth limit.
+    Range requests are answered with 206 so interrupted downloads can resume, unless support_range is False.
+
+    Args:
+        events_per_hour (int): Events written to each hourly member.
+        rate_429 (float): Share of requests answered with 429 Too Many Requests and a Retry-After header.
+        rate_5xx (float): Share of requests answered with 500/502/503.
+        rate_drop (float): Share of transfers whose connection is closed after half of the body.
+        support_range (bool): If False, Range headers are ignored and the whole export is always sent.
+        latency (float): Seconds to wait before answering each request.
+        bandwidth_mbps (float): Optional cap on the response rate in MB/s.
+        retry_after (int): Retry-After value in seconds sent with 429 responses.
+        empty_hours (set): Optional hours ('%Y%m%dT%H') with no data. A window made only of empty hours returns 404.
+        host (str): Interface to listen on.
+        port (int): Port to listen on. 0 picks a free port.
+    '''
+
+    def __init__(self, events_per_hour: int = 2000, rate_429: float = 0.0, rate_5xx: float = 0.0, rate_drop: float = 0.0, support_range: bool = True, latency: float = 0.0, bandwidth_mbps: float = None, retry_after: int = 1, empty_hours: set = None, host: str = '127.0.0.1', port: int = 0):
+        self.events_per_hour = events_per_hour
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rate_drop = rate_drop
+        self.support_range = support_range
+        self.latency = latency
+        self.bandwidth_mbps = bandwidth_mbps
+        self.retry_after = retry_after
+        self.empty_hours = empty_hours or set()
+        self.requests = {'total': 0, '200': 0, '206': 0, '404': 0, '416': 0, '429': 0, '5xx': 0, 'dropped': 0}
+        self._exports = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/api/2/export'
+
+    def _export_body(self, start_time: str, end_time: str):
+        # Exports are generated once per window, so repeated and retried requests return identical bytes
+        with self._lock:
+            if (start_time, end_time) not in self._exports:
+                buffer = io.BytesIO()
+                skip_hours = {datetime.strptime(hour, HOUR_FORMAT) for hour in self.empty_hours}
+                build_export_window(buffer, start_time, end_time, events_per_hour=self.events_per_hour, skip_hours=skip_hours)
+                self._exports[(start_time, end_time)] = buffer.getvalue()
+            return self._exports[(start_time, end_time)]
+
+    def prepare(self, windows: list):
+        '''
+        Generates the exports of windows up front, so a benchmark times the transfer and not the generation of the data.
+
+        Args:
+            windows (list): (start_time, end_time) tuples in '%Y%m%dT%H' format, e.g. from amplitude_shard_plan.
+        '''
+
+        for start_time, end_time in windows:
+            self._export_body(start_time, end_time)
+        return self
+
+    def _handler(self):
+        server = self
+
+        class ExportHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                # Request counts, for a benchmark running the server in another process
+                if urlparse(self.path).path == '/stats':
+                    with server._lock:
+                        body = json.dumps(server.requests).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                params = parse_qs(urlparse(self.path).query)
+                start_time, end_time = params['start'][0], params['end'][0]
+                with server._lock:
+                    server.requests['total'] += 1
+
+                if server.latency:
+                    time.sleep(server.latency)
+
+                # Injected faults
+                roll = random.random()
+                if roll < server.rate_429:
+                    self._count('429')
+                    self.send_response(429)
+                    self.send_header('Retry-After', str(server.retry_after))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if roll < server.rate_429 + server.rate_5xx:
+                    self._count('5xx')
+                    self.send_response(random.choice([500, 502, 503]))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body = server._export_body(start_time, end_time)
+
+                # An archive with no members means there was no data in the window
+                if len(body) <= 22:
+                    self._count('404')
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                # Resume from the requested offset when Range is supported
+                range_header = self.headers.get('Range', '')
+                first_byte = int(range_header[len('bytes='):].rstrip('-')) if server.support_range and range_header.startswith('bytes=') else 0
+                if first_byte >= len(body):
+                    self._count('416')
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{len(body)}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                if first_byte:
+                    self._count('206')
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {first_byte}-{len(body) - 1}/{len(body)}')
+                else:
+                    self._count('200')
+                    self.send_response(200)
+                self.send_header('Content-Type', 'application/zip')
+                self.send_header('Content-Length', str(len(body) - first_byte))
+                self.send_header('Accept-Ranges', 'bytes' if server.support_range else 'none')
+                self.send_header('ETag', f'"{hash(body) & 0xffffffff:08x}"')
+                self.end_headers()
+
+                # Dropped transfers stop halfway through the body
+                last_byte = len(body)
+                dropped = random.random() < server.rate_drop
+                if dropped:
+                    last_byte = first_byte + (len(body) - first_byte) // 2
+                    self._count('dropped')
+
+                # Write in chunks, pausing to stay under the bandwidth limit
+                for offset in range(first_byte, last_byte, WRITE_CHUNK_SIZE):
+                    self.wfile.write(body[offset:min(offset + WRITE_CHUNK_SIZE, last_byte)])
+                    if server.bandwidth_mbps:
+                        time.sleep(WRITE_CHUNK_SIZE / (server.bandwidth_mbps * 1024 * 1024))
+
+                if dropped:
+                    self.wfile.flush()
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    self.close_connection = True
+
+            def _count(self, outcome: str):
+                with server._lock:
+                    server.requests[outcome] += 1
+
+            def log_message(self, format, *args):
+                # Keep benchmark output readable
+                pass
+
+        return ExportHandler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic Amplitude exports locally, with optional 429/5xx/slow responses.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--events-per-hour', type=int, default=2000)
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Share of requests answered with 429.')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help='Share of requests answered with 500/502/503.')
+    parser.add_argument('--rate-drop', type=float, default=0.0, help='Share of transfers dropped halfway.')
+    parser.add_argument('--no-range', action='store_true', help='Ignore Range headers.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds before each response.')
+    parser.add_argument('--bandwidth-mbps', type=float, default=None, help='Cap on the response rate in MB/s.')
+    parser.add_argument('--prepare', nargs=3, metavar=('START', 'END', 'SHARD_HOURS'), default=None, help='Generate the exports of every shard of the START-END window before serving.')
+    args = parser.parse_args()
+
+    server = MockExportServer(args.events_per_hour, args.rate_429, args.rate_5xx, args.rate_drop, not args.no_range, args.latency, args.bandwidth_mbps, port=args.port)
+    if args.prepare:
+        start_time, end_time, shard_hours = args.prepare
+        server.prepare(amplitude_shard_plan(start_time, end_time, int(shard_hours)))
+
+    # Printed once the exports are ready; benchmarks running the server in a subprocess wait for this line
+    print(f'Serving synthetic exports at {server.url}. Ctrl+C to stop.', flush=True)
+    try:
+        server.start()._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
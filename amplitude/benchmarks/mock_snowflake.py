@@ -0,0 +1,98 @@
+# Import libraries
+import gzip
+import io
+import re
+import threading
+
+# FILES = ('key', ...) list of a COPY INTO statement
+FILES_PATTERN = re.compile(r"FILES\s*=\s*\((.*?)\)\s*FILE_FORMAT", re.DOTALL)
+FILE_NAME_PATTERN = re.compile(r"'((?:[^']|'')*)'")
+
+# Result columns of COPY INTO, in Snowflake's order
+COPY_COLUMNS = ('file', 'status', 'rows_parsed', 'rows_loaded', 'error_limit', 'errors_seen', 'first_error')
+
+class MockSnowflake:
+    '''
+    Local stand-in for snowflake.connector, for tests and benchmarks of the Snowflake load stage. Pass its connect method as the connect argument of amplitude_snowflake_load.
+    COPY INTO statements are parsed, each listed file is read from the S3 stand-in and its events counted as rows. Like Snowflake's load metadata, a file loaded once is skipped by later statements and left out of their results.
+
+    Args:
+        s3_client (botocore.client.S3): client of the S3 stand-in the files were uploaded to.
+        bucket (str): bucket the stage points at.
+    '''
+
+    def __init__(self, s3_client, bucket: str):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.statements = []
+        self.loaded = {}
+        self._lock = threading.Lock()
+
+    def connect(self, **connection_params):
+        return _Connection(self)
+
+    def _rows(self, key: str):
+        # Events in one object: lines of (possibly compressed) NDJSON, or Parquet rows
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        if key.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            return pq.ParquetFile(io.BytesIO(body)).metadata.num_rows
+        if key.endswith('.gz'):
+            body = gzip.decompress(body)
+        elif key.endswith('.zst'):
+            import zstandard
+            body = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body), read_across_frames=True).read()
+        return sum(1 for line in body.splitlines() if line.strip())
+
+    def copy_into(self, statement: str):
+        # Returns COPY result rows for the files not loaded before
+        with self._lock:
+            self.statements.append(statement)
+        keys = [name.replace("''", "'") for name in FILE_NAME_PATTERN.findall(FILES_PATTERN.search(statement).group(1))]
+        results = []
+        for key in keys:
+            if key in self.loaded:
+                continue
+            try:
+                rows = self._rows(key)
+            except Exception as e:
+                results.append((f's3://{self.bucket}/{key}', 'LOAD_FAILED', 0, 0, 1, 1, str(e)))
+                continue
+            with self._lock:
+                self.loaded[key] = rows
+            results.append((f's3://{self.bucket}/{key}', 'LOADED', rows, rows, 1, 0, None))
+        return results
+
+class _Connection:
+
+    def __init__(self, server: MockSnowflake):
+        self.server = server
+
+    def cursor(self):
+        return _Cursor(self.server)
+
+    def close(self):
+        pass
+
+class _Cursor:
+
+    def __init__(self, server: MockSnowflake):
+        self.server = server
+        self.description = None
+        self._rows = []
+
+    def execute(self, statement: str):
+        if not statement.lstrip().upper().startswith('COPY INTO'):
+            raise NotImplementedError(f'MockSnowflake only runs COPY INTO statements: {statement[:60]}')
+        self._rows = self.server.copy_into(statement)
+        self.description = [(column,) for column in COPY_COLUMNS] if self._rows else [('status',)]
+        if not self._rows:
+            self._rows = [('Copy executed with 0 files processed.',)]
+        return self
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        pass
@@ -0,0 +1,242 @@
+# Import libraries
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+from urllib.request import urlopen
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Folder holding main.py, modules and benchmarks. Stand-in processes are started from here
+AMPLITUDE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Make the pipeline modules importable when the benchmark is run from the amplitude folder
+sys.path.insert(0, AMPLITUDE_DIR)
+
+# Import modules
+from modules.amplitude_sharded_download import amplitude_sharded_download
+from modules.amplitude_zip_file_extract import amplitude_zip_file_extract
+from modules.amplitude_s3_load import amplitude_s3_client, amplitude_s3_load
+from modules.amplitude_orchestrator import amplitude_pipeline
+from modules.amplitude_retry import RetryPolicy
+from modules.amplitude_snowflake_load import amplitude_snowflake_load
+from modules.amplitude_metrics import stage_timer, metrics_snapshot, metrics_reset, amplitude_metrics_report
+from benchmarks.synthetic_export import HOUR_FORMAT
+from benchmarks.mock_snowflake import MockSnowflake
+
+# Credentials accepted by the local S3 stand-in
+S3_KEY = 'testing'
+S3_SECRET = 'testing'
+S3_BUCKET = 'amplitude-benchmark'
+
+# Seconds a stand-in process may take to start serving, including generating the exports
+STARTUP_TIMEOUT = 600
+
+# Manifest of uploaded keys, written in each mode's working directory when the Snowflake stage is benchmarked
+MANIFEST_PATH = 'state/manifest.json'
+
+def _free_port():
+    # Ask the OS for a free port for the S3 stand-in
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _wait_for_port(port: int, process: subprocess.Popen):
+    # Poll until the stand-in accepts connections, failing early if its process exits
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Stand-in process exited with code {process.returncode} before listening on port {port}.')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'Stand-in process did not listen on port {port} within {STARTUP_TIMEOUT}s.')
+
+def stop_stand_in(process: subprocess.Popen):
+    # Stand-ins run until they are terminated
+    if process is None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def start_export_stand_in(start_time: str, end_time: str, args):
+    '''
+    Starts benchmarks/mock_export_server.py in its own process, with the export of every planned shard generated before it starts serving. Neither the generation of the data nor the memory of the server is counted in the benchmarked stages.
+
+    Returns:
+        tuple: (export_url, process).
+    '''
+
+    port = _free_port()
+    command = [
+        sys.executable, '-m', 'benchmarks.mock_export_server'
+        , '--port', str(port)
+        , '--events-per-hour', str(args.events_per_hour)
+        , '--rate-429', str(args.rate_429)
+        , '--rate-5xx', str(args.rate_5xx)
+        , '--rate-drop', str(args.rate_drop)
+        , '--latency', str(args.latency)
+        , '--prepare', start_time, end_time, str(args.shard_hours)
+        ]
+    if args.bandwidth_mbps:
+        command += ['--bandwidth-mbps', str(args.bandwidth_mbps)]
+
+    # The server binds its port before generating the exports, so readiness is the line it prints once they are ready
+    process = subprocess.Popen(command, cwd=AMPLITUDE_DIR, stdout=subprocess.PIPE, text=True)
+    ready_line = process.stdout.readline()
+    if not ready_line.startswith('Serving synthetic exports at '):
+        stop_stand_in(process)
+        raise RuntimeError('The mock export server did not start.')
+    return f'http://127.0.0.1:{port}/api/2/export', process
+
+def export_requests(export_url: str):
+    # Request counts kept by the mock export server
+    parts = urlparse(export_url)
+    with urlopen(f'{parts.scheme}://{parts.netloc}/stats', timeout=10) as response:
+        return json.load(response)
+
+def start_s3_stand_in(endpoint_url: str = None):
+    '''
+    Returns an S3 endpoint to load into: endpoint_url if given (e.g. a running MinIO), otherwise a moto server started in its own process on a free local port, so its memory is not counted in the benchmarked stages.
+
+    Returns:
+        tuple: (endpoint_url, process) - process is None when an external endpoint is used.
+    '''
+
+    if endpoint_url:
+        return endpoint_url, None
+
+    if importlib.util.find_spec('moto') is None:
+        raise ImportError("The local S3 stand-in requires moto: pip install 'moto[server]', or pass --s3-endpoint")
+
+    port = _free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _wait_for_port(port, process)
+    return f'http://127.0.0.1:{port}', process
+
+def _retry_policy(args):
+    # Backoff used for export requests during the benchmark
+    return RetryPolicy(max_attempts=args.max_attempts, base_delay=args.retry_base, max_delay=args.retry_max)
+
+def _manifest_path(args):
+    # Uploaded keys are only recorded when they will be loaded into the Snowflake stand-in
+    return MANIFEST_PATH if args.snowflake else None
+
+def run_staged(export_url: str, s3_endpoint: str, start_time: str, end_time: str, args):
+    '''
+    Runs download, extract and load one after another, each inside its own stage timer.
+    '''
+
+    with stage_timer('amplitude_api_call'):
+        amplitude_sharded_download(export_url, start_time, end_time, 'key', 'secret', max_attempts=args.max_attempts, shard_hours=args.shard_hours, max_workers=args.download_workers, retry_policy=_retry_policy(args))
+    with stage_timer('amplitude_zip_file_extract'):
+        amplitude_zip_file_extract('downloaded_data', max_workers=args.extract_workers)
+    with stage_timer('amplitude_s3_load'):
+        amplitude_s3_load('extracted_data', S3_KEY, S3_SECRET, S3_BUCKET, max_workers=args.upload_workers, endpoint_url=s3_endpoint, manifest_path=_manifest_path(args))
+
+def run_async(export_url: str, s3_endpoint: str, start_time: str, end_time: str, args):
+    '''
+    Runs the async orchestrator, which overlaps the three stages and times each of them, inside an overall stage timer.
+    '''
+
+    with stage_timer('amplitude_pipeline'):
+        amplitude_pipeline(export_url, start_time, end_time, 'key', 'secret', S3_KEY, S3_SECRET, S3_BUCKET, max_attempts=args.max_attempts, shard_hours=args.shard_hours, download_workers=args.download_workers, extract_workers=args.extract_workers, upload_workers=args.upload_workers, queue_size=args.queue_size, endpoint_url=s3_endpoint, retry_policy=_retry_policy(args), manifest_path=_manifest_path(args))
+
+def run_snowflake(s3_endpoint: str, args):
+    '''
+    Loads the objects uploaded in this mode into the Snowflake stand-in with batched COPY INTO statements.
+    '''
+
+    snowflake = MockSnowflake(amplitude_s3_client(S3_KEY, S3_SECRET, endpoint_url=s3_endpoint), S3_BUCKET)
+    with stage_timer('amplitude_snowflake_load'):
+        amplitude_snowflake_load(MANIFEST_PATH, 'AMPLITUDE_EVENTS', '@AMPLITUDE_STAGE', connect=snowflake.connect, batch_size=args.copy_batch_size)
+
+def print_stages(mode: str):
+    # One row per stage from the metrics collected during the run
+    print()
+    print(f'[{mode}] {"stage":<28}{"wall s":>9}{"MB in/s":>10}{"MB out/s":>10}{"files/s":>10}{"rows/s":>10}{"retries":>9}{"errors":>8}{"peak RSS MB":>13}')
+    for stage, metrics in metrics_snapshot().items():
+        print(f'[{mode}] {stage:<28}{metrics["wall_seconds"]:>9.2f}{metrics["bytes_in_per_second"] / 1024 / 1024:>10.1f}{metrics["bytes_out_per_second"] / 1024 / 1024:>10.1f}'
+              f'{metrics["files_per_second"]:>10.1f}{metrics["rows_per_second"]:>10.0f}{metrics["retries"]:>9}{metrics["errors"]:>8}{max(metrics["peak_rss_bytes"], metrics["peak_child_rss_bytes"]) / 1024 / 1024:>13.1f}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark download, extract and load offline against a mock export API and a local S3 stand-in.')
+    parser.add_argument('--hours', type=int, default=24, help='Hours in the export window.')
+    parser.add_argument('--events-per-hour', type=int, default=20000, help='Events in each hourly member.')
+    parser.add_argument('--mode', choices=['staged', 'async', 'both'], default='both')
+    parser.add_argument('--shard-hours', type=int, default=6)
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--extract-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--upload-workers', type=int, default=8)
+    parser.add_argument('--queue-size', type=int, default=8, help='Queue size for the async pipeline.')
+    parser.add_argument('--max-attempts', type=int, default=5)
+    parser.add_argument('--retry-base', type=float, default=0.5, help='Backoff delay cap in seconds after the first failed export request.')
+    parser.add_argument('--retry-max', type=float, default=10.0, help='Longest backoff delay in seconds.')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Share of export requests answered with 429.')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help='Share of export requests answered with 500/502/503.')
+    parser.add_argument('--rate-drop', type=float, default=0.0, help='Share of export transfers dropped halfway.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds before each export response.')
+    parser.add_argument('--bandwidth-mbps', type=float, default=None, help='Cap on the export response rate in MB/s.')
+    parser.add_argument('--s3-endpoint', default=None, help='Use an existing S3-compatible endpoint (e.g. MinIO) instead of starting moto.')
+    parser.add_argument('--snowflake', action='store_true', help='Also load the uploaded objects into a Snowflake stand-in with batched COPY INTO.')
+    parser.add_argument('--copy-batch-size', type=int, default=1000, help='Files per COPY INTO statement.')
+    parser.add_argument('--report', default=None, help='Optional path prefix for JSON run reports, one per mode.')
+    args = parser.parse_args()
+
+    start_time = '20240101T00'
+    end_time = (datetime.strptime(start_time, HOUR_FORMAT) + timedelta(hours=args.hours - 1)).strftime(HOUR_FORMAT)
+    modes = ['staged', 'async'] if args.mode == 'both' else [args.mode]
+
+    # Both stand-ins run in their own processes and are ready before any stage is timed
+    print(f'Generating {args.hours} hour(s) of synthetic exports...')
+    export_url, export_process = start_export_stand_in(start_time, end_time, args)
+    s3_endpoint, s3_process = None, None
+    original_dir = os.getcwd()
+
+    try:
+        s3_endpoint, s3_process = start_s3_stand_in(args.s3_endpoint)
+        amplitude_s3_client(S3_KEY, S3_SECRET, endpoint_url=s3_endpoint).create_bucket(Bucket=S3_BUCKET)
+        print(f'Export API stand-in at {export_url}, S3 stand-in at {s3_endpoint}.')
+
+        for mode in modes:
+            # Each mode runs in a fresh working directory so no state carries over
+            work_dir = tempfile.mkdtemp()
+            os.chdir(work_dir)
+            metrics_reset()
+            try:
+                if mode == 'staged':
+                    run_staged(export_url, s3_endpoint, start_time, end_time, args)
+                else:
+                    run_async(export_url, s3_endpoint, start_time, end_time, args)
+                if args.snowflake:
+                    run_snowflake(s3_endpoint, args)
+            finally:
+                os.chdir(original_dir)
+                shutil.rmtree(work_dir)
+
+            print_stages(mode)
+            if args.report:
+                amplitude_metrics_report(f'{args.report}_{mode}.json', run_info={'mode': mode, 'args': vars(args)})
+
+        print()
+        print(f'Export API requests: {export_requests(export_url)}')
+
+    finally:
+        stop_stand_in(export_process)
+        stop_stand_in(s3_process)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Import libraries
+from datetime import datetime, timedelta
+import gzip
+import json
+import random
+import uuid
+import zipfile
+
+# Event types used to build synthetic events
+EVENT_TYPES = ['session_start', 'page_view', 'button_click', 'add_to_cart', 'purchase', 'session_end']
+
+# Amplitude export API hour format
+HOUR_FORMAT = '%Y%m%dT%H'
+
+def synthetic_event(event_time: datetime):
+    '''
+    Builds one synthetic event shaped like an Amplitude export row, with a random time inside the hour of event_time.
+
+    Returns:
+        dict: the event.
+    '''
+
+    timestamp = (event_time + timedelta(seconds=random.randint(0, 3599))).strftime('%Y-%m-%d %H:%M:%S.%f')
+    return {
+        'uuid': str(uuid.uuid4()),
+        '$insert_id': str(uuid.uuid4()),
+        'amplitude_id': random.randint(1, 10**12),
+        'event_id': random.randint(1, 10**6),
+        'session_id': random.randint(10**12, 10**13),
+        'event_type': random.choice(EVENT_TYPES),
+        'event_time': timestamp,
+        'server_upload_time': timestamp,
+        'user_id': f'user_{random.randint(1, 100000)}',
+        'device_id': str(uuid.uuid4()),
+        'platform': random.choice(['Web', 'iOS', 'Android']),
+        'country': random.choice(['United Kingdom', 'Germany', 'France', 'United States']),
+        'event_properties': {'value': random.random(), 'path': f'/page/{random.randint(1, 500)}'},
+        'user_properties': {'plan': random.choice(['free', 'pro', 'enterprise'])},
+    }
+
+def build_synthetic_export(zip_path, size_mb: float = None, hours: int = 24, project_id: str = '123456', compresslevel: int = 6, start_hour: datetime = datetime(2024, 1, 1), events_per_hour: int = None, skip_hours: set = None):
+    '''
+    Writes a synthetic Amplitude export: zip -> project folder -> one hourly .gz NDJSON file per hour. Each hour is sized either by uncompressed bytes (size_mb spread across the hours) or by event count (events_per_hour).
+
+    Args:
+        zip_path (str or file object): Path of the zip file to create, or a writable binary file object.
+        size_mb (float): Approximate uncompressed size of the export in MB. Ignored when events_per_hour is given.
+        hours (int): Number of hourly .gz members.
+        project_id (str): Amplitude project id used for the folder and file names.
+        compresslevel (int): gzip compression level used for the members.
+        start_hour (datetime): Hour of the first member.
+        events_per_hour (int): Optional number of events written to each hourly member.
+        skip_hours (set): Optional hours (datetime) with no data, so no member is written for them.
+
+    Returns:
+        int: Uncompressed bytes written across all members.
+    '''
+
+    # Split the target size evenly across hourly members
+    if events_per_hour is None and size_mb is None:
+        raise ValueError('Either size_mb or events_per_hour must be given.')
+    bytes_per_hour = int((size_mb or 0) * 1024 * 1024 // hours)
+    skip_hours = skip_hours or set()
+    total_bytes = 0
+
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zip_ref:
+        for hour in range(hours):
+            event_time = start_hour + timedelta(hours=hour)
+            if event_time in skip_hours:
+                continue
+            member_name = f'{project_id}/{project_id}_{event_time.strftime("%Y-%m-%d")}_{event_time.hour}#0.json.gz'
+
+            # Stream events into the gzip member so generation memory stays bounded
+            with zip_ref.open(member_name, 'w', force_zip64=True) as member, gzip.GzipFile(fileobj=member, mode='wb', compresslevel=compresslevel) as gz:
+                written = 0
+                events = 0
+                while (events < events_per_hour) if events_per_hour is not None else (written < bytes_per_hour):
+                    line = (json.dumps(synthetic_event(event_time)) + '\n').encode('utf-8')
+                    gz.write(line)
+                    written += len(line)
+                    events += 1
+                total_bytes += written
+
+    return total_bytes
+
+def build_export_window(zip_path, start_time: str, end_time: str, **kwargs):
+    '''
+    Writes a synthetic export covering the start_time/end_time window, both inclusive, as the export API would return it.
+
+    Args:
+        zip_path (str or file object): Path of the zip file to create, or a writable binary file object.
+        start_time (str): first hour in '%Y%m%dT%H' format.
+        end_time (str): last hour in '%Y%m%dT%H' format.
+        **kwargs: passed on to build_synthetic_export.
+
+    Returns:
+        int: Uncompressed bytes written across all members.
+    '''
+
+    window_start = datetime.strptime(start_time, HOUR_FORMAT)
+    hours = int((datetime.strptime(end_time, HOUR_FORMAT) - window_start).total_seconds() // 3600) + 1
+    return build_synthetic_export(zip_path, hours=hours, start_hour=window_start, **kwargs)
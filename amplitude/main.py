@@ -1,125 +1,756 @@
 # Import libraries
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 import os
+import time
+import signal
+import argparse
+import threading
 import logging
 
 # Import modules
 from modules.amplitude_date_range import amplitude_date_range
-from modules.amplitude_api_call import amplitude_api_call
+from modules.amplitude_sharded_download import amplitude_sharded_download
 from modules.amplitude_zip_file_extract import  amplitude_zip_file_extract
-from modules.amplitude_s3_load import amplitude_s3_load
-
-# CONFIGURE LOGGING
-# Define runtime timestamp
-timestamp = datetime.now().strftime('%Y-%m-%d %H-%M-%S')
-
-# Create log directories if they do not exist
-os.makedirs('logs/date_range', exist_ok=True)
-os.makedirs('logs/api_call', exist_ok=True)
-os.makedirs('logs/zip_file_extract', exist_ok=True)
-os.makedirs('logs/s3_load', exist_ok=True)
-
-# Configure Logging for amplitude_date_range.py
-date_range_logger = logging.getLogger('modules.amplitude_date_range')
-date_range_logger.setLevel(logging.INFO)
-date_range_handler = logging.FileHandler(f'logs/date_range/{timestamp}_date_range.log', encoding='utf-8')
-date_range_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-date_range_logger.addHandler(date_range_handler)
-date_range_logger.propagate = False 
-
-# Configure Logging for amplitude_api_call.py
-api_call_logger = logging.getLogger('modules.amplitude_api_call')
-api_call_logger.setLevel(logging.INFO)
-api_call__handler = logging.FileHandler(f'logs/api_call/{timestamp}_api_call.log', encoding='utf-8')
-api_call__handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-api_call_logger.addHandler(api_call__handler)
-api_call_logger.propagate = False 
-
-# Configure Logging for amplitude_zip_file_extract.py
-zip_file_extract_logger = logging.getLogger('modules.amplitude_zip_file_extract')
-zip_file_extract_logger.setLevel(logging.INFO)
-zip_file_extract__handler = logging.FileHandler(f'logs/zip_file_extract/{timestamp}_zip_file_extract.log', encoding='utf-8')
-zip_file_extract__handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-zip_file_extract_logger.addHandler(zip_file_extract__handler)
-zip_file_extract_logger.propagate = False 
-
-# Configure Logging for amplitude_s3_load.py
-s3_load_logger = logging.getLogger('modules.amplitude_s3_load')
-s3_load_logger.setLevel(logging.INFO)
-s3_load__handler = logging.FileHandler(f'logs/s3_load/{timestamp}_s3_load.log', encoding='utf-8')
-s3_load__handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-s3_load_logger.addHandler(s3_load__handler)
-s3_load_logger.propagate = False 
-
-# Generate start_time, end_time with custom function
-start_time, end_time = amplitude_date_range('days', 1)
-
-# Load .env file
-load_dotenv()
-
-# Assign AMP keys to variables
-AMP_API_KEY = os.getenv('AMP_API_KEY')
-AMP_SECRET_KEY = os.getenv('AMP_SECRET_KEY')
-# logger.info('API key and secret imported from .env file.')
-
-# Assign AWS keys to variables
-AWS_ACCESS_KEY = os.getenv('AWS_ACCESS_KEY')
-AWS_SECRET_KEY = os.getenv('AWS_SECRET_KEY')
-AWS_BUCKET_NAME = os.getenv('AWS_BUCKET_NAME')
-# logger.info('API key, secret and bucket name imported from .env file.')
-
-# Declare url for API call function
-url = 'https://analytics.eu.amplitude.com/api/2/export'
-
-# Amplitude API call in try/except block using custom function. Prints exception error if function fails.
-try:
-    download_success = amplitude_api_call(
-        url = url
-        , start_time = start_time
-        , end_time = end_time
-        , AMP_API_KEY = AMP_API_KEY
-        , AMP_SECRET_KEY = AMP_SECRET_KEY
-        , max_attempts=3
+from modules.amplitude_transform import amplitude_transform
+from modules.amplitude_s3_load import amplitude_s3_load, amplitude_s3_client
+from modules.amplitude_stream_to_s3 import amplitude_stream_to_s3
+from modules.amplitude_watermark import amplitude_pending_ranges, amplitude_file_hour, amplitude_last_settled_hour
+from modules.amplitude_checkpoint import amplitude_checkpoint_verified_hours
+from modules.amplitude_metrics import stage_timer, amplitude_metrics_report, metrics_reset, metrics_scope
+from modules.amplitude_orchestrator import amplitude_pipeline
+from modules.amplitude_retry import RetryPolicy, amplitude_session
+from modules.amplitude_dedup import amplitude_dedup_prune
+from modules.amplitude_event_filter import amplitude_event_filter
+from modules.amplitude_snowflake_load import amplitude_snowflake_load
+from modules.amplitude_cache import amplitude_cache_evict
+from modules.amplitude_projects import amplitude_projects_load, amplitude_project_setting, amplitude_project_work_dir, amplitude_project_path
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+def configure_logging():
+    '''
+    Creates the log directories and attaches one log file per stage. Called once per process, so every run of a daemon writes to the same log files.
+    '''
+
+    # Define runtime timestamp
+    timestamp = datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+
+    # Create log directories if they do not exist
+    os.makedirs('logs/date_range', exist_ok=True)
+    os.makedirs('logs/api_call', exist_ok=True)
+    os.makedirs('logs/zip_file_extract', exist_ok=True)
+    os.makedirs('logs/s3_load', exist_ok=True)
+    os.makedirs('logs/metrics', exist_ok=True)
+
+    # Configure Logging for amplitude_date_range.py
+    date_range_logger = logging.getLogger('modules.amplitude_date_range')
+    date_range_logger.setLevel(logging.INFO)
+    date_range_handler = logging.FileHandler(f'logs/date_range/{timestamp}_date_range.log', encoding='utf-8')
+    date_range_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    date_range_logger.addHandler(date_range_handler)
+    date_range_logger.propagate = False 
+
+    # Watermark lookups and updates log to the date_range log
+    watermark_logger = logging.getLogger('modules.amplitude_watermark')
+    watermark_logger.setLevel(logging.INFO)
+    watermark_logger.addHandler(date_range_handler)
+    watermark_logger.propagate = False 
+
+    # Checkpoint verification and resume decisions log to the date_range log
+    checkpoint_logger = logging.getLogger('modules.amplitude_checkpoint')
+    checkpoint_logger.setLevel(logging.INFO)
+    checkpoint_logger.addHandler(date_range_handler)
+    checkpoint_logger.propagate = False 
+
+    # Per-stage timings and the run report log to the date_range log
+    metrics_logger = logging.getLogger('modules.amplitude_metrics')
+    metrics_logger.setLevel(logging.INFO)
+    metrics_logger.addHandler(date_range_handler)
+    metrics_logger.propagate = False 
+
+    # Configure Logging for amplitude_api_call.py
+    api_call_logger = logging.getLogger('modules.amplitude_api_call')
+    api_call_logger.setLevel(logging.INFO)
+    api_call__handler = logging.FileHandler(f'logs/api_call/{timestamp}_api_call.log', encoding='utf-8')
+    api_call__handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    api_call_logger.addHandler(api_call__handler)
+    api_call_logger.propagate = False 
+
+    # Shard planning and bisection logs go to the api_call log alongside the individual shard downloads
+    sharded_download_logger = logging.getLogger('modules.amplitude_sharded_download')
+    sharded_download_logger.setLevel(logging.INFO)
+    sharded_download_logger.addHandler(api_call__handler)
+    sharded_download_logger.propagate = False 
+
+    # The async orchestrator drives every stage, so its summary logs to the api_call log where the run starts
+    orchestrator_logger = logging.getLogger('modules.amplitude_orchestrator')
+    orchestrator_logger.setLevel(logging.INFO)
+    orchestrator_logger.addHandler(api_call__handler)
+    orchestrator_logger.propagate = False 
+
+    # Archive cache hits and evictions log to the api_call log
+    cache_logger = logging.getLogger('modules.amplitude_cache')
+    cache_logger.setLevel(logging.INFO)
+    cache_logger.addHandler(api_call__handler)
+    cache_logger.propagate = False 
+
+    # Configure Logging for amplitude_zip_file_extract.py
+    zip_file_extract_logger = logging.getLogger('modules.amplitude_zip_file_extract')
+    zip_file_extract_logger.setLevel(logging.INFO)
+    zip_file_extract__handler = logging.FileHandler(f'logs/zip_file_extract/{timestamp}_zip_file_extract.log', encoding='utf-8')
+    zip_file_extract__handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    zip_file_extract_logger.addHandler(zip_file_extract__handler)
+    zip_file_extract_logger.propagate = False 
+
+    # Re-encoding of extracted files logs to the zip_file_extract log
+    transform_logger = logging.getLogger('modules.amplitude_transform')
+    transform_logger.setLevel(logging.INFO)
+    transform_logger.addHandler(zip_file_extract__handler)
+    transform_logger.propagate = False 
+
+    # Event filter settings log to the zip_file_extract log
+    event_filter_logger = logging.getLogger('modules.amplitude_event_filter')
+    event_filter_logger.setLevel(logging.INFO)
+    event_filter_logger.addHandler(zip_file_extract__handler)
+    event_filter_logger.propagate = False 
+
+    # Dedup index pruning logs to the zip_file_extract log
+    dedup_logger = logging.getLogger('modules.amplitude_dedup')
+    dedup_logger.setLevel(logging.INFO)
+    dedup_logger.addHandler(zip_file_extract__handler)
+    dedup_logger.propagate = False 
+
+    # Configure Logging for amplitude_s3_load.py
+    s3_load_logger = logging.getLogger('modules.amplitude_s3_load')
+    s3_load_logger.setLevel(logging.INFO)
+    s3_load__handler = logging.FileHandler(f'logs/s3_load/{timestamp}_s3_load.log', encoding='utf-8')
+    s3_load__handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    s3_load_logger.addHandler(s3_load__handler)
+    s3_load_logger.propagate = False 
+
+    # Streaming zip -> S3 uploads log to the s3_load log
+    stream_to_s3_logger = logging.getLogger('modules.amplitude_stream_to_s3')
+    stream_to_s3_logger.setLevel(logging.INFO)
+    stream_to_s3_logger.addHandler(s3_load__handler)
+    stream_to_s3_logger.propagate = False 
+
+    # Upload manifest and Snowflake COPY INTO batches log to the s3_load log
+    for module_name in ('modules.amplitude_manifest', 'modules.amplitude_snowflake_load'):
+        warehouse_logger = logging.getLogger(module_name)
+        warehouse_logger.setLevel(logging.INFO)
+        warehouse_logger.addHandler(s3_load__handler)
+        warehouse_logger.propagate = False 
+
+    # Projects file loading logs to the date_range log
+    projects_logger = logging.getLogger('modules.amplitude_projects')
+    projects_logger.setLevel(logging.INFO)
+    projects_logger.addHandler(date_range_handler)
+    projects_logger.propagate = False 
+
+    # Daemon scheduling and project rounds log to the date_range log
+    logger.setLevel(logging.INFO)
+    logger.addHandler(date_range_handler)
+    logger.propagate = False 
+
+def pipeline_clients(project: dict = None, s3_clients: dict = None):
+    '''
+    Creates the pooled export API session and the S3 client of a project, so they can be shared by every run of a process instead of being rebuilt each time.
+    Each project gets its own session, so its requests-per-minute limit applies to its API key alone.
+
+    Args:
+        project (dict): Optional project entry from amplitude_projects_load. Defaults to the single project configured by .env.
+        s3_clients (dict): Optional cache of S3 clients by credentials and endpoint, so projects writing with the same credentials share one connection pool.
+
+    Returns:
+        tuple: (session, s3_client).
+    '''
+
+    # Load .env file
+    load_dotenv()
+
+    # Settings come from the project entry, falling back to .env
+    def setting(name: str, default: str = None):
+        return amplitude_project_setting(project, name, default)
+
+    # Export requests per minute allowed for the project's API key. Empty or 0 leaves requests unlimited
+    AMP_REQUESTS_PER_MINUTE = float(setting('AMP_REQUESTS_PER_MINUTE') or 0)
+    session = amplitude_session(pool_maxsize=int(setting('AMP_DOWNLOAD_WORKERS', '4')), requests_per_minute=AMP_REQUESTS_PER_MINUTE or None)
+
+    # Pool sized like the upload stages would size their own: upload workers * 4 part threads
+    client_key = (setting('AWS_ACCESS_KEY'), setting('AWS_SECRET_KEY'), setting('AWS_ENDPOINT_URL'))
+    if s3_clients is not None and client_key in s3_clients:
+        return session, s3_clients[client_key]
+
+    AWS_MAX_POOL_CONNECTIONS = setting('AWS_MAX_POOL_CONNECTIONS')
+    s3_client = amplitude_s3_client(
+        client_key[0]
+        , client_key[1]
+        , max_pool_connections = int(AWS_MAX_POOL_CONNECTIONS) if AWS_MAX_POOL_CONNECTIONS else int(setting('AWS_UPLOAD_WORKERS', '8')) * 4
+        , endpoint_url = client_key[2]
         )
-    print(f'Data files for range {start_time}-{end_time} downloaded into "downloaded_data" folder.')
+    if s3_clients is not None:
+        s3_clients[client_key] = s3_client
+
+    return session, s3_client
+
+def run_pipeline(session = None, s3_client = None, project: dict = None, process_pool = None, write_report: bool = True, daemon: bool = False, download_pool = None, upload_pool = None):
+    '''
+    Runs the pipeline once: date range -> sharded download -> zip extract -> S3 load.
+    Kept inside a function so worker processes spawned by the extract stage can import this module without re-running the pipeline.
+
+    Args:
+        session (requests.Session): Optional pooled export API session, e.g. from pipeline_clients. The download stage creates its own otherwise.
+        s3_client (botocore.client.S3): Optional shared S3 client. The upload stages create their own otherwise.
+        project (dict): Optional project entry from amplitude_projects_load. Its settings override .env, and its files live in its own working directory.
+        process_pool (concurrent.futures.Executor): Optional process pool shared by every project, used for decompression and transforms.
+        write_report (bool): If False, metrics are neither reset nor reported, so a round of projects can report once for all of them.
+        daemon (bool): If True, the window ends at the last hour older than AMP_AVAILABILITY_LAG_HOURS instead of at the end of yesterday, so each poll picks up the hours that settled since the last one.
+        download_pool (concurrent.futures.Executor): Optional thread pool shared by every project for export downloads. The project's AMP_DOWNLOAD_WORKERS still bounds its own shards in flight.
+        upload_pool (concurrent.futures.Executor): Optional thread pool shared by every project for S3 uploads. The project's AWS_UPLOAD_WORKERS still bounds its own uploads in flight.
+
+    Returns:
+        dict: run info of the run, as written to the run report.
+    '''
+
+    # Define run timestamp, used for the run report
+    timestamp = datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+
+    # Counters and stage timings start from zero on every run of a daemon
+    if write_report:
+        metrics_reset()
+
+    # Load .env file
+    load_dotenv()
+
+    # Settings come from the project entry, falling back to .env
+    def setting(name: str, default: str = None):
+        return amplitude_project_setting(project, name, default)
+
+    # Downloads, extracted files and state of a project stay in its working directory. The single .env project works in the current directory
+    work_dir = amplitude_project_work_dir(project)
+    download_dir = os.path.join(work_dir, 'downloaded_data')
+    extract_folder = os.path.join(work_dir, 'extracted_data')
+
+    # Watermark file recording which hours were downloaded, extracted and uploaded. Lookback is how many days back missing hours are caught up
+    AMP_STATE_FILE = amplitude_project_path(project, 'AMP_STATE_FILE', 'state/watermark.json')
+    AMP_LOOKBACK_DAYS = int(setting('AMP_LOOKBACK_DAYS', '3'))
+
+    # Hours after the end of an hour before the export API is assumed to hold all of its events. Younger hours are never marked empty or complete, so late events are picked up
+    AMP_AVAILABILITY_LAG_HOURS = int(setting('AMP_AVAILABILITY_LAG_HOURS', '3'))
+
+    # Checkpoint file recording finished units of work (archive checksums, extracted members, uploaded objects and ETags) so reruns resume instead of starting over
+    AMP_CHECKPOINT_FILE = amplitude_project_path(project, 'AMP_CHECKPOINT_FILE', 'state/checkpoint.json')
+
+    # Optional Prometheus textfile-collector path for the run metrics. The JSON run report is always written to logs/metrics
+    AMP_METRICS_TEXTFILE = setting('AMP_METRICS_TEXTFILE', 'logs/metrics/amplitude_pipeline.prom')
+
+    # Optional per-hour index of emitted event ids, so overlapping windows and reruns never load an event twice. Empty disables dedup
+    AMP_DEDUP_DIR = amplitude_project_path(project, 'AMP_DEDUP_DIR')
+    AMP_DEDUP_KEEP_DAYS = int(setting('AMP_DEDUP_KEEP_DAYS', '30'))
+    if AMP_DEDUP_DIR:
+        amplitude_dedup_prune(AMP_DEDUP_DIR, AMP_DEDUP_KEEP_DAYS)
+
+    # Optional content cache of downloaded archives and uploaded objects, so backfills of the same window skip the download and the upload. Empty disables the cache
+    AMP_CACHE_DIR = amplitude_project_path(project, 'AMP_CACHE_DIR')
+    if AMP_CACHE_DIR:
+        amplitude_cache_evict(AMP_CACHE_DIR, int(setting('AMP_CACHE_MAX_MB', '10240')), int(setting('AMP_CACHE_MAX_AGE_DAYS', '7')))
+
+    # Optional validation and filtering of events during extraction (comma-separated lists). Invalid lines are written to AMP_QUARANTINE_DIR instead of being loaded
+    event_filter = amplitude_event_filter(
+        required_fields = setting('AMP_REQUIRED_FIELDS', '')
+        , drop_event_types = setting('AMP_DROP_EVENT_TYPES', '')
+        , drop_columns = setting('AMP_DROP_COLUMNS', '')
+        , drop_where = setting('AMP_DROP_WHERE', '')
+        , quarantine_dir = amplitude_project_path(project, 'AMP_QUARANTINE_DIR', 'quarantine')
+        )
+
+    # Generate start_time, end_time with custom function
+    start_time, end_time = amplitude_date_range('days', AMP_LOOKBACK_DAYS)
+
+    # A daemon polls for new hours, so its window runs up to the last hour whose events should all be available
+    if daemon:
+        end_time = amplitude_last_settled_hour(AMP_AVAILABILITY_LAG_HOURS)
+        print(f'Daemon window ends at {end_time}, {AMP_AVAILABILITY_LAG_HOURS} hour(s) behind now.')
+        logger.info(f'Daemon window ends at {end_time}, {AMP_AVAILABILITY_LAG_HOURS} hour(s) behind now.')
+
+    # Work left on disk by an earlier run: verified archives still to extract, and extracted files still to upload
+    resume_archive_hours = amplitude_checkpoint_verified_hours(AMP_CHECKPOINT_FILE, download_dir)
+    resume_extracted = os.path.exists(extract_folder) and len(os.listdir(extract_folder)) > 0
+    resume_hours = set(resume_archive_hours)
+    if resume_extracted:
+        resume_hours.update(hour for hour in map(amplitude_file_hour, os.listdir(extract_folder)) if hour)
+
+    # Only the hours in the window that are not loaded yet, and not already on disk, are requested
+    pending_ranges = amplitude_pending_ranges(start_time, end_time, AMP_STATE_FILE, exclude_hours=resume_hours, availability_lag_hours=AMP_AVAILABILITY_LAG_HOURS)
+
+    # Assign AMP keys to variables
+    AMP_API_KEY = setting('AMP_API_KEY')
+    AMP_SECRET_KEY = setting('AMP_SECRET_KEY')
+    # logger.info('API key and secret imported from .env file.')
+
+    # Assign AWS keys to variables
+    AWS_ACCESS_KEY = setting('AWS_ACCESS_KEY')
+    AWS_SECRET_KEY = setting('AWS_SECRET_KEY')
+    AWS_BUCKET_NAME = setting('AWS_BUCKET_NAME')
+
+    # S3 upload tuning. AWS_ENDPOINT_URL points the client at an S3-compatible stand-in such as moto
+    AWS_UPLOAD_WORKERS = int(setting('AWS_UPLOAD_WORKERS', '8'))
+    AWS_MULTIPART_THRESHOLD_MB = int(setting('AWS_MULTIPART_THRESHOLD_MB', '8'))
+    AWS_MULTIPART_CHUNKSIZE_MB = int(setting('AWS_MULTIPART_CHUNKSIZE_MB', '8'))
+    AWS_MAX_POOL_CONNECTIONS = int(setting('AWS_MAX_POOL_CONNECTIONS')) if setting('AWS_MAX_POOL_CONNECTIONS') else None
+    AWS_ENDPOINT_URL = setting('AWS_ENDPOINT_URL')
+
+    # Object key layout, e.g. 'hive' for project/year=/month=/day=/hour= prefixes. Empty keeps every object at the bucket root. A compaction target merges small files of a partition into objects of up to that size
+    AWS_KEY_TEMPLATE = setting('AWS_KEY_TEMPLATE', '')
+    AWS_COMPACT_TARGET_MB = int(setting('AWS_COMPACT_TARGET_MB', '0'))
+
+    # Optional Snowflake load: batched COPY INTO from an external stage on the bucket root, over the keys listed in the upload manifest. Disabled unless SNOWFLAKE_TABLE is set
+    SNOWFLAKE_TABLE = setting('SNOWFLAKE_TABLE')
+    SNOWFLAKE_STAGE = setting('SNOWFLAKE_STAGE')
+    SNOWFLAKE_COPY_BATCH_SIZE = int(setting('SNOWFLAKE_COPY_BATCH_SIZE', '1000'))
+    SNOWFLAKE_ON_ERROR = setting('SNOWFLAKE_ON_ERROR', 'ABORT_STATEMENT')
+    SNOWFLAKE_FILE_FORMAT = setting('SNOWFLAKE_FILE_FORMAT')
+    snowflake_connection_params = {
+        param: setting(f'SNOWFLAKE_{param.upper()}')
+        for param in ('account', 'user', 'password', 'warehouse', 'database', 'schema', 'role')
+        if setting(f'SNOWFLAKE_{param.upper()}')
+    }
+    AMP_MANIFEST_FILE = amplitude_project_path(project, 'AMP_MANIFEST_FILE', 'state/manifest.json') if SNOWFLAKE_TABLE else None
+    # logger.info('API key, secret and bucket name imported from .env file.')
+
+    # Declare url for API call function. AMP_EXPORT_URL points the pipeline at another region or a local stand-in such as benchmarks/mock_export_server.py
+    url = setting('AMP_EXPORT_URL', 'https://analytics.eu.amplitude.com/api/2/export')
+
+    # Shard size in hours and number of shards downloaded concurrently
+    AMP_SHARD_HOURS = int(setting('AMP_SHARD_HOURS', '6'))
+    AMP_DOWNLOAD_WORKERS = int(setting('AMP_DOWNLOAD_WORKERS', '4'))
+
+    # Retry policy for export requests: attempts per shard, and the exponential backoff range in seconds. Retry-After from the API takes precedence
+    AMP_MAX_ATTEMPTS = int(setting('AMP_MAX_ATTEMPTS', '5'))
+    retry_policy = RetryPolicy(
+        max_attempts = AMP_MAX_ATTEMPTS
+        , base_delay = float(setting('AMP_RETRY_BASE_SECONDS', '2'))
+        , max_delay = float(setting('AMP_RETRY_MAX_SECONDS', '120'))
+        )
+
+    # Number of processes used to decompress .gz members
+    AMP_EXTRACT_WORKERS = int(setting('AMP_EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+
+    # Optional re-encoding of extracted files before load: gzip, zstd or parquet. Empty leaves raw JSON
+    AMP_TRANSFORM_FORMAT = setting('AMP_TRANSFORM_FORMAT', '').lower()
+
+    # Stream decompressed members straight from the downloaded zips to S3 instead of landing them in extracted_data
+    AMP_STREAM_TO_S3 = setting('AMP_STREAM_TO_S3', 'false').lower() == 'true'
+
+    # 'async' overlaps download, extract and upload through bounded queues; 'staged' runs them one after another
+    AMP_PIPELINE_MODE = setting('AMP_PIPELINE_MODE', 'staged').lower()
+    AMP_QUEUE_SIZE = int(setting('AMP_QUEUE_SIZE', '8'))
+
+    # Async mode runs the whole pipeline in one call, including work left on disk by an earlier run
+    if AMP_PIPELINE_MODE == 'async':
+        try:
+            with stage_timer('amplitude_pipeline'):
+                pipeline_success = amplitude_pipeline(
+                    url = url
+                    , start_time = start_time
+                    , end_time = end_time
+                    , AMP_API_KEY = AMP_API_KEY
+                    , AMP_SECRET_KEY = AMP_SECRET_KEY
+                    , AWS_ACCESS_KEY = AWS_ACCESS_KEY
+                    , AWS_SECRET_KEY = AWS_SECRET_KEY
+                    , AWS_BUCKET_NAME = AWS_BUCKET_NAME
+                    , max_attempts = AMP_MAX_ATTEMPTS
+                    , retry_policy = retry_policy
+                    , ranges = pending_ranges
+                    , shard_hours = AMP_SHARD_HOURS
+                    , download_workers = AMP_DOWNLOAD_WORKERS
+                    , extract_workers = AMP_EXTRACT_WORKERS
+                    , upload_workers = AWS_UPLOAD_WORKERS
+                    , queue_size = AMP_QUEUE_SIZE
+                    , transform_format = AMP_TRANSFORM_FORMAT
+                    , multipart_threshold_mb = AWS_MULTIPART_THRESHOLD_MB
+                    , multipart_chunksize_mb = AWS_MULTIPART_CHUNKSIZE_MB
+                    , max_pool_connections = AWS_MAX_POOL_CONNECTIONS
+                    , endpoint_url = AWS_ENDPOINT_URL
+                    , state_path = AMP_STATE_FILE
+                    , checkpoint_path = AMP_CHECKPOINT_FILE
+                    , dedup_dir = AMP_DEDUP_DIR or None
+                    , key_template = AWS_KEY_TEMPLATE
+                    , event_filter = event_filter
+                    , manifest_path = AMP_MANIFEST_FILE
+                    , session = session
+                    , s3_client = s3_client
+                    , download_dir = download_dir
+                    , extract_folder = extract_folder
+                    , process_pool = process_pool
+                    , cache_dir = AMP_CACHE_DIR or None
+                    , availability_lag_hours = AMP_AVAILABILITY_LAG_HOURS
+                    , download_pool = download_pool
+                    , upload_pool = upload_pool
+                    )
+            print(f'Async pipeline is complete. Success: {pipeline_success}.')
+
+        except Exception as e:
+            print(f"Async pipeline has failed: {e}")
+
+        # Load the objects uploaded in this run (and any left by a failed load) into Snowflake
+        if SNOWFLAKE_TABLE:
+            try:
+                with stage_timer('amplitude_snowflake_load'):
+                    amplitude_snowflake_load(
+                        AMP_MANIFEST_FILE
+                        , SNOWFLAKE_TABLE
+                        , SNOWFLAKE_STAGE
+                        , connection_params = snowflake_connection_params
+                        , batch_size = SNOWFLAKE_COPY_BATCH_SIZE
+                        , on_error = SNOWFLAKE_ON_ERROR
+                        , file_format = SNOWFLAKE_FILE_FORMAT
+                        )
+                print('Snowflake load process is complete.')
+
+            except Exception as e:
+                print(f"Snowflake load process has failed: {e}")
+
+        run_info = {'start_time': start_time, 'end_time': end_time, 'pending_ranges': pending_ranges, 'pipeline_mode': AMP_PIPELINE_MODE, 'transform_format': AMP_TRANSFORM_FORMAT}
+        if write_report:
+            try:
+                amplitude_metrics_report(
+                    f'logs/metrics/{timestamp}_run_report.json'
+                    , prometheus_path = AMP_METRICS_TEXTFILE
+                    , run_info = run_info
+                    )
+
+            except Exception as e:
+                print(f"Run report could not be written: {e}")
+        return run_info
+
+    # Stage flags default to False so a failed stage never leaves them unset
+    download_success = False
+    extract_success = False
+
+    # Amplitude API call in try/except block using custom function. Pending ranges are split into shards that download concurrently. Prints exception error if function fails.
+    if not pending_ranges:
+        print(f'Every hour in {start_time}-{end_time} is already loaded. Nothing to download.')
+
+    else:
+        try:
+            with stage_timer('amplitude_api_call'):
+                download_success = amplitude_sharded_download(
+                    url = url
+                    , start_time = start_time
+                    , end_time = end_time
+                    , AMP_API_KEY = AMP_API_KEY
+                    , AMP_SECRET_KEY = AMP_SECRET_KEY
+                    , max_attempts = AMP_MAX_ATTEMPTS
+                    , retry_policy = retry_policy
+                    , shard_hours = AMP_SHARD_HOURS
+                    , max_workers = AMP_DOWNLOAD_WORKERS
+                    , ranges = pending_ranges
+                    , state_path = AMP_STATE_FILE
+                    , checkpoint_path = AMP_CHECKPOINT_FILE
+                    , session = session
+                    , download_dir = download_dir
+                    , cache_dir = AMP_CACHE_DIR or None
+                    , availability_lag_hours = AMP_AVAILABILITY_LAG_HOURS
+                    , thread_pool = download_pool
+                    )
+            print(f'Data files for range {start_time}-{end_time} downloaded into "{download_dir}" folder.')
     
-except Exception as e:
-    print(f"Amplitude file download failed: {e}")
-    # logger.error(f"Extraction failed: {e}")
+        except Exception as e:
+            print(f"Amplitude file download failed: {e}")
+            # logger.error(f"Extraction failed: {e}")
+
+    # Verified archives from an earlier run are resumed even when nothing new was downloaded
+    if resume_archive_hours:
+        download_success = True
+
+    # Streaming mode replaces the extract and load stages with a single zip -> S3 pass
+    if download_success == True and AMP_STREAM_TO_S3:
+
+        # Call streaming upload function. Prints exception error if function fails.
+        try:
+            with stage_timer('amplitude_stream_to_s3'):
+                stream_success = amplitude_stream_to_s3(
+                    download_dir
+                    , AWS_ACCESS_KEY
+                    , AWS_SECRET_KEY
+                    , AWS_BUCKET_NAME
+                    , max_workers = AWS_UPLOAD_WORKERS
+                    , multipart_chunksize_mb = AWS_MULTIPART_CHUNKSIZE_MB
+                    , max_pool_connections = AWS_MAX_POOL_CONNECTIONS
+                    , endpoint_url = AWS_ENDPOINT_URL
+                    , state_path = AMP_STATE_FILE
+                    , checkpoint_path = AMP_CHECKPOINT_FILE
+                    , key_template = AWS_KEY_TEMPLATE
+                    , manifest_path = AMP_MANIFEST_FILE
+                    , s3_client = s3_client
+                    , thread_pool = upload_pool
+                    )
+            print(f'Streaming S3 load process is complete. Success: {stream_success}.')
+
+        except Exception as e:
+            print(f"Streaming S3 load process has failed: {e}")
+
+    # Logic to only run zip extract function if files successfully downloaded from Amplitude
+    elif download_success == True:
+
+        # Call custom zip extract function. Prints exception error if function fails.
+        try:
+            # logger.info("Starting nested zip file extraction...")
+            with stage_timer('amplitude_zip_file_extract'):
+                extract_success = amplitude_zip_file_extract(download_dir, max_workers=AMP_EXTRACT_WORKERS, state_path=AMP_STATE_FILE, checkpoint_path=AMP_CHECKPOINT_FILE, dedup_dir=AMP_DEDUP_DIR or None, event_filter=event_filter, extract_folder=extract_folder, executor=process_pool)
+            print('Files successfully extracted from extracted .zip files')
+            # logger.info("Extraction complete.")
+
+        except Exception as e:
+            print(f".zip file extraction failed: {e}")
+            # logger.error(f"Extraction failed: {e}")
+
+    else:
+        print("Data download was unsuccessful. Review logs and try again.")
+        # logger.info(f'Data download was unsuccessful so no data was extracted.')
+
+    # Extracted files left by an earlier run are loaded even when nothing new was extracted
+    if resume_extracted and not AMP_STREAM_TO_S3:
+        extract_success = True
+
+    # Re-encode extracted files before they are loaded. Files that fail to transform stay as raw JSON and are still loaded
+    if extract_success == True and AMP_TRANSFORM_FORMAT:
+        try:
+            with stage_timer('amplitude_transform'):
+                amplitude_transform(extract_folder, AMP_TRANSFORM_FORMAT, max_workers=AMP_EXTRACT_WORKERS, executor=process_pool)
+            print(f'Extracted files transformed to {AMP_TRANSFORM_FORMAT}.')
+
+        except Exception as e:
+            print(f"Transform to {AMP_TRANSFORM_FORMAT} failed: {e}")
+
+    # Logic to only run s3 load function if files successfully extracted nested .zip files
+    if extract_success == True:
+
+        # Call s3 file upload function. Prints exception error if function fails.
+        try:
+            # logger.info("Starting nested zip file extraction...")
+            with stage_timer('amplitude_s3_load'):
+                amplitude_s3_load(
+                    extract_folder
+                    , AWS_ACCESS_KEY
+                    , AWS_SECRET_KEY
+                    , AWS_BUCKET_NAME
+                    , max_workers = AWS_UPLOAD_WORKERS
+                    , multipart_threshold_mb = AWS_MULTIPART_THRESHOLD_MB
+                    , multipart_chunksize_mb = AWS_MULTIPART_CHUNKSIZE_MB
+                    , max_pool_connections = AWS_MAX_POOL_CONNECTIONS
+                    , endpoint_url = AWS_ENDPOINT_URL
+                    , state_path = AMP_STATE_FILE
+                    , checkpoint_path = AMP_CHECKPOINT_FILE
+                    , key_template = AWS_KEY_TEMPLATE
+                    , compact_target_mb = AWS_COMPACT_TARGET_MB
+                    , manifest_path = AMP_MANIFEST_FILE
+                    , s3_client = s3_client
+                    , cache_dir = AMP_CACHE_DIR or None
+                    , thread_pool = upload_pool
+                    )
+            print('S3 load process is complete.')
+            # logger.info('S3 load process is complete.')
+
+        except Exception as e:
+            print(f"S3 load process has failed: {e}")
+            # logger.error(f"Extraction failed: {e}")
+
+    elif not AMP_STREAM_TO_S3: 
+        print("Data download was unsuccessful. Review logs and try again.")
+        # logger.info(f'Data download was unsuccessful so no data was extracted.')
 
-# Logic to only run zip extract function if files successfully downloaded from Amplitude
-if download_success == True:
+    # Load the objects uploaded in this run (and any left by a failed load) into Snowflake
+    if SNOWFLAKE_TABLE:
+        try:
+            with stage_timer('amplitude_snowflake_load'):
+                amplitude_snowflake_load(
+                    AMP_MANIFEST_FILE
+                    , SNOWFLAKE_TABLE
+                    , SNOWFLAKE_STAGE
+                    , connection_params = snowflake_connection_params
+                    , batch_size = SNOWFLAKE_COPY_BATCH_SIZE
+                    , on_error = SNOWFLAKE_ON_ERROR
+                    , file_format = SNOWFLAKE_FILE_FORMAT
+                    )
+            print('Snowflake load process is complete.')
 
-    # Call custom zip extract function. Prints exception error if function fails.
+        except Exception as e:
+            print(f"Snowflake load process has failed: {e}")
+
+    # Write per-stage wall time, bytes in/out, files/s, retries and peak RSS as a JSON run report and a Prometheus textfile
+    run_info = {'start_time': start_time, 'end_time': end_time, 'pending_ranges': pending_ranges, 'pipeline_mode': AMP_PIPELINE_MODE, 'stream_to_s3': AMP_STREAM_TO_S3, 'transform_format': AMP_TRANSFORM_FORMAT, 'key_template': AWS_KEY_TEMPLATE, 'compact_target_mb': AWS_COMPACT_TARGET_MB}
+    if write_report:
+        try:
+            amplitude_metrics_report(
+                f'logs/metrics/{timestamp}_run_report.json'
+                , prometheus_path = AMP_METRICS_TEXTFILE
+                , run_info = run_info
+                )
+
+        except Exception as e:
+            print(f"Run report could not be written: {e}")
+    return run_info
+
+def project_clients(projects: list):
+    '''
+    Creates the session and S3 client of every project. Projects writing with the same AWS credentials share one S3 client.
+
+    Args:
+        projects (list): project entries from amplitude_projects_load. Empty for the single .env project.
+
+    Returns:
+        dict: (session, s3_client) by project name, or under None for the single .env project.
+    '''
+
+    s3_clients = {}
+    return {project['name'] if project else None: pipeline_clients(project, s3_clients) for project in projects or [None]}
+
+def run_project_pipeline(project: dict, *args):
+    '''
+    Runs the pipeline of one project of a round with its metrics recorded under the project's name, so projects running side by side never add up each other's wall time or counters.
+
+    Args:
+        project (dict): project entry from amplitude_projects_load.
+        *args: the other arguments of run_pipeline, after project.
+
+    Returns:
+        dict: run info of the run, see run_pipeline.
+    '''
+
+    session, s3_client, *pipeline_args = args
+    with metrics_scope(project['name']):
+        return run_pipeline(session, s3_client, project, *pipeline_args)
+
+def run_projects(projects: list, clients: dict, daemon: bool = False):
+    '''
+    Runs the pipeline once for every project. Projects run side by side on a bounded pool of AMP_PROJECT_WORKERS threads and share one pool of AMP_EXTRACT_WORKERS processes for decompression and transforms, so a dozen projects finish in one run window without oversubscribing the CPUs.
+    Downloads and uploads of every project likewise run on two shared thread pools, sized by AMP_DOWNLOAD_WORKERS and AWS_UPLOAD_WORKERS in .env, so the number of open connections stays bounded however many projects there are.
+    One run report covers the whole round, with the stage metrics of each project kept apart. Without a projects file, this is a single run_pipeline call.
+
+    Args:
+        projects (list): project entries from amplitude_projects_load.
+        clients (dict): sessions and S3 clients from project_clients.
+        daemon (bool): If True, each window ends at the last settled hour, see run_pipeline.
+
+    Returns:
+        bool: True if no project run raised.
+    '''
+
+    if not projects:
+        run_pipeline(*clients[None], daemon = daemon)
+        return True
+
+    # Define round timestamp, used for the run report
+    timestamp = datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+    metrics_reset()
+
+    AMP_PROJECT_WORKERS = int(os.getenv('AMP_PROJECT_WORKERS', '4'))
+    AMP_EXTRACT_WORKERS = int(os.getenv('AMP_EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+    AMP_DOWNLOAD_WORKERS = int(os.getenv('AMP_DOWNLOAD_WORKERS', '4'))
+    AWS_UPLOAD_WORKERS = int(os.getenv('AWS_UPLOAD_WORKERS', '8'))
+    print(f'Running {len(projects)} project(s), {AMP_PROJECT_WORKERS} at a time, on {AMP_EXTRACT_WORKERS} shared extract process(es), {AMP_DOWNLOAD_WORKERS} download and {AWS_UPLOAD_WORKERS} upload thread(s).')
+    logger.info(f'Running {len(projects)} project(s), {AMP_PROJECT_WORKERS} at a time, on {AMP_EXTRACT_WORKERS} shared extract process(es), {AMP_DOWNLOAD_WORKERS} download and {AWS_UPLOAD_WORKERS} upload thread(s).')
+
+    run_infos = {}
+    failed_projects = []
+    # Project runs wait on download and upload tasks, so they get their own pool and never take a thread the tasks need
+    with ProcessPoolExecutor(max_workers=AMP_EXTRACT_WORKERS) as process_pool, ThreadPoolExecutor(max_workers=AMP_DOWNLOAD_WORKERS) as download_pool, ThreadPoolExecutor(max_workers=AWS_UPLOAD_WORKERS) as upload_pool, ThreadPoolExecutor(max_workers=AMP_PROJECT_WORKERS) as project_pool:
+        futures = {
+            project['name']: project_pool.submit(run_project_pipeline, project, *clients[project['name']], process_pool, False, daemon, download_pool, upload_pool)
+            for project in projects
+        }
+        for name, future in futures.items():
+            try:
+                run_infos[name] = future.result()
+                logger.info(f'Project {name} finished.')
+            except Exception as e:
+                failed_projects.append(name)
+                print(f'Project {name} failed: {e}')
+                logger.error(f'Project {name} failed: {e}')
+
+    # Write one run report for the round, with the run info of each project
     try:
-        # logger.info("Starting nested zip file extraction...")
-        extract_success = amplitude_zip_file_extract('downloaded_data')
-        print('Files successfully extracted from extracted .zip files')
-        # logger.info("Extraction complete.")
+        amplitude_metrics_report(
+            f'logs/metrics/{timestamp}_run_report.json'
+            , prometheus_path = os.getenv('AMP_METRICS_TEXTFILE', 'logs/metrics/amplitude_pipeline.prom')
+            , run_info = {'projects': run_infos, 'failed_projects': failed_projects}
+            )
 
     except Exception as e:
-        print(f".zip file extraction failed: {e}")
-        # logger.error(f"Extraction failed: {e}")
+        print(f"Run report could not be written: {e}")
+
+    return not failed_projects
+
+def run_daemon(interval_minutes: float, projects: list = None):
+    '''
+    Runs the pipeline every interval_minutes until SIGTERM or SIGINT, keeping the interpreter, the export API sessions and the S3 clients warm between runs. Each run picks up the hours that became available since the last one through the watermark.
+    A signal stops the daemon once the current run has finished, so no run is cut off half way.
+
+    Args:
+        interval_minutes (float): Time between the starts of two runs. A run that takes longer is followed straight away by the next.
+        projects (list): Optional project entries from amplitude_projects_load, all run in every round. Defaults to the single .env project.
+    '''
 
-else:
-    print("Data download was unsuccessful. Review logs and try again.")
-    # logger.info(f'Data download was unsuccessful so no data was extracted.')
+    # Set by the signal handlers, and waited on between runs
+    stop = threading.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda signal_number, frame: stop.set())
 
-# Logic to only run s3 load function if files successfully extracted nested .zip files
-if extract_success == True:
+    clients = project_clients(projects)
+    print(f'Daemon started: polling every {interval_minutes} minute(s).')
+    logger.info(f'Daemon started: polling every {interval_minutes} minute(s).')
 
-    # Call s3 file upload function. Prints exception error if function fails.
     try:
-        # logger.info("Starting nested zip file extraction...")
-        amplitude_s3_load('extracted_data', AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_BUCKET_NAME)
-        print('S3 load process is complete.')
-        # logger.info('S3 load process is complete.')
+        while not stop.is_set():
+            run_start = time.monotonic()
+            try:
+                run_projects(projects, clients, daemon = True)
+            except Exception as e:
+                # A failed run is retried at the next poll instead of stopping the daemon
+                print(f'Pipeline run failed: {e}')
+                logger.error(f'Pipeline run failed: {e}')
 
-    except Exception as e:
-        print(f"S3 load process has failed: {e}")
-        # logger.error(f"Extraction failed: {e}")
+            wait_seconds = max(interval_minutes * 60 - (time.monotonic() - run_start), 0)
+            logger.info(f'Next run in {wait_seconds:.0f}s.')
+            stop.wait(wait_seconds)
+    finally:
+        for session, _ in clients.values():
+            session.close()
+
+    print('Daemon stopped.')
+    logger.info('Daemon stopped.')
+
+def main():
+    '''
+    Command line entry point. Runs the pipeline once by default, or on a schedule with --daemon.
+    '''
+
+    parser = argparse.ArgumentParser(description='Amplitude export -> S3 (-> Snowflake) pipeline.')
+    parser.add_argument('--daemon', action='store_true', help='keep running and poll for new hours every --interval-minutes')
+    parser.add_argument('--interval-minutes', type=float, default=None, help='minutes between daemon runs (default: AMP_POLL_MINUTES or 60)')
+    args = parser.parse_args()
+
+    configure_logging()
+
+    # Optional projects file listing several Amplitude projects and their destinations. Empty runs the single project configured by .env
+    load_dotenv()
+    projects = amplitude_projects_load(os.getenv('AMP_PROJECTS_FILE', ''))
+
+    if args.daemon:
+        interval_minutes = args.interval_minutes if args.interval_minutes is not None else float(os.getenv('AMP_POLL_MINUTES', '60'))
+        run_daemon(interval_minutes, projects)
+    else:
+        clients = project_clients(projects)
+        try:
+            run_projects(projects, clients)
+        finally:
+            for session, _ in clients.values():
+                session.close()
 
-else: 
-    print("Data download was unsuccessful. Review logs and try again.")
-    # logger.info(f'Data download was unsuccessful so no data was extracted.')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,35 @@
 # Import libraries
 import requests
+import hashlib
 import time
 import os
 import logging
 
+# Import modules
+from modules.amplitude_checkpoint import amplitude_checkpoint_record_archive
+from modules.amplitude_cache import amplitude_cache_fetch_archive, amplitude_cache_store_archive
+from modules.amplitude_metrics import metrics_increment
+from modules.amplitude_retry import RetryPolicy, amplitude_session
+from modules.amplitude_watermark import amplitude_last_settled_hour, AVAILABILITY_LAG_HOURS
+
 # Define the logger
 logger = logging.getLogger(__name__)
 
-def amplitude_api_call(url: str, start_time: str, end_time: str, AMP_API_KEY: str, AMP_SECRET_KEY: str, max_attempts:int):
+class AmplitudeExportError(Exception):
+    '''
+    Raised by amplitude_api_call when raise_on_status is True and the export returns a mapped status code (400, 404 or 504).
+    Lets callers such as amplitude_sharded_download react to the status code instead of giving up on the whole window.
+    '''
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+def amplitude_api_call(url: str, start_time: str, end_time: str, AMP_API_KEY: str, AMP_SECRET_KEY: str, max_attempts:int, chunk_size: int = 1024 * 1024, raise_on_status: bool = False, checkpoint_path: str = None, session: requests.Session = None, retry_policy: RetryPolicy = None, download_dir: str = 'downloaded_data', cache_dir: str = None, availability_lag_hours: int = AVAILABILITY_LAG_HOURS):
     '''
     This function calls the Amplitude API and downloads data between start_time and end_time and saves it to the defined filepath.
+    The response body is streamed to a '.part' file in chunks and only renamed into download_dir once the whole body has arrived, so memory use stays flat regardless of export size.
+    Failed attempts are retried with exponential backoff and jitter, honouring Retry-After. If a transfer breaks mid-stream, the next attempt asks for the rest of the file with an HTTP Range request and appends to the '.part' file; servers that ignore Range send the whole file again.
     
     Args:
         url (str): Amplitude API URL.
@@ -17,11 +37,22 @@ def amplitude_api_call(url: str, start_time: str, end_time: str, AMP_API_KEY: st
         end_time (str): latest date in the download date range.
         AMP_API_KEY (str): Amplitude API key from .env file.
         AMP_SECRET_KEY (str): Amplitude secret key from .env file.
-        max_attempts (int): Maximum number of times the API call will retry in case of timeout.
+        max_attempts (int): Maximum number of attempts, including the first. Used when no retry_policy is given.
+        chunk_size (int): Number of bytes read from the response stream and written to disk per iteration. Defaults to 1MB.
+        raise_on_status (bool): If True, status codes 400, 404 and 504 raise AmplitudeExportError instead of returning False.
+        checkpoint_path (str): Optional checkpoint file. The completed archive is recorded with its SHA-256 and size so a rerun can reuse it.
+        session (requests.Session): Optional pooled session shared with other downloads, e.g. from amplitude_session. A private session is used otherwise.
+        retry_policy (RetryPolicy): Optional backoff policy. Defaults to RetryPolicy(max_attempts).
+        download_dir (str): Folder the archive is written to. Defaults to 'downloaded_data'.
+        cache_dir (str): Optional archive cache (see amplitude_cache). A window already cached for this project is taken from it without a request, and a downloaded archive is added to it. Only windows ending before the last settled hour use the cache.
+        availability_lag_hours (int): Hours after the end of an hour before its events are assumed complete. Younger windows are always downloaded and never cached, so late events are not masked by an earlier export.
 
     Returns:
         bool: True if API call and download completed successfully.
               False if API call fails.
+
+    Raises:
+        AmplitudeExportError: if raise_on_status is True and the API returns 400, 404 or 504.
     '''
 
     # API date parameters
@@ -30,98 +61,250 @@ def amplitude_api_call(url: str, start_time: str, end_time: str, AMP_API_KEY: st
         'end': end_time
     }
 
+    # Pooled session and retry policy. A session created here is closed before returning
+    own_session = session is None
+    if own_session:
+        session = amplitude_session(pool_maxsize=1)
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_attempts=max_attempts)
+
+    # Create downloaded data folder if it doesn't already exist
+    os.makedirs(download_dir, exist_ok=True)
+
+    # Create dynamic file name based off of start/end time
+    filename = f'amplitude_{start_time}_{end_time}'
+
+    # Created filepath using filename variable and folder variable
+    filepath = f'{download_dir}/{filename}.zip'
+
+    # Only settled windows go through the cache. A younger window may still gain late events, so it is always exported afresh and its archive is not kept
+    if end_time > amplitude_last_settled_hour(availability_lag_hours):
+        cache_dir = None
+
+    # A window of this project already in the cache is served from disk instead of the export API
+    cached = amplitude_cache_fetch_archive(cache_dir, filepath, AMP_API_KEY)
+    if cached:
+        amplitude_checkpoint_record_archive(checkpoint_path, filepath, *cached)
+        print(f'Cache: reused cached archive for {filename} ({cached[1]} bytes). No download needed.')
+        logger.info(f'Cache: reused cached archive for {filename} ({cached[1]} bytes). No download needed.')
+        metrics_increment('amplitude_api_call', 'bytes_out', cached[1])
+        metrics_increment('amplitude_api_call', 'files')
+        metrics_increment('amplitude_api_call', 'cached')
+        if own_session:
+            session.close()
+        return True
+
+    # Partial file the stream is written to. Only renamed to filepath once the whole body has arrived. A partial file left by an earlier run may not match this export, so it is discarded
+    part_path = f'{filepath}.part'
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
     # Create variables for while loop check status code test and set False download_success as default
-    loop_count = 0
+    attempt = 0
     download_success = False
 
+    # ETag or Last-Modified of the export, sent back with Range requests so the server only resumes the same file
+    validator = None
+
     # Log beginning of API connection and file download process
     print('Initiating API connection and file download')
     logger.info('Initiating API connection and file download')
 
-    # Logic to ensure API call retries do not exceed defined number of attempts
-    while loop_count < max_attempts:
+    try:
+        # Logic to ensure API call retries do not exceed defined number of attempts
+        while attempt < retry_policy.max_attempts:
+
+            # Logging that download attempt has begun
+            logger.info(f"Download attempt {attempt + 1}/{retry_policy.max_attempts}...")
+
+            # Response of this attempt, checked for Retry-After if the attempt fails
+            response = None
 
-        # Logging that download attempt has begun
-        logger.info(f"Download attempt {loop_count + 1}/{max_attempts}...")
+            # Make the GET request with basic authentication. try/except block to log information in the case of any errors and prevent early exit of loop.
+            try:
+                # Start request timer used to calculate time to first byte and download throughput
+                request_start = time.perf_counter()
 
-        # Make the GET request with basic authentication. try/except block to log information in the case of any errors and prevent early exit of loop.
-        try:
-            response = requests.get(url, params=params, auth=(AMP_API_KEY, AMP_SECRET_KEY), timeout = 45)
+                # Ask only for the missing bytes when an earlier attempt left part of the file
+                resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                # The archive is already compressed. A gzip-encoded body would be decoded by iter_content, so neither the length check nor Range offsets would match the bytes on disk
+                headers = {'Accept-Encoding': 'identity'}
+                if resume_from:
+                    headers['Range'] = f'bytes={resume_from}-'
+                    if validator:
+                        headers['If-Range'] = validator
 
-            # Assign response status code to a variable
-            response_code = response.status_code
+                # stream=True stops requests from buffering the whole archive in memory before it is written
+                response = session.get(url, params=params, auth=(AMP_API_KEY, AMP_SECRET_KEY), headers=headers, timeout = 45, stream = True)
 
-            # Create variable for downloaded data folder creation logic
-            download_dir = "downloaded_data"
-            os.makedirs(download_dir, exist_ok=True)
+                # With stream=True, get returns as soon as the response headers arrive, before the body is read
+                first_byte_time = time.perf_counter() - request_start
 
-            # Create dynamic file name based off of start/end time
-            filename = f'amplitude_{start_time}_{end_time}'
+                # Assign response status code to a variable
+                response_code = response.status_code
 
-            # Created filepath using filename variable and folder variable
-            filepath = f'{download_dir}/{filename}.zip'
+                # Wrapping file write logic into conditional statement that checks response status code and returns a response to use based off of this.
+                if response_code in (200, 206):
 
-            # Wrapping folder creation, filepath creation, file write logic into conditional statement that checks response status code and returns a response to use based off of this.
-            if response_code == 200:
-                logger.info("Connection established. Downloading stream...")
+                    # 200 to a Range request means the server sent the whole file again
+                    if response_code == 200 and resume_from:
+                        print(f'Server did not resume {filename}. Downloading from the start.')
+                        logger.warning(f'Server did not resume {filename}. Downloading from the start.')
+                        resume_from = 0
+                    elif response_code == 206:
+                        print(f'Resuming {filename} from byte {resume_from}.')
+                        logger.info(f'Resuming {filename} from byte {resume_from}.')
+                    else:
+                        logger.info("Connection established. Downloading stream...")
+                    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
 
-                # Assign data to variable
-                data = response.content
+                    # The checksum covers the bytes already on disk as well as the ones about to arrive
+                    archive_digest = hashlib.sha256()
+                    if resume_from:
+                        with open(part_path, 'rb') as file:
+                            for chunk in iter(lambda: file.read(chunk_size), b''):
+                                archive_digest.update(chunk)
+
+                    # Expected final size, when the server says how long the body is
+                    content_length = response.headers.get('Content-Length')
+                    expected_bytes = resume_from + int(content_length) if content_length else None
+
+                    # Write the response body to the partial file in bounded chunks
+                    bytes_written = resume_from
+                    with open(part_path, 'ab' if resume_from else 'wb') as file:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            if not chunk:
+                                continue
+                            file.write(chunk)
+                            archive_digest.update(chunk)
+                            bytes_written += len(chunk)
+
+                    # A body cut short without an error is retried like a dropped connection
+                    if expected_bytes is not None and bytes_written != expected_bytes:
+                        raise requests.exceptions.ChunkedEncodingError(f'Received {bytes_written} of {expected_bytes} bytes.')
+
+                    # Calculate download statistics
+                    total_time = time.perf_counter() - request_start
+                    transfer_time = max(total_time - first_byte_time, 1e-6)
+                    bytes_per_second = (bytes_written - resume_from) / transfer_time
+
+                    # Move the completed file into place. os.replace is atomic on the same filesystem
+                    os.replace(part_path, filepath)
+
+                    # Record the finished archive so a rerun can verify and reuse it instead of downloading again
+                    amplitude_checkpoint_record_archive(checkpoint_path, filepath, archive_digest.hexdigest(), bytes_written)
+                    amplitude_cache_store_archive(cache_dir, filepath, archive_digest.hexdigest(), bytes_written, AMP_API_KEY)
 
-                # try/except block to provide information if there are any issues writing the file
-                try:
-                    # Writing data file
-                    with open(filepath, 'wb') as file:
-                        file.write(data)
                     # Print success message
                     print(f'Data retrieved and stored at /{filepath} 😊')
                     # Logger will note a message if file write is successful
                     logger.info(f'Data retrieved and stored at /{filepath} 😊') 
+                    print(f'Downloaded {bytes_written} bytes. Time to first byte: {first_byte_time:.2f}s. Throughput: {bytes_per_second / 1024 / 1024:.2f} MB/s.')
+                    logger.info(f'Downloaded {bytes_written} bytes. Time to first byte: {first_byte_time:.2f}s. Throughput: {bytes_per_second / 1024 / 1024:.2f} MB/s.')
                     download_success = True
-                except Exception as e:
-                    print(e)
-                    # Logger will note exception error if file write is unsuccessful
-                    logger.error(f"An error occurred; {e}")             
-                break
 
-            # Print reason status code 400
-            elif response_code == 400:
-                print('Status code 400: File size max of 4GB exceeded. Adjust date range and try again')
-                # Logger notes response reason when response code is 100s or 500s
-                logger.warning('Status code 400: File size max of 4GB exceeded.')      
-                break
+                    # Add the archive to the download stage metrics
+                    metrics_increment('amplitude_api_call', 'bytes_in', bytes_written - resume_from)
+                    metrics_increment('amplitude_api_call', 'bytes_out', bytes_written)
+                    metrics_increment('amplitude_api_call', 'files')
+                    break
 
-            # Print reason status code 404
-            elif response_code == 404:
-                print('Status code 404: either the API did not run correctly or there is no data available for this time range. Double check the API configuration or adjust date range and try again')
-                # Logger notes response reason when response code is 100s or 500s
-                logger.warning('Status code 404: either the API did not run correctly or there is no data available for this time range.')    
-                break
+                # Print reason status code 400
+                elif response_code == 400:
+                    print('Status code 400: File size max of 4GB exceeded. Adjust date range and try again')
+                    # Logger notes response reason when response code is 100s or 500s
+                    logger.warning('Status code 400: File size max of 4GB exceeded.')      
+                    if raise_on_status:
+                        raise AmplitudeExportError(400, f'{start_time}-{end_time}: Status code 400: File size max of 4GB exceeded.')
+                    break
+
+                # Print reason status code 404
+                elif response_code == 404:
+                    print('Status code 404: either the API did not run correctly or there is no data available for this time range. Double check the API configuration or adjust date range and try again')
+                    # Logger notes response reason when response code is 100s or 500s
+                    logger.warning('Status code 404: either the API did not run correctly or there is no data available for this time range.')    
+                    if raise_on_status:
+                        raise AmplitudeExportError(404, f'{start_time}-{end_time}: Status code 404: either the API did not run correctly or there is no data available for this time range.')
+                    break
+
+                # Print reason status code 504
+                elif response_code == 504:
+                    print('Status code 504: Timeout due to large data size. Adjust date range and try again') 
+                    # Logger notes response reason when response code is 100s or 500s
+                    logger.warning('Status code 504: Timeout due to large data size.')    
+                    if raise_on_status:
+                        raise AmplitudeExportError(504, f'{start_time}-{end_time}: Status code 504: Timeout due to large data size.')
+                    break
+
+                # The partial file no longer matches the export. Start over on the next attempt
+                elif response_code == 416:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    attempt += 1
+                    print(f'Status code 416: cannot resume {filename}. Restarting download. This was attempt {attempt}/{retry_policy.max_attempts}.')
+                    logger.warning(f'Status code 416: cannot resume {filename}. Restarting download. This was attempt {attempt}/{retry_policy.max_attempts}.')
+                    _backoff(retry_policy, attempt)
 
-            # Print reason status code 504
-            elif response_code == 504:
-                print('Status code 504: Timeout due to large data size. Adjust date range and try again') 
-                # Logger notes response reason when response code is 100s or 500s
-                logger.warning('Status code 504: Timeout due to large data size.')    
+                # Rate limiting and transient server errors are retried after a backoff delay
+                elif retry_policy.should_retry(response_code):
+                    attempt += 1
+                    print(f'Error: {response.reason}. Status code: {response_code}. This was attempt {attempt}/{retry_policy.max_attempts}.')
+                    # Logger notes response reason when error occurs when connecting to the API
+                    logger.warning(f'Error: {response.reason}. Status code: {response_code}. This was attempt {attempt}/{retry_policy.max_attempts}.')
+                    _backoff(retry_policy, attempt, response)
+
+                # Anything else (e.g. 401 bad credentials) will not succeed on retry
+                else:
+                    print(f'Error: {response.reason}. Status code: {response_code}. Not retrying.')
+                    logger.error(f'Error: {response.reason}. Status code: {response_code}. Not retrying.')
+                    metrics_increment('amplitude_api_call', 'errors')
+                    break
+
+            # Exception errors raised if API connection fails or drops mid-stream. The partial file is kept so the next attempt can resume it
+            except requests.exceptions.Timeout as e:
+                attempt += 1
+                print(f"Request Timeout - {e}")
+                logger.error(f"Request timed out - server may be slow. This was attempt {attempt}/{retry_policy.max_attempts}.")
+                metrics_increment('amplitude_api_call', 'errors')
+                _backoff(retry_policy, attempt)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                attempt += 1
+                print(f"Connection Error - {e}")
+                logger.error(f"Connection failed or dropped mid-stream - {e}. This was attempt {attempt}/{retry_policy.max_attempts}.")
+                metrics_increment('amplitude_api_call', 'errors')
+                _backoff(retry_policy, attempt)
+            except requests.exceptions.RequestException as e:
+                attempt += 1
+                print(f"Request Exception- {e}")
+                logger.error(f"Other request error: {e}. This was attempt {attempt}/{retry_policy.max_attempts}.")
+                metrics_increment('amplitude_api_call', 'errors')
+                _backoff(retry_policy, attempt)
+            except OSError as e:
+                # Local disk errors will not be fixed by retrying
+                print(e)
+                logger.error(f"An error occurred; {e}")
+                metrics_increment('amplitude_api_call', 'errors')
                 break
+            finally:
+                # Release the connection back to the pool
+                if response is not None:
+                    response.close()
+
+    finally:
+        # Remove the partial file so an incomplete archive is never picked up by the extract stage
+        if not download_success and os.path.exists(part_path):
+            os.remove(part_path)
+        if own_session:
+            session.close()
+
+    return(download_success)
 
-            # Print response reason and number of attempts and wait 10 seconds before loop runs again
-            else:
-                loop_count +=1
-                print(f'Error: {response.reason}. Status code: {response_code}. API will try again shortly. This is attempt {loop_count}/{max_attempts}. Retrying...')
-                # Logger notes response reason when error occurs when connecting to the API
-                logger.warning(f'Error: {response.reason}. API will try again shortly. This is attempt {loop_count}/{max_attempts}. Retrying...')
-                time.sleep(10)
-
-        # Exception errors raised if API connection fails
-        except requests.exceptions.Timeout as e:
-            print(f"Request Timeout - {e}")
-            logger.error("Request timed out - server may be slow")
-        except requests.exceptions.ConnectionError as e:
-            print(f"Connection Error - {e}")
-            logger.error("Connection failed - check network")
-        except requests.exceptions.RequestException as e:
-            print(f"Request Exception- {e}")
-            logger.error(f"Other request error: {e}")
-
-    return(download_success)
\ No newline at end of file
+def _backoff(retry_policy: RetryPolicy, attempt: int, response=None):
+    # Wait before the next attempt, unless this was the last one
+    if attempt >= retry_policy.max_attempts:
+        return
+    delay = retry_policy.delay(attempt, response)
+    metrics_increment('amplitude_api_call', 'retries')
+    print(f'Retrying in {delay:.1f}s...')
+    logger.info(f'Retrying in {delay:.1f}s...')
+    time.sleep(delay)
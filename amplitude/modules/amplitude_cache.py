@@ -0,0 +1,230 @@
+# Import libraries
+from datetime import datetime, timedelta
+import os
+import hashlib
+import json
+import shutil
+import threading
+import logging
+
+# Import modules
+from modules.amplitude_checkpoint import file_sha256
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Index of cached archives (project identity/window filename -> checksum) and uploaded objects (bucket/key -> ETag), kept in the cache folder
+CACHE_INDEX = 'index.json'
+
+# Archives are stored once per content, as archives/<sha256>.zip
+ARCHIVES_DIR = 'archives'
+
+# Serialises read-modify-write cycles on the index across threads
+_cache_lock = threading.Lock()
+
+def _load_index(cache_dir: str):
+    # Missing index means an empty cache
+    index_path = os.path.join(cache_dir, CACHE_INDEX)
+    if not os.path.exists(index_path):
+        return {'archives': {}, 'objects': {}}
+    with open(index_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _save_index(cache_dir: str, index: dict):
+    # Write to a temporary file and rename, so a crash never leaves a half-written index
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, CACHE_INDEX)
+    temp_path = f'{index_path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(temp_path, index_path)
+
+def _link_or_copy(source_path: str, target_path: str):
+    # A hard link costs no disk space and survives the source being deleted; copy when the paths are on different filesystems
+    temp_path = f'{target_path}.part'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, target_path)
+
+def _archive_path(cache_dir: str, sha256: str):
+    return os.path.join(cache_dir, ARCHIVES_DIR, f'{sha256}.zip')
+
+def _archive_key(AMP_API_KEY: str, filepath: str):
+    # Windows are named by time only, so the entry also names the project it was exported from. The API key is stored as a short hash, never in plain text
+    identity = hashlib.blake2b(AMP_API_KEY.encode('utf-8'), digest_size=8).hexdigest()
+    return f'{identity}/{os.path.basename(filepath)}'
+
+def amplitude_cache_store_archive(cache_dir: str, filepath: str, sha256: str, size: int, AMP_API_KEY: str):
+    '''
+    Adds a downloaded archive to the cache under its project and window filename, so a later download of the same window of the same project can be served from disk.
+
+    Args:
+        cache_dir (str): cache folder. Nothing is cached if empty.
+        filepath (str): path of the downloaded archive.
+        sha256 (str): hex SHA-256 of the archive.
+        size (int): size of the archive in bytes.
+        AMP_API_KEY (str): API key of the project the archive was exported from.
+    '''
+
+    if not cache_dir:
+        return
+
+    archive_path = _archive_path(cache_dir, sha256)
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    now = datetime.now().isoformat(timespec='seconds')
+    with _cache_lock:
+        # Identical content downloaded for another window is stored only once
+        if not os.path.exists(archive_path):
+            _link_or_copy(filepath, archive_path)
+        index = _load_index(cache_dir)
+        index['archives'][_archive_key(AMP_API_KEY, filepath)] = {'sha256': sha256, 'size': size, 'cached_at': now, 'used_at': now}
+        _save_index(cache_dir, index)
+
+    logger.info(f'Cache: stored {os.path.basename(filepath)} ({size} bytes, sha256 {sha256[:12]}...).')
+
+def amplitude_cache_fetch_archive(cache_dir: str, filepath: str, AMP_API_KEY: str):
+    '''
+    Places the cached archive of a window at filepath instead of downloading it again. The cached file is checked against its recorded size and SHA-256 first; a damaged entry is dropped.
+
+    Args:
+        cache_dir (str): cache folder.
+        filepath (str): path the archive would be downloaded to. Its filename identifies the window.
+        AMP_API_KEY (str): API key of the project being exported. Archives of other projects are never returned.
+
+    Returns:
+        tuple: (sha256, size) of the archive placed at filepath, or None if the window is not cached.
+    '''
+
+    if not cache_dir:
+        return None
+
+    zip_filename = os.path.basename(filepath)
+    archive_key = _archive_key(AMP_API_KEY, filepath)
+    with _cache_lock:
+        record = _load_index(cache_dir)['archives'].get(archive_key)
+    if not record:
+        return None
+
+    # Size is checked first because it is free; the checksum only runs when sizes agree
+    archive_path = _archive_path(cache_dir, record['sha256'])
+    if not (os.path.exists(archive_path) and os.path.getsize(archive_path) == record['size'] and file_sha256(archive_path) == record['sha256']):
+        with _cache_lock:
+            index = _load_index(cache_dir)
+            index['archives'].pop(archive_key, None)
+            _save_index(cache_dir, index)
+        print(f'Cache: dropped damaged entry for {zip_filename}.')
+        logger.warning(f'Cache: dropped damaged entry for {zip_filename}.')
+        return None
+
+    _link_or_copy(archive_path, filepath)
+    with _cache_lock:
+        index = _load_index(cache_dir)
+        if archive_key in index['archives']:
+            index['archives'][archive_key]['used_at'] = datetime.now().isoformat(timespec='seconds')
+            _save_index(cache_dir, index)
+
+    return record['sha256'], record['size']
+
+def amplitude_cache_record_objects(cache_dir: str, AWS_BUCKET_NAME: str, objects: list):
+    '''
+    Records objects known to be in S3 with their ETag and size, so identical files are not uploaded or even checked again.
+
+    Args:
+        cache_dir (str): cache folder. Nothing is recorded if empty.
+        AWS_BUCKET_NAME (str): bucket the objects are in.
+        objects (list): (key, etag, size) tuples.
+    '''
+
+    if not cache_dir or not objects:
+        return
+
+    now = datetime.now().isoformat(timespec='seconds')
+    with _cache_lock:
+        index = _load_index(cache_dir)
+        for key, etag, size in objects:
+            if etag:
+                index['objects'][f'{AWS_BUCKET_NAME}/{key}'] = {'etag': etag, 'size': size, 'cached_at': now}
+        _save_index(cache_dir, index)
+
+def amplitude_cache_object_matches(cache_dir: str, AWS_BUCKET_NAME: str, key: str, size: int, etag: str):
+    '''
+    Checks in the index alone, without a request to S3, whether this exact object was already uploaded.
+
+    Args:
+        cache_dir (str): cache folder.
+        AWS_BUCKET_NAME (str): bucket name.
+        key (str): object key.
+        size (int): local file size in bytes.
+        etag (str): ETag computed for the local file with file_s3_etag.
+
+    Returns:
+        bool: True if the index holds the object with the same size and ETag.
+    '''
+
+    if not cache_dir:
+        return False
+
+    with _cache_lock:
+        record = _load_index(cache_dir)['objects'].get(f'{AWS_BUCKET_NAME}/{key}')
+    return bool(record) and record['size'] == size and record['etag'] == etag
+
+def amplitude_cache_evict(cache_dir: str, max_size_mb: int = 0, max_age_days: int = 0):
+    '''
+    Evicts cache entries older than max_age_days, then the least recently used archives until the archives take up at most max_size_mb. Archive files no entry refers to any more are deleted.
+    Age also bounds how long a cached export is reused, so late-arriving events are picked up once an entry expires.
+
+    Args:
+        cache_dir (str): cache folder.
+        max_size_mb (int): upper bound for the archives on disk. 0 means no bound.
+        max_age_days (int): days an entry is kept after it was cached. 0 means no limit.
+
+    Returns:
+        dict: archives and objects evicted, and MB freed.
+    '''
+
+    summary = {'archives': 0, 'objects': 0, 'mb_freed': 0.0}
+    if not cache_dir or not os.path.exists(cache_dir):
+        return summary
+
+    with _cache_lock:
+        index = _load_index(cache_dir)
+
+        # Expired entries first
+        if max_age_days:
+            cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat(timespec='seconds')
+            for section in ('archives', 'objects'):
+                expired = [name for name, record in index[section].items() if record['cached_at'] < cutoff]
+                for name in expired:
+                    del index[section][name]
+                summary[section] += len(expired)
+
+        # Then least recently used archives, counting content shared by several windows once
+        if max_size_mb:
+            sizes = {record['sha256']: record['size'] for record in index['archives'].values()}
+            for name, record in sorted(index['archives'].items(), key=lambda item: item[1]['used_at']):
+                if sum(sizes.values()) <= max_size_mb * 1024 * 1024:
+                    break
+                del index['archives'][name]
+                summary['archives'] += 1
+                if not any(other['sha256'] == record['sha256'] for other in index['archives'].values()):
+                    sizes.pop(record['sha256'], None)
+
+        # Delete archive files left without an entry
+        referenced = {record['sha256'] for record in index['archives'].values()}
+        archives_dir = os.path.join(cache_dir, ARCHIVES_DIR)
+        for archive_filename in os.listdir(archives_dir) if os.path.exists(archives_dir) else []:
+            if archive_filename.endswith('.zip') and archive_filename[:-4] not in referenced:
+                archive_path = os.path.join(archives_dir, archive_filename)
+                summary['mb_freed'] += os.path.getsize(archive_path) / 1024 / 1024
+                os.remove(archive_path)
+
+        _save_index(cache_dir, index)
+
+    if summary['archives'] or summary['objects']:
+        print(f"Cache: evicted {summary['archives']} archive(s) and {summary['objects']} object record(s), freed {summary['mb_freed']:.1f}MB.")
+        logger.info(f"Cache: evicted {summary['archives']} archive(s) and {summary['objects']} object record(s), freed {summary['mb_freed']:.1f}MB.")
+    return summary
@@ -0,0 +1,237 @@
+# Import libraries
+from datetime import datetime
+from botocore.exceptions import ClientError
+from s3transfer.utils import ChunksizeAdjuster
+import os
+import json
+import hashlib
+import threading
+import logging
+
+# Import modules
+from modules.amplitude_watermark import amplitude_archive_hours
+from modules.amplitude_transform import OUTPUT_EXTENSIONS
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Size of the buffer used when hashing files
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Serialises read-modify-write cycles on the checkpoint file across threads
+_checkpoint_lock = threading.Lock()
+
+def file_sha256(path: str):
+    '''
+    Returns the hex SHA-256 of a file, read in bounded chunks.
+    '''
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_s3_etag(path: str, multipart_threshold: int, multipart_chunksize: int):
+    '''
+    Computes the ETag S3 will report for a file uploaded with the given transfer settings: the plain MD5 for single-part uploads, or the MD5 of the part MD5s followed by '-<parts>' for multipart uploads.
+
+    Args:
+        path (str): local file path.
+        multipart_threshold (int): TransferConfig.multipart_threshold in bytes.
+        multipart_chunksize (int): TransferConfig.multipart_chunksize in bytes.
+
+    Returns:
+        str: ETag without surrounding quotes.
+    '''
+
+    file_size = os.path.getsize(path)
+
+    # Single-part uploads use the MD5 of the whole body
+    if file_size < multipart_threshold:
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    # s3transfer grows the part size for very large files to stay under the part limit, so the same adjustment is applied here
+    part_size = ChunksizeAdjuster().adjust_chunksize(multipart_chunksize, file_size)
+    part_digests = []
+    with open(path, 'rb') as f:
+        for part in iter(lambda: f.read(part_size), b''):
+            part_digests.append(hashlib.md5(part).digest())
+    return f'{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}'
+
+def _load_checkpoint(checkpoint_path: str):
+    # Missing checkpoint file means no unit of work has finished yet
+    if not os.path.exists(checkpoint_path):
+        return {'archives': {}}
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        checkpoint = json.load(f)
+    # Uploaded objects were once recorded here but never read; they are dropped on the next save. S3 itself, or the cache index, tells what was uploaded
+    checkpoint.pop('objects', None)
+    return checkpoint
+
+def _save_checkpoint(checkpoint_path: str, checkpoint: dict):
+    # Write to a temporary file and rename, so a crash never leaves a half-written checkpoint
+    os.makedirs(os.path.dirname(checkpoint_path) or '.', exist_ok=True)
+    temp_path = f'{checkpoint_path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, indent=2, sort_keys=True)
+    os.replace(temp_path, checkpoint_path)
+
+def amplitude_checkpoint_record_archive(checkpoint_path: str, filepath: str, sha256: str, size: int):
+    '''
+    Records a fully downloaded archive with its checksum and size.
+
+    Args:
+        checkpoint_path (str): path of the checkpoint JSON file.
+        filepath (str): path of the downloaded archive.
+        sha256 (str): hex SHA-256 of the archive.
+        size (int): size of the archive in bytes.
+    '''
+
+    if not checkpoint_path:
+        return
+
+    with _checkpoint_lock:
+        checkpoint = _load_checkpoint(checkpoint_path)
+        checkpoint['archives'][os.path.basename(filepath)] = {
+            'sha256': sha256,
+            'size': size,
+            'members': {},
+            'downloaded_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        _save_checkpoint(checkpoint_path, checkpoint)
+
+    logger.info(f'Checkpoint: recorded archive {os.path.basename(filepath)} ({size} bytes, sha256 {sha256[:12]}...).')
+
+def amplitude_checkpoint_forget_archive(checkpoint_path: str, zip_filename: str):
+    '''
+    Drops an archive from the checkpoint once it has been fully processed and deleted.
+    '''
+
+    if not checkpoint_path:
+        return
+
+    with _checkpoint_lock:
+        checkpoint = _load_checkpoint(checkpoint_path)
+        if checkpoint['archives'].pop(zip_filename, None) is not None:
+            _save_checkpoint(checkpoint_path, checkpoint)
+
+def amplitude_checkpoint_verified_hours(checkpoint_path: str, download_dir: str):
+    '''
+    Verifies archives left in download_dir by an earlier run against their recorded checksum. Archives that match are kept and their hours are returned so they are not downloaded again; archives that do not match, or were never recorded as complete, are deleted.
+
+    Args:
+        checkpoint_path (str): path of the checkpoint JSON file.
+        download_dir (str): folder holding downloaded archives.
+
+    Returns:
+        set: hours in '%Y%m%dT%H' format covered by verified archives.
+    '''
+
+    verified_hours = set()
+    if not checkpoint_path or not os.path.exists(download_dir):
+        return verified_hours
+
+    with _checkpoint_lock:
+        checkpoint = _load_checkpoint(checkpoint_path)
+
+    for zip_filename in [f for f in os.listdir(download_dir) if f.endswith('.zip')]:
+        zip_path = os.path.join(download_dir, zip_filename)
+        record = checkpoint['archives'].get(zip_filename)
+
+        # Size is checked first because it is free; the checksum only runs when sizes agree
+        if record and os.path.getsize(zip_path) == record['size'] and file_sha256(zip_path) == record['sha256']:
+            verified_hours.update(amplitude_archive_hours(zip_filename))
+            print(f'Checkpoint: resuming from verified archive {zip_filename}.')
+            logger.info(f'Checkpoint: resuming from verified archive {zip_filename}.')
+        else:
+            os.remove(zip_path)
+            print(f'Checkpoint: deleted unverified archive {zip_filename}.')
+            logger.warning(f'Checkpoint: deleted unverified archive {zip_filename}.')
+
+    return verified_hours
+
+def amplitude_checkpoint_record_members(checkpoint_path: str, zip_filename: str, outcomes: list):
+    '''
+    Records members extracted from an archive with the name and size of their output.
+
+    Args:
+        checkpoint_path (str): path of the checkpoint JSON file.
+        zip_filename (str): archive filename.
+        outcomes (list): (member_name, output_name, bytes_out) tuples. output_name is the file actually written, e.g. a '.rerun-<timestamp>.json' name, or None if no event of the member was left to load.
+    '''
+
+    if not checkpoint_path or not outcomes:
+        return
+
+    with _checkpoint_lock:
+        checkpoint = _load_checkpoint(checkpoint_path)
+        archive = checkpoint['archives'].setdefault(zip_filename, {'members': {}})
+        for member_name, output_name, bytes_out in outcomes:
+            archive['members'][member_name] = {'output': output_name, 'bytes': bytes_out}
+        _save_checkpoint(checkpoint_path, checkpoint)
+
+def amplitude_checkpoint_extracted_members(checkpoint_path: str, zip_filename: str, extract_folder: str):
+    '''
+    Lists members of an archive that were already extracted: members that left no output, and members whose output is still on disk, either as the JSON file with the recorded size or re-encoded by amplitude_transform.
+
+    Args:
+        checkpoint_path (str): path of the checkpoint JSON file.
+        zip_filename (str): archive filename.
+        extract_folder (str): folder the outputs were written to.
+
+    Returns:
+        set: member names that can be skipped.
+    '''
+
+    if not checkpoint_path:
+        return set()
+
+    with _checkpoint_lock:
+        checkpoint = _load_checkpoint(checkpoint_path)
+
+    members = checkpoint['archives'].get(zip_filename, {}).get('members', {})
+    done = set()
+    for member_name, record in members.items():
+        # Records written before output names were kept hold only the size of '<member>.json'
+        if not isinstance(record, dict):
+            record = {'output': os.path.basename(member_name)[:-3], 'bytes': record}
+
+        # No event of the member was left to load, so there is nothing to look for
+        output_name = record['output']
+        if output_name is None:
+            done.add(member_name)
+            continue
+
+        out_path = os.path.join(extract_folder, output_name)
+        if os.path.exists(out_path) and os.path.getsize(out_path) == record['bytes']:
+            done.add(member_name)
+        elif any(os.path.exists(out_path[:-len('.json')] + extension) for extension in OUTPUT_EXTENSIONS.values()):
+            done.add(member_name)
+    return done
+
+def amplitude_checkpoint_object_matches(s3_client, AWS_BUCKET_NAME: str, key: str, size: int, etag: str):
+    '''
+    Checks with a HeadObject call whether S3 already holds this exact object.
+
+    Args:
+        s3_client (botocore.client.S3): S3 client.
+        AWS_BUCKET_NAME (str): bucket name.
+        key (str): object key.
+        size (int): local file size in bytes.
+        etag (str): ETag computed for the local file with file_s3_etag.
+
+    Returns:
+        bool: True if the object exists with the same size and ETag.
+    '''
+
+    try:
+        head = s3_client.head_object(Bucket=AWS_BUCKET_NAME, Key=key)
+    except ClientError:
+        return False
+
+    return head['ContentLength'] == size and head['ETag'].strip('"') == etag
@@ -0,0 +1,173 @@
+# Import libraries
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import logging
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Amplitude export API hour format, used to name the hourly index partitions
+HOUR_FORMAT = '%Y%m%dT%H'
+
+# orjson parses several times faster when installed; the standard library is the fallback
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# Keys per SELECT ... IN (...) query, below SQLite's default limit on bound parameters
+LOOKUP_CHUNK_SIZE = 900
+
+def event_key(line: bytes):
+    '''
+    Returns the 64-bit dedup key of one NDJSON event: a BLAKE2b hash of its top-level uuid, or of its $insert_id when there is no uuid. 8-byte keys keep each index row small while collisions stay negligible at billions of events.
+    The line is parsed rather than searched, as event_properties, user_properties and group_properties may hold their own 'uuid' keys.
+
+    Args:
+        line (bytes): one raw event line.
+
+    Returns:
+        int: signed 64-bit key, or None if the event has neither identifier.
+    '''
+
+    try:
+        event = json_loads(line)
+    except ValueError:
+        return None
+    if not isinstance(event, dict):
+        return None
+
+    identifier = event.get('uuid') or event.get('$insert_id')
+    if not identifier:
+        return None
+
+    return int.from_bytes(hashlib.blake2b(str(identifier).encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+class DedupIndex:
+    '''
+    On-disk index of the events already emitted for one export hour, stored as a SQLite table of 64-bit keys (one file per hour under dedup_dir). Lookups are batched primary-key probes, so cost grows with the log of the hour's size rather than the history.
+    Used as a context manager around the extraction of one member. Each batch of lines takes the hour's write lock only while its keys are checked and claimed, so partitions of the same hour (e.g. '#0' and '#1') extract side by side yet never both emit an event.
+    Claimed keys are held in a pending table under the member's name. They move to the seen table on a clean exit and are released if an exception is raised, so a failed extraction never marks its events as seen. Claims left by a crashed run are released when the same member is extracted again.
+
+    Args:
+        dedup_dir (str): folder holding the hourly partitions.
+        hour (str): export hour in '%Y%m%dT%H' format.
+        member (str): name of the member being extracted, which owns the claimed keys.
+        timeout (float): seconds to wait for another process holding the hour's write lock for one batch.
+    '''
+
+    def __init__(self, dedup_dir: str, hour: str, member: str, timeout: float = 60.0):
+        self.path = os.path.join(dedup_dir, f'{hour}.sqlite')
+        self.member = member
+        self.timeout = timeout
+        self.connection = None
+        self.events_in = 0
+        self.events_out = 0
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS seen (key INTEGER PRIMARY KEY) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pending (key INTEGER PRIMARY KEY, member TEXT NOT NULL) WITHOUT ROWID')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS pending_member ON pending (member)')
+
+        # Claims of an earlier, interrupted extraction of this member would hide its events
+        with self._transaction():
+            self.connection.execute('DELETE FROM pending WHERE member = ?', (self.member,))
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            with self._transaction():
+                if exc_type is None:
+                    self.connection.execute('INSERT INTO seen (key) SELECT key FROM pending WHERE member = ?', (self.member,))
+                self.connection.execute('DELETE FROM pending WHERE member = ?', (self.member,))
+        finally:
+            self.connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        # Holds the hour's write lock for the statements inside the block only
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def filter_new(self, lines: list):
+        '''
+        Returns the lines whose events have not been seen or claimed before, and claims them for this member. Lines without an identifier are always kept.
+
+        Args:
+            lines (list): raw NDJSON event lines.
+
+        Returns:
+            list: lines to emit, in their original order.
+        '''
+
+        # Keys are computed before the lock is taken, so the lock covers index work only
+        keyed = [(event_key(line), line) for line in lines if line.strip()]
+        self.events_in += len(keyed)
+        keys = list({key for key, _ in keyed if key is not None})
+
+        with self._transaction():
+            # Keys already emitted, or claimed by another partition of the hour
+            seen = set()
+            for table in ('seen', 'pending'):
+                for offset in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+                    chunk = keys[offset:offset + LOOKUP_CHUNK_SIZE]
+                    rows = self.connection.execute(f'SELECT key FROM {table} WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+                    seen.update(row[0] for row in rows)
+
+            # Keep the first occurrence of each new key, including repeats within this batch
+            new_lines = []
+            new_keys = []
+            for key, line in keyed:
+                if key is None:
+                    new_lines.append(line)
+                elif key not in seen:
+                    seen.add(key)
+                    new_keys.append((key, self.member))
+                    new_lines.append(line)
+
+            self.connection.executemany('INSERT INTO pending (key, member) VALUES (?, ?)', new_keys)
+
+        self.events_out += len(new_lines)
+        return new_lines
+
+def amplitude_dedup_prune(dedup_dir: str, keep_days: int):
+    '''
+    Deletes hourly partitions older than keep_days, so the index only covers the window that reruns and backfills can overlap.
+
+    Args:
+        dedup_dir (str): folder holding the hourly partitions.
+        keep_days (int): number of days of partitions to keep.
+
+    Returns:
+        int: number of partitions deleted.
+    '''
+
+    if not os.path.exists(dedup_dir):
+        return 0
+
+    cutoff = (datetime.now() - timedelta(days=keep_days)).strftime(HOUR_FORMAT)
+    deleted = 0
+    for filename in os.listdir(dedup_dir):
+        hour = filename.split('.', 1)[0]
+        if re.fullmatch(r'\d{8}T\d{2}', hour) and hour < cutoff:
+            os.remove(os.path.join(dedup_dir, filename))
+            deleted += 1
+
+    if deleted:
+        print(f'Dedup index: removed {deleted} partition file(s) older than {keep_days} day(s).')
+        logger.info(f'Dedup index: removed {deleted} partition file(s) older than {keep_days} day(s).')
+    return deleted
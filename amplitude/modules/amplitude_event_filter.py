@@ -0,0 +1,124 @@
+# Import libraries
+import json
+import logging
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+def _json_codec():
+    # orjson parses and serialises several times faster when installed; the standard library is the fallback
+    try:
+        import orjson
+        return orjson.loads, orjson.dumps
+    except ImportError:
+        return json.loads, lambda event: json.dumps(event, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _match_value(value):
+    # Scalars are compared as the strings they are configured with, so 'app=123456' matches the number 123456. Objects and arrays never match
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    return None
+
+class EventFilter:
+    '''
+    Validates and trims NDJSON export events while they are extracted, so malformed lines and events that are never used do not reach S3.
+    Each line is parsed once. Lines that are not JSON objects or lack a required field are quarantined; events of a dropped type, or matching a drop_where value, are dropped; drop_columns are removed from the events kept.
+    Holds configuration only, so it can be sent to extract worker processes.
+
+    Args:
+        required_fields (tuple): fields every event must have with a non-empty value, e.g. ('event_type', 'uuid').
+        drop_event_types (tuple): event types to drop, e.g. internal or test events.
+        drop_columns (tuple): top-level fields removed from every event kept.
+        drop_where (dict): field -> values; events whose field has one of the values are dropped, e.g. {'device_id': {'test-device'}}. Values are compared as strings, so numeric fields such as 'app' match too.
+        quarantine_dir (str): folder receiving one '<file>.json' of quarantined lines per export file.
+    '''
+
+    def __init__(self, required_fields: tuple = (), drop_event_types: tuple = (), drop_columns: tuple = (), drop_where: dict = None, quarantine_dir: str = 'quarantine'):
+        self.required_fields = tuple(required_fields)
+        self.drop_event_types = frozenset(str(event_type) for event_type in drop_event_types)
+        self.drop_columns = tuple(drop_columns)
+        self.drop_where = {field: frozenset(str(value) for value in values) for field, values in (drop_where or {}).items()}
+        self.quarantine_dir = quarantine_dir
+
+    def filter_lines(self, lines: list):
+        '''
+        Filters one batch of raw event lines.
+
+        Args:
+            lines (list): raw NDJSON event lines.
+
+        Returns:
+            tuple: (kept, dropped, quarantined) - lines to emit in their original order, the number of events dropped, and quarantine records ready to be written.
+        '''
+
+        loads, dumps = _json_codec()
+        kept = []
+        dropped = 0
+        quarantined = []
+
+        for line in lines:
+            if not line.strip():
+                continue
+
+            # Malformed lines and events missing a required field are kept aside for inspection
+            try:
+                event = loads(line)
+            except ValueError:
+                event = None
+            if not isinstance(event, dict):
+                reason = 'invalid_json'
+            else:
+                missing = [field for field in self.required_fields if event.get(field) in (None, '')]
+                reason = f"missing:{','.join(missing)}" if missing else None
+            if reason:
+                quarantined.append(dumps({'reason': reason, 'line': line.decode('utf-8', errors='replace').rstrip('\n')}) + b'\n')
+                continue
+
+            if _match_value(event.get('event_type')) in self.drop_event_types or any(_match_value(event.get(field)) in values for field, values in self.drop_where.items()):
+                dropped += 1
+                continue
+
+            # Projection: only events that lose a column are serialised again
+            if self.drop_columns and any(column in event for column in self.drop_columns):
+                for column in self.drop_columns:
+                    event.pop(column, None)
+                line = dumps(event) + b'\n'
+            elif not line.endswith(b'\n'):
+                line += b'\n'
+            kept.append(line)
+
+        return kept, dropped, quarantined
+
+def amplitude_event_filter(required_fields: str = '', drop_event_types: str = '', drop_columns: str = '', drop_where: str = '', quarantine_dir: str = 'quarantine'):
+    '''
+    Builds an EventFilter from comma-separated settings, as read from .env.
+
+    Args:
+        required_fields (str): e.g. 'event_type,uuid'.
+        drop_event_types (str): e.g. 'test_event,[Amplitude] Page Viewed'.
+        drop_columns (str): e.g. 'user_properties,data'.
+        drop_where (str): field=value pairs, e.g. 'device_id=test-device,user_id=qa@example.com'.
+        quarantine_dir (str): folder receiving quarantined lines.
+
+    Returns:
+        EventFilter: the filter, or None if nothing is configured.
+    '''
+
+    def split(value: str):
+        return tuple(item.strip() for item in value.split(',') if item.strip())
+
+    where = {}
+    for pair in split(drop_where):
+        field, separator, value = pair.partition('=')
+        if not separator:
+            raise ValueError(f"Invalid drop_where entry '{pair}'. Expected field=value.")
+        where.setdefault(field.strip(), set()).add(value.strip())
+
+    if not (split(required_fields) or split(drop_event_types) or split(drop_columns) or where):
+        return None
+
+    event_filter = EventFilter(split(required_fields), split(drop_event_types), split(drop_columns), where, quarantine_dir)
+    logger.info(f'Event filter: required {event_filter.required_fields}, dropping types {sorted(event_filter.drop_event_types)}, columns {event_filter.drop_columns}, where {sorted(where)}.')
+    return event_filter
@@ -0,0 +1,82 @@
+# Import libraries
+from datetime import datetime
+import os
+import json
+import threading
+import logging
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Serialises read-modify-write cycles on the manifest file across threads
+_manifest_lock = threading.Lock()
+
+def _load_manifest(manifest_path: str):
+    # Missing manifest file means nothing is waiting to be loaded
+    if not os.path.exists(manifest_path):
+        return {'objects': {}}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _save_manifest(manifest_path: str, manifest: dict):
+    # Write to a temporary file and rename, so a crash never leaves a half-written manifest
+    os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+    temp_path = f'{manifest_path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+def amplitude_manifest_add(manifest_path: str, keys: list):
+    '''
+    Records S3 objects uploaded by the pipeline that still have to be loaded into the warehouse.
+
+    Args:
+        manifest_path (str): path of the manifest JSON file. Nothing is recorded if empty.
+        keys (list): object keys.
+    '''
+
+    if not manifest_path or not keys:
+        return
+
+    uploaded_at = datetime.now().isoformat(timespec='seconds')
+    with _manifest_lock:
+        manifest = _load_manifest(manifest_path)
+        for key in keys:
+            manifest['objects'][key] = {'uploaded_at': uploaded_at}
+        _save_manifest(manifest_path, manifest)
+
+    logger.info(f'Manifest: recorded {len(keys)} object(s) to load.')
+
+def amplitude_manifest_pending(manifest_path: str):
+    '''
+    Returns the keys uploaded but not loaded yet, including keys left by an earlier run whose load failed.
+
+    Args:
+        manifest_path (str): path of the manifest JSON file.
+
+    Returns:
+        list: object keys in name order.
+    '''
+
+    with _manifest_lock:
+        return sorted(_load_manifest(manifest_path)['objects'])
+
+def amplitude_manifest_mark_loaded(manifest_path: str, keys: list):
+    '''
+    Removes loaded objects from the manifest.
+
+    Args:
+        manifest_path (str): path of the manifest JSON file.
+        keys (list): object keys loaded into the warehouse.
+    '''
+
+    if not manifest_path or not keys:
+        return
+
+    with _manifest_lock:
+        manifest = _load_manifest(manifest_path)
+        for key in keys:
+            manifest['objects'].pop(key, None)
+        _save_manifest(manifest_path, manifest)
+
+    logger.info(f'Manifest: {len(keys)} object(s) loaded.')
@@ -0,0 +1,217 @@
+# Import libraries
+from contextlib import contextmanager
+from datetime import datetime
+import os
+import contextvars
+import sys
+import json
+import time
+import resource
+import threading
+import logging
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Counters tracked for every stage
+COUNTERS = ['bytes_in', 'bytes_out', 'files', 'retries', 'errors', 'duplicates', 'filtered', 'quarantined', 'rows', 'cached']
+
+# How often the resident set size is sampled while a stage runs, in seconds
+RSS_SAMPLE_INTERVAL = 0.2
+
+# (scope, stage name) -> metrics dictionary for the current run
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+# Project the current thread or task is working for, set with metrics_scope. Empty outside any project
+_scope = contextvars.ContextVar('amplitude_metrics_scope', default='')
+
+def _current_rss_bytes():
+    # /proc gives the live RSS on Linux; elsewhere fall back to the process high-water mark
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return _max_rss_bytes()
+
+def _max_rss_bytes():
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def _max_child_rss_bytes():
+    # High-water mark of the largest finished child process, e.g. extract and transform pool workers
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def _stage(stage: str):
+    # Metrics dictionary for a stage in the current scope, created on first use. Caller holds _metrics_lock
+    key = (_scope.get(), stage)
+    if key not in _metrics:
+        _metrics[key] = {'wall_seconds': 0.0, 'peak_rss_bytes': 0, 'peak_child_rss_bytes': 0, 'runs': 0}
+        _metrics[key].update({counter: 0 for counter in COUNTERS})
+    return _metrics[key]
+
+@contextmanager
+def metrics_scope(scope: str):
+    '''
+    Records the metrics of the code inside the with block under scope, e.g. a project name, so projects running side by side in one process never add to each other's wall time or counters.
+    The scope follows the context into asyncio tasks. Work handed to a thread pool keeps it when submitted through copy_context().run, as BoundedExecutor does.
+
+    Args:
+        scope (str): scope name. Empty records outside any scope.
+    '''
+
+    token = _scope.set(scope or '')
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+def metrics_increment(stage: str, counter: str, value: int = 1):
+    '''
+    Adds value to one of the stage counters (bytes_in, bytes_out, files, retries, errors, ...). Safe to call from worker threads.
+
+    Args:
+        stage (str): stage name, e.g. 'amplitude_api_call'.
+        counter (str): counter name.
+        value (int): amount to add.
+    '''
+
+    with _metrics_lock:
+        metrics = _stage(stage)
+        metrics[counter] = metrics.get(counter, 0) + value
+
+@contextmanager
+def stage_timer(stage: str):
+    '''
+    Measures the wall time and peak resident memory of the code inside the with block and adds them to the stage metrics. Peak RSS of this process is sampled on a background thread while the block runs; worker processes are covered by the child high-water mark read when the block ends.
+
+    Args:
+        stage (str): stage name, e.g. 'amplitude_zip_file_extract'.
+    '''
+
+    peak_rss = [_current_rss_bytes()]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(RSS_SAMPLE_INTERVAL):
+            peak_rss[0] = max(peak_rss[0], _current_rss_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        wall_seconds = time.perf_counter() - start
+        stop.set()
+        sampler.join()
+        peak_rss[0] = max(peak_rss[0], _current_rss_bytes())
+
+        with _metrics_lock:
+            metrics = _stage(stage)
+            metrics['wall_seconds'] += wall_seconds
+            metrics['peak_rss_bytes'] = max(metrics['peak_rss_bytes'], peak_rss[0])
+            metrics['peak_child_rss_bytes'] = max(metrics['peak_child_rss_bytes'], _max_child_rss_bytes())
+            metrics['runs'] += 1
+
+        logger.info(f'Stage {stage} took {wall_seconds:.2f}s, peak RSS {peak_rss[0] / 1024 / 1024:.1f}MB.')
+
+def metrics_snapshot(scope: str = None):
+    '''
+    Returns a copy of the metrics collected so far in one scope, with derived throughput figures.
+
+    Args:
+        scope (str): scope to read. Defaults to the current scope.
+
+    Returns:
+        dict: stage name -> metrics.
+    '''
+
+    scope = _scope.get() if scope is None else scope
+    with _metrics_lock:
+        snapshot = {stage: dict(metrics) for (stage_scope, stage), metrics in _metrics.items() if stage_scope == scope}
+
+    # Stages that counted work but were never timed report no rate rather than a meaningless one
+    for metrics in snapshot.values():
+        wall_seconds = metrics['wall_seconds']
+        metrics['files_per_second'] = metrics['files'] / wall_seconds if wall_seconds else 0.0
+        metrics['bytes_in_per_second'] = metrics['bytes_in'] / wall_seconds if wall_seconds else 0.0
+        metrics['bytes_out_per_second'] = metrics['bytes_out'] / wall_seconds if wall_seconds else 0.0
+        metrics['rows_per_second'] = metrics['rows'] / wall_seconds if wall_seconds else 0.0
+
+    return snapshot
+
+def metrics_scopes():
+    '''
+    Lists the scopes that recorded metrics in the current run, e.g. the projects of a round.
+
+    Returns:
+        list: scope names, sorted. The empty scope is included if anything was recorded outside a scope.
+    '''
+
+    with _metrics_lock:
+        return sorted({scope for scope, _ in _metrics})
+
+def metrics_reset():
+    '''
+    Clears all collected metrics, e.g. between runs of a long-lived process.
+    '''
+
+    with _metrics_lock:
+        _metrics.clear()
+
+def amplitude_metrics_report(json_path: str, prometheus_path: str = None, run_info: dict = None):
+    '''
+    Writes the run metrics as a JSON report and, optionally, as a Prometheus textfile-collector file. Both files are written to a temporary path and renamed so scrapers never read half a file.
+
+    Args:
+        json_path (str): path of the JSON run report.
+        prometheus_path (str): optional path of the Prometheus .prom file.
+        run_info (dict): optional run details (e.g. date range) added to the JSON report.
+
+    Returns:
+        dict: the report that was written. Stages recorded outside any scope are under 'stages', those of each project under 'projects'.
+    '''
+
+    stages = metrics_snapshot('')
+    projects = {scope: metrics_snapshot(scope) for scope in metrics_scopes() if scope}
+    report = {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'run': run_info or {},
+        'stages': stages,
+    }
+    if projects:
+        report['projects'] = projects
+
+    # JSON report
+    os.makedirs(os.path.dirname(json_path) or '.', exist_ok=True)
+    with open(f'{json_path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    os.replace(f'{json_path}.tmp', json_path)
+    print(f'Run report written to {json_path}.')
+    logger.info(f'Run report written to {json_path}.')
+
+    # Prometheus textfile: one gauge per metric, labelled by stage, and by project for scoped stages
+    if prometheus_path:
+        metric_names = ['wall_seconds', 'peak_rss_bytes', 'peak_child_rss_bytes', 'files_per_second', 'bytes_in_per_second', 'bytes_out_per_second', 'rows_per_second'] + COUNTERS
+        labelled_stages = [(f'stage="{stage}"', metrics) for stage, metrics in sorted(stages.items())]
+        labelled_stages += [(f'project="{project}",stage="{stage}"', metrics) for project, project_stages in sorted(projects.items()) for stage, metrics in sorted(project_stages.items())]
+        lines = []
+        for name in metric_names:
+            lines.append(f'# TYPE amplitude_pipeline_{name} gauge')
+            for labels, metrics in labelled_stages:
+                lines.append(f'amplitude_pipeline_{name}{{{labels}}} {metrics.get(name, 0)}')
+        lines.append('# TYPE amplitude_pipeline_last_run_timestamp_seconds gauge')
+        lines.append(f'amplitude_pipeline_last_run_timestamp_seconds {time.time():.0f}')
+
+        os.makedirs(os.path.dirname(prometheus_path) or '.', exist_ok=True)
+        with open(f'{prometheus_path}.tmp', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f'{prometheus_path}.tmp', prometheus_path)
+        print(f'Prometheus metrics written to {prometheus_path}.')
+        logger.info(f'Prometheus metrics written to {prometheus_path}.')
+
+    return report
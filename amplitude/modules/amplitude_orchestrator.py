@@ -0,0 +1,351 @@
+# Import libraries
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import os
+import time
+import zipfile
+import asyncio
+import contextvars
+import logging
+
+# Import modules
+from modules.amplitude_api_call import amplitude_api_call, AmplitudeExportError
+from modules.amplitude_sharded_download import amplitude_shard_plan, amplitude_bisect_shard, SPLIT_STATUS_CODES
+from modules.amplitude_zip_file_extract import zip_day_members, _extract_gz_member
+from modules.amplitude_transform import _transform_file, OUTPUT_EXTENSIONS
+from modules.amplitude_s3_load import amplitude_s3_client, amplitude_transfer_config, _upload_and_delete
+from modules.amplitude_watermark import amplitude_hours_between, amplitude_watermark_mark_hours, amplitude_watermark_mark_files, amplitude_watermark_mark_archive, amplitude_settled_hours, AVAILABILITY_LAG_HOURS
+from modules.amplitude_checkpoint import amplitude_checkpoint_record_members, amplitude_checkpoint_extracted_members, amplitude_checkpoint_forget_archive
+from modules.amplitude_metrics import metrics_increment, stage_timer
+from modules.amplitude_retry import RetryPolicy, amplitude_session
+from modules.amplitude_s3_layout import amplitude_key_template, amplitude_object_key
+from modules.amplitude_event_filter import EventFilter
+from modules.amplitude_manifest import amplitude_manifest_add
+from modules.amplitude_cache import amplitude_cache_record_objects
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Number of archives whose members are being extracted at the same time. Two lets the next archive start while the last members of the previous one finish
+ARCHIVES_IN_FLIGHT = 2
+
+async def _timed_stage(stage: str, awaitable):
+    # Runs one stage of the pipeline inside its stage timer
+    with stage_timer(stage):
+        return await awaitable
+
+async def _download_stage(loop, thread_pool, archive_queue: asyncio.Queue, shards: list, url: str, AMP_API_KEY: str, AMP_SECRET_KEY: str, max_attempts: int, download_workers: int, download_dir: str, state_path: str, checkpoint_path: str, summary: dict, session=None, retry_policy: RetryPolicy = None, cache_dir: str = None, availability_lag_hours: int = AVAILABILITY_LAG_HOURS):
+    '''
+    Downloads shards concurrently and puts each finished archive on archive_queue as soon as it is on disk. Shards that return 400 or 504 are bisected and re-queued, as in amplitude_sharded_download.
+    A download slot is held until its archive has been queued, so at most download_workers + queue_size archives wait on disk.
+    '''
+
+    download_slots = asyncio.Semaphore(download_workers)
+
+    async def download(shard_start: str, shard_end: str):
+        async with download_slots:
+            try:
+                # Run in a copy of the task's context, so metrics recorded by the download stay in the project's scope
+                downloaded = await loop.run_in_executor(thread_pool, partial(contextvars.copy_context().run, amplitude_api_call, url, shard_start, shard_end, AMP_API_KEY, AMP_SECRET_KEY, max_attempts, raise_on_status=True, checkpoint_path=checkpoint_path, session=session, retry_policy=retry_policy, download_dir=download_dir, cache_dir=cache_dir, availability_lag_hours=availability_lag_hours))
+
+            except AmplitudeExportError as e:
+                # No data for this shard is not a failure. Hours newer than the availability lag stay pending, as their events may still arrive
+                if e.status_code == 404:
+                    amplitude_watermark_mark_hours(state_path, amplitude_settled_hours(amplitude_hours_between(shard_start, shard_end), availability_lag_hours), 'empty')
+                    return
+
+                # Split oversize/timed out shards in half and queue both halves
+                halves = amplitude_bisect_shard(shard_start, shard_end) if e.status_code in SPLIT_STATUS_CODES else []
+                if halves:
+                    print(f'Shard {shard_start}-{shard_end} returned {e.status_code}. Splitting into {halves[0][0]}-{halves[0][1]} and {halves[1][0]}-{halves[1][1]}.')
+                    logger.warning(f'Shard {shard_start}-{shard_end} returned {e.status_code}. Splitting into {halves[0][0]}-{halves[0][1]} and {halves[1][0]}-{halves[1][1]}.')
+                    for half_start, half_end in halves:
+                        task_group.create_task(download(half_start, half_end))
+                else:
+                    print(f'Shard {shard_start}-{shard_end} returned {e.status_code} and cannot be split further.')
+                    logger.error(f'Shard {shard_start}-{shard_end} returned {e.status_code} and cannot be split further.')
+                    summary['failed_shards'] += 1
+                return
+
+            except Exception as e:
+                print(f'Shard {shard_start}-{shard_end} download failed: {e}')
+                logger.error(f'Shard {shard_start}-{shard_end} download failed: {e}')
+                summary['failed_shards'] += 1
+                return
+
+            if not downloaded:
+                summary['failed_shards'] += 1
+                return
+
+            # Hand the archive to the extract stage. Waits here while the queue is full
+            summary['downloaded_shards'] += 1
+            amplitude_watermark_mark_hours(state_path, amplitude_hours_between(shard_start, shard_end), 'downloaded')
+            await archive_queue.put(os.path.join(download_dir, f'amplitude_{shard_start}_{shard_end}.zip'))
+
+    async with asyncio.TaskGroup() as task_group:
+        for shard_start, shard_end in shards:
+            task_group.create_task(download(shard_start, shard_end))
+
+async def _extract_stage(loop, process_pool, archive_queue: asyncio.Queue, upload_queue: asyncio.Queue, extract_workers: int, extract_folder: str, state_path: str, checkpoint_path: str, summary: dict, dedup_dir: str = None, event_filter: EventFilter = None):
+    '''
+    Takes archives off archive_queue and decompresses their members on process_pool, putting each JSON file on upload_queue as soon as it is written.
+    An extract slot is held until the file has been queued, so at most extract_workers + queue_size decompressed files wait on disk. Archives are deleted once every member is extracted.
+    '''
+
+    member_slots = asyncio.Semaphore(extract_workers)
+    archive_slots = asyncio.Semaphore(ARCHIVES_IN_FLIGHT)
+    os.makedirs(extract_folder, exist_ok=True)
+
+    async def extract_member(full_zip_path: str, member_name: str):
+        zip_filename = os.path.basename(full_zip_path)
+        async with member_slots:
+            try:
+                outcome = await loop.run_in_executor(process_pool, _extract_gz_member, full_zip_path, member_name, extract_folder, dedup_dir, event_filter)
+            except Exception as e:
+                metrics_increment('amplitude_zip_file_extract', 'errors')
+                print(f"Error extracting {member_name}: {e}")
+                logger.error(f"Error extracting {member_name}: {e}")
+                return False
+
+            amplitude_checkpoint_record_members(checkpoint_path, zip_filename, [(member_name, outcome['json_name'], outcome['bytes_out'])])
+            metrics_increment('amplitude_zip_file_extract', 'bytes_in', outcome['bytes_in'])
+            metrics_increment('amplitude_zip_file_extract', 'bytes_out', outcome['bytes_out'])
+            for counter in ('duplicates', 'filtered', 'quarantined'):
+                metrics_increment('amplitude_zip_file_extract', counter, outcome[counter])
+
+            # No event of the member was left to load, so there is nothing to upload and its part of the hour is done
+            if outcome['json_name'] is None:
+                amplitude_watermark_mark_files(state_path, [member_name], 'empty')
+                print(f"Skipped {member_name}: no events left ({outcome['duplicates']} already emitted, {outcome['filtered']} filtered, {outcome['quarantined']} quarantined).")
+                logger.info(f"Skipped {member_name}: no events left ({outcome['duplicates']} already emitted, {outcome['filtered']} filtered, {outcome['quarantined']} quarantined).")
+                return True
+
+            amplitude_watermark_mark_files(state_path, [outcome['json_name']], 'extracted')
+            metrics_increment('amplitude_zip_file_extract', 'files')
+            summary['extracted_files'] += 1
+
+            # Hand the file to the upload stage. Waits here while the queue is full
+            await upload_queue.put(outcome['json_name'])
+            return True
+
+    async def extract_archive(full_zip_path: str):
+        zip_filename = os.path.basename(full_zip_path)
+        try:
+            with zipfile.ZipFile(full_zip_path, 'r') as zip_ref:
+                gz_members = zip_day_members(zip_ref)
+
+            if gz_members is None:
+                print(f"Skipping {zip_filename} extract process: No internal folder found.")
+                logger.warning(f"Skipping {zip_filename} extract process: No internal folder found.")
+                return
+
+            # Members finished by an earlier run are already in extract_folder and were queued for upload at start-up
+            done_members = amplitude_checkpoint_extracted_members(checkpoint_path, zip_filename, extract_folder)
+
+            results = await asyncio.gather(*(extract_member(full_zip_path, member_name) for member_name in gz_members if member_name not in done_members))
+            amplitude_watermark_mark_archive(state_path, zip_filename, gz_members)
+
+            # Cleanup .zip file only if every member was extracted successfully
+            if all(results):
+                os.remove(full_zip_path)
+                amplitude_checkpoint_forget_archive(checkpoint_path, zip_filename)
+                print(f"Cleanup: deleted files {zip_filename}")
+                logger.info(f"Cleanup: deleted files {zip_filename}")
+            else:
+                summary['failed_members'] += results.count(False)
+                print(f"Keeping {zip_filename}: {results.count(False)} member(s) failed to extract.")
+                logger.warning(f"Keeping {zip_filename}: {results.count(False)} member(s) failed to extract.")
+
+        except Exception as e:
+            summary['failed_members'] += 1
+            print(f"Error processing {zip_filename}: {e}")
+            logger.error(f"Error processing {zip_filename}: {e}")
+
+        finally:
+            archive_slots.release()
+
+    # None on the queue means the download stage has finished
+    async with asyncio.TaskGroup() as task_group:
+        while (full_zip_path := await archive_queue.get()) is not None:
+            await archive_slots.acquire()
+            task_group.create_task(extract_archive(full_zip_path))
+
+async def _upload_worker(loop, thread_pool, process_pool, upload_queue: asyncio.Queue, s3_client, transfer_config, AWS_BUCKET_NAME: str, extract_folder: str, transform_format: str, state_path: str, checkpoint_path: str, summary: dict, key_template: str = '', manifest_path: str = None, cache_dir: str = None):
+    '''
+    Takes JSON files off upload_queue, optionally re-encodes them, and uploads them to S3, deleting the local copy on success. Stops at the first None.
+    '''
+
+    while (filename := await upload_queue.get()) is not None:
+        full_path = os.path.join(extract_folder, filename)
+
+        try:
+            # Re-encode before upload. A file that fails to transform is still uploaded as raw JSON
+            if transform_format and filename.endswith('.json'):
+                try:
+                    outcome = await loop.run_in_executor(process_pool, _transform_file, full_path, transform_format, 10000, None)
+                    filename = outcome['filename']
+                    full_path = os.path.join(extract_folder, filename)
+                    metrics_increment('amplitude_transform', 'bytes_in', outcome['bytes_in'])
+                    metrics_increment('amplitude_transform', 'bytes_out', outcome['bytes_out'])
+                    metrics_increment('amplitude_transform', 'files')
+                except Exception as e:
+                    metrics_increment('amplitude_transform', 'errors')
+                    print(f"Failed to transform {filename}: {e}")
+                    logger.error(f"Failed to transform {filename}: {e}")
+
+            key = amplitude_object_key(filename, key_template, full_path)
+            # Run in a copy of the task's context, so metrics recorded by the upload stay in the project's scope
+            file_size, etag, skipped = await loop.run_in_executor(thread_pool, partial(contextvars.copy_context().run, _upload_and_delete, s3_client, full_path, AWS_BUCKET_NAME, key, transfer_config, checkpoint_path is not None, cache_dir))
+
+            # Record the object straight away, so an interrupted run still knows what reached S3
+            amplitude_watermark_mark_files(state_path, [filename], 'uploaded')
+            amplitude_cache_record_objects(cache_dir, AWS_BUCKET_NAME, [(key, etag, file_size)])
+            amplitude_manifest_add(manifest_path, [key])
+            if skipped:
+                metrics_increment('amplitude_s3_load', 'cached')
+            else:
+                metrics_increment('amplitude_s3_load', 'bytes_in', file_size)
+                metrics_increment('amplitude_s3_load', 'bytes_out', file_size)
+                metrics_increment('amplitude_s3_load', 'files')
+            summary['uploaded_files'] += 1
+            print(f"Uploaded {key} and deleted local copy: {filename}")
+            logger.info(f"Uploaded {key} and deleted local copy: {filename}")
+
+        except Exception as e:
+            # If upload fails the file is NOT deleted, so the next run picks it up from extract_folder
+            metrics_increment('amplitude_s3_load', 'errors')
+            summary['failed_uploads'] += 1
+            print(f"Failed to upload {filename}: {e}")
+            logger.error(f"Failed to upload {filename}: {e}")
+
+async def amplitude_pipeline_async(url: str, start_time: str, end_time: str, AMP_API_KEY: str, AMP_SECRET_KEY: str, AWS_ACCESS_KEY: str, AWS_SECRET_KEY: str, AWS_BUCKET_NAME: str, max_attempts: int = 3, ranges: list = None, shard_hours: int = 6, download_workers: int = 4, extract_workers: int = 1, upload_workers: int = 8, queue_size: int = 8, transform_format: str = '', multipart_threshold_mb: int = 8, multipart_chunksize_mb: int = 8, multipart_concurrency: int = 4, max_pool_connections: int = None, endpoint_url: str = None, extract_folder: str = 'extracted_data', state_path: str = None, checkpoint_path: str = None, retry_policy: RetryPolicy = None, session = None, dedup_dir: str = None, key_template: str = '', event_filter: EventFilter = None, manifest_path: str = None, s3_client = None, download_dir: str = 'downloaded_data', process_pool = None, cache_dir: str = None, availability_lag_hours: int = AVAILABILITY_LAG_HOURS, download_pool = None, upload_pool = None):
+    '''
+    Runs download, extract and upload as concurrent stages connected by bounded queues. Each finished shard moves straight on to extraction, and each extracted member straight on to upload, so end-to-end time approaches that of the slowest stage rather than the sum of all three.
+    Queues hold at most queue_size items, so a slow stage makes the one before it wait instead of filling memory or disk.
+
+    Args:
+        url (str): Amplitude API URL.
+        start_time (str): earliest hour in the download date range.
+        end_time (str): latest hour in the download date range.
+        AMP_API_KEY (str): Amplitude API key from .env file.
+        AMP_SECRET_KEY (str): Amplitude secret key from .env file.
+        AWS_ACCESS_KEY (str): AWS access key from .env file
+        AWS_SECRET_KEY (str): AWS secret key from .env file
+        AWS_BUCKET_NAME (str): AWS bucket name from .env file
+        max_attempts (int): Maximum number of times each shard request will retry in case of timeout.
+        ranges (list): Optional (start, end) hour ranges to download instead of the whole window, e.g. from amplitude_pending_ranges.
+        shard_hours (int): Number of hours in each initial shard.
+        download_workers (int): Shards downloaded at the same time.
+        extract_workers (int): Processes used to decompress members (and to transform files).
+        upload_workers (int): Files uploaded at the same time.
+        queue_size (int): Capacity of the archive queue and of the upload queue.
+        transform_format (str): Optional re-encoding before upload: 'gzip', 'zstd' or 'parquet'. Empty uploads raw JSON.
+        multipart_threshold_mb (int): Files at or above this size in MB are uploaded as multipart uploads.
+        multipart_chunksize_mb (int): Size in MB of each multipart part.
+        multipart_concurrency (int): Number of threads used for the parts of a single file.
+        max_pool_connections (int): Connection pool size of the S3 client. Defaults to upload_workers * multipart_concurrency.
+        endpoint_url (str): Optional S3-compatible endpoint, e.g. a local moto server. Defaults to AWS.
+        extract_folder (str): Folder members are decompressed to.
+        download_dir (str): Folder archives are downloaded to.
+        state_path (str): Optional watermark file.
+        checkpoint_path (str): Optional checkpoint file.
+        retry_policy (RetryPolicy): Optional backoff policy used for every shard. Defaults to RetryPolicy(max_attempts).
+        session (requests.Session): Optional pooled session for the export API. By default one sized for download_workers is created and closed afterwards.
+        dedup_dir (str): Optional dedup index folder. Events already emitted by an earlier run are dropped during extraction.
+        key_template (str): Optional key template ('hive' or a format string, see amplitude_s3_layout). Empty uploads to the bucket root under the filename. Files are uploaded as they arrive, so they are not compacted.
+        event_filter (EventFilter): Optional validation and filtering of events during extraction, see amplitude_event_filter.
+        manifest_path (str): Optional manifest file. Uploaded keys are recorded in it for the Snowflake load stage.
+        s3_client (botocore.client.S3): Optional shared client, e.g. one kept warm by the daemon. One is created from the keys and pool settings otherwise.
+        process_pool (concurrent.futures.Executor): Optional pool shared with other pipelines, e.g. one per process for all projects. Left running when the pipeline ends; extract_workers still bounds how many members this pipeline decompresses at a time.
+        cache_dir (str): Optional cache (see amplitude_cache). Cached windows are not downloaded again, and files whose identical object it records are not uploaded again.
+        availability_lag_hours (int): Hours of a 404 shard newer than this lag are not marked 'empty', and windows reaching into them bypass the cache, as their events may still arrive.
+        download_pool (concurrent.futures.Executor): Optional thread pool shared with other pipelines for downloads. download_workers still bounds how many shards this pipeline downloads at a time.
+        upload_pool (concurrent.futures.Executor): Optional thread pool shared with other pipelines for uploads. upload_workers still bounds how many files this pipeline uploads at a time.
+
+    Returns:
+        bool: True if every shard, member and upload succeeded.
+              False if ANY of them failed.
+    '''
+
+    # Validate requested format
+    if transform_format and transform_format not in OUTPUT_EXTENSIONS:
+        raise ValueError(f"Unsupported transform_format '{transform_format}'. Choose from {', '.join(OUTPUT_EXTENSIONS)}.")
+
+    key_template = amplitude_key_template(key_template)
+
+    # Plan the initial shards, across every requested range
+    if ranges is None:
+        ranges = [(start_time, end_time)]
+    shards = [shard for range_start, range_end in ranges for shard in amplitude_shard_plan(range_start, range_end, shard_hours)]
+    print(f'Async pipeline: {len(shards)} shard(s) to download, queues of {queue_size}.')
+    logger.info(f'Async pipeline: {len(shards)} shard(s) to download, queues of {queue_size}.')
+
+    # S3 client and transfer settings shared by every upload
+    if max_pool_connections is None:
+        max_pool_connections = upload_workers * multipart_concurrency
+    if s3_client is None:
+        s3_client = amplitude_s3_client(AWS_ACCESS_KEY, AWS_SECRET_KEY, max_pool_connections, endpoint_url)
+    transfer_config = amplitude_transfer_config(multipart_threshold_mb, multipart_chunksize_mb, multipart_concurrency)
+
+    summary = {'downloaded_shards': 0, 'failed_shards': 0, 'extracted_files': 0, 'failed_members': 0, 'uploaded_files': 0, 'failed_uploads': 0}
+    archive_queue = asyncio.Queue(maxsize=queue_size)
+    upload_queue = asyncio.Queue(maxsize=queue_size)
+    loop = asyncio.get_running_loop()
+    pipeline_start = time.perf_counter()
+
+    # One connection pool for every shard download
+    own_session = session is None
+    if own_session:
+        session = amplitude_session(pool_maxsize=download_workers)
+
+    # Blocking downloads and uploads run on threads, on the shared pools if given; decompression runs on processes when more than one worker is requested, or on the shared pool if one is given
+    if process_pool is not None:
+        process_pool_context = nullcontext(process_pool)
+    else:
+        process_pool_context = ProcessPoolExecutor(max_workers=extract_workers) if extract_workers > 1 else ThreadPoolExecutor(max_workers=1)
+    thread_pool_context = nullcontext() if download_pool is not None and upload_pool is not None else ThreadPoolExecutor(max_workers=download_workers + upload_workers)
+    with thread_pool_context as thread_pool, process_pool_context as process_pool:
+        download_pool = download_pool or thread_pool
+        upload_pool = upload_pool or thread_pool
+
+        # Uploaders start first so they are ready for the first extracted file. Each stage is timed from start-up until its input is exhausted, so the stage windows overlap
+        uploaders = asyncio.create_task(_timed_stage('amplitude_s3_load', asyncio.gather(*(
+            _upload_worker(loop, upload_pool, process_pool, upload_queue, s3_client, transfer_config, AWS_BUCKET_NAME, extract_folder, transform_format, state_path, checkpoint_path, summary, key_template, manifest_path, cache_dir)
+            for _ in range(upload_workers)
+        ))))
+        extractor = asyncio.create_task(_timed_stage('amplitude_zip_file_extract', _extract_stage(loop, process_pool, archive_queue, upload_queue, extract_workers, extract_folder, state_path, checkpoint_path, summary, dedup_dir, event_filter)))
+
+        # Work left on disk by an earlier run is queued ahead of new downloads
+        if os.path.exists(extract_folder):
+            for filename in os.listdir(extract_folder):
+                if not filename.endswith('.part'):
+                    await upload_queue.put(filename)
+        if os.path.exists(download_dir):
+            for zip_filename in [f for f in os.listdir(download_dir) if f.endswith('.zip')]:
+                await archive_queue.put(os.path.join(download_dir, zip_filename))
+
+        # Download, then tell each downstream stage that no more work is coming
+        await _timed_stage('amplitude_api_call', _download_stage(loop, download_pool, archive_queue, shards, url, AMP_API_KEY, AMP_SECRET_KEY, max_attempts, download_workers, download_dir, state_path, checkpoint_path, summary, session, retry_policy, cache_dir, availability_lag_hours))
+        await archive_queue.put(None)
+        await extractor
+        for _ in range(upload_workers):
+            await upload_queue.put(None)
+        await uploaders
+
+    if own_session:
+        session.close()
+
+    # Log summary of stage outcomes
+    pipeline_seconds = time.perf_counter() - pipeline_start
+    print(f"Async pipeline finished in {pipeline_seconds:.2f}s: {summary['downloaded_shards']} shard(s) downloaded, {summary['extracted_files']} file(s) extracted, {summary['uploaded_files']} file(s) uploaded. Failures: {summary['failed_shards']} shard(s), {summary['failed_members']} member(s), {summary['failed_uploads']} upload(s).")
+    logger.info(f"Async pipeline finished in {pipeline_seconds:.2f}s: {summary['downloaded_shards']} shard(s) downloaded, {summary['extracted_files']} file(s) extracted, {summary['uploaded_files']} file(s) uploaded. Failures: {summary['failed_shards']} shard(s), {summary['failed_members']} member(s), {summary['failed_uploads']} upload(s).")
+
+    return summary['failed_shards'] == 0 and summary['failed_members'] == 0 and summary['failed_uploads'] == 0
+
+def amplitude_pipeline(*args, **kwargs):
+    '''
+    Synchronous entry point for amplitude_pipeline_async. Takes the same arguments and returns the same bool.
+    '''
+
+    return asyncio.run(amplitude_pipeline_async(*args, **kwargs))
@@ -0,0 +1,40 @@
+# Import libraries
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import threading
+import logging
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+class BoundedExecutor:
+    '''
+    Submits tasks to an executor with at most max_workers of them in flight, so a pipeline keeps its own concurrency limit on a thread pool shared with other projects. Without a shared pool, a private one of max_workers threads is created.
+    submit blocks until one of the caller's earlier tasks has finished when the limit is reached. Tasks run in a copy of the caller's context, so they record metrics under the caller's project scope. Used as a context manager: a private pool is shut down on exit, a shared one is left running.
+
+    Args:
+        executor (concurrent.futures.Executor): Optional pool shared with other pipelines.
+        max_workers (int): tasks of this caller running or queued at the same time.
+    '''
+
+    def __init__(self, executor = None, max_workers: int = 4):
+        self.own_executor = executor is None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) if executor is None else executor
+        self.slots = threading.BoundedSemaphore(max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.own_executor:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,115 @@
+# Import libraries
+import os
+import json
+import logging
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Settings every project entry must give itself, so one project never falls back to another's credentials or bucket
+REQUIRED_PROJECT_SETTINGS = ('AMP_API_KEY', 'AMP_SECRET_KEY', 'AWS_BUCKET_NAME')
+
+# Root of the per-project working directories
+PROJECTS_DIR = 'projects'
+
+def _resolve(name: str, value):
+    # '$VAR' values are read from the environment, so secrets can stay in .env instead of the projects file
+    if isinstance(value, str) and value.startswith('$'):
+        resolved = os.getenv(value[1:])
+        if resolved is None:
+            raise ValueError(f"Setting {name} refers to {value}, which is not set in the environment.")
+        return resolved
+    return value
+
+def amplitude_projects_load(projects_path: str):
+    '''
+    Reads the projects file listing the Amplitude projects ingested by one process and where each is loaded to.
+    The file holds {"projects": [{"name": "web", "AMP_API_KEY": "$AMP_API_KEY_WEB", "AMP_SECRET_KEY": "$AMP_SECRET_KEY_WEB", "AWS_BUCKET_NAME": "amplitude-web", ...}, ...]}. Any .env setting can be given per project; settings left out fall back to .env.
+
+    Args:
+        projects_path (str): path of the projects JSON file. Empty means a single project configured by .env.
+
+    Returns:
+        list: project dicts with '$VAR' values resolved, or an empty list if no file is configured.
+    '''
+
+    if not projects_path:
+        return []
+
+    with open(projects_path, 'r', encoding='utf-8') as f:
+        entries = json.load(f).get('projects', [])
+
+    projects = []
+    names = set()
+    for entry in entries:
+        name = entry.get('name')
+        # Names become folder names, so they must be unique and path-safe
+        if not name or name in names or os.path.basename(name) != name or name in ('.', '..'):
+            raise ValueError(f"Project name '{name}' in {projects_path} is missing, repeated or not a plain folder name.")
+        missing = [setting for setting in REQUIRED_PROJECT_SETTINGS if not entry.get(setting)]
+        if missing:
+            raise ValueError(f"Project '{name}' in {projects_path} is missing {', '.join(missing)}.")
+
+        names.add(name)
+        projects.append({setting: _resolve(setting, value) for setting, value in entry.items()})
+
+    print(f"Loaded {len(projects)} project(s) from {projects_path}: {', '.join(sorted(names))}.")
+    logger.info(f"Loaded {len(projects)} project(s) from {projects_path}: {', '.join(sorted(names))}.")
+    return projects
+
+def amplitude_project_setting(project: dict, name: str, default: str = None):
+    '''
+    Returns a setting of a project, falling back to the environment (.env) and then to default.
+
+    Args:
+        project (dict): project entry from amplitude_projects_load, or None for the single .env project.
+        name (str): setting name, e.g. 'AMP_SHARD_HOURS'.
+        default (str): value used when neither sets it.
+
+    Returns:
+        str: the value, as a string like os.getenv returns.
+    '''
+
+    if project and name in project:
+        return str(project[name])
+    return os.getenv(name, default)
+
+def amplitude_project_work_dir(project: dict):
+    '''
+    Returns the working directory holding a project's downloads, extracted files and state, so projects run side by side never touch each other's files.
+
+    Args:
+        project (dict): project entry, or None for the single .env project.
+
+    Returns:
+        str: AMP_WORK_DIR of the project, else 'projects/<name>'. Empty (the current directory) for the single .env project.
+    '''
+
+    if not project:
+        return ''
+    return str(project.get('AMP_WORK_DIR', os.path.join(PROJECTS_DIR, project['name'])))
+
+def amplitude_project_path(project: dict, name: str, default: str = None):
+    '''
+    Returns a path setting of a project resolved inside its working directory, so no two projects share a state file, checkpoint, dedup index, cache or manifest.
+
+    Args:
+        project (dict): project entry, or None for the single .env project.
+        name (str): setting name, e.g. 'AMP_STATE_FILE'.
+        default (str): relative path used when the setting is not given.
+
+    Returns:
+        str: the path under the project's working directory, or an empty string if the setting is empty.
+
+    Raises:
+        ValueError: if a project sets an absolute path, or one that leads out of its working directory. The single .env project may use any path.
+    '''
+
+    value = amplitude_project_setting(project, name, default)
+    if not value:
+        return ''
+
+    work_dir = amplitude_project_work_dir(project)
+    if work_dir and (os.path.isabs(value) or os.path.normpath(value).split(os.sep)[0] == '..'):
+        raise ValueError(f"Setting {name}='{value}' of project '{project['name']}' must be a relative path inside its working directory {work_dir}.")
+    return os.path.join(work_dir, value)
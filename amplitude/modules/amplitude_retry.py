@@ -0,0 +1,150 @@
+# Import libraries
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+import random
+import requests
+import threading
+import time
+import logging
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying: rate limiting and transient server errors. 400, 404 and 504 are handled by amplitude_api_call itself
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503)
+
+class RetryPolicy:
+    '''
+    Decides whether a failed export request is retried and how long to wait first. Delays grow exponentially from base_delay and are capped at max_delay, with "full jitter" (a random delay between 0 and the cap) so concurrent shards do not retry in lockstep.
+    A Retry-After header on 429/503 responses takes precedence over the computed delay.
+
+    Args:
+        max_attempts (int): Total number of attempts, including the first.
+        base_delay (float): Delay cap in seconds after the first failure.
+        max_delay (float): Upper bound in seconds for any single delay, including Retry-After.
+        multiplier (float): Growth factor of the delay cap per attempt.
+        jitter (bool): If False, the full capped delay is used instead of a random one.
+        retry_status_codes (tuple): Status codes that are retried.
+    '''
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0, multiplier: float = 2.0, jitter: bool = True, retry_status_codes: tuple = RETRY_STATUS_CODES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.retry_status_codes = retry_status_codes
+
+    def should_retry(self, status_code: int):
+        '''
+        Returns True if a response with status_code is worth retrying.
+        '''
+
+        return status_code in self.retry_status_codes
+
+    def retry_after(self, response):
+        '''
+        Reads the Retry-After header of a response, given either in seconds or as an HTTP date.
+
+        Returns:
+            float: seconds to wait, or None if the header is missing or unreadable.
+        '''
+
+        if response is None:
+            return None
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt: int, response=None):
+        '''
+        Returns how long to wait before the next attempt.
+
+        Args:
+            attempt (int): Number of attempts made so far (1 after the first failure).
+            response (requests.Response): Optional failed response, checked for Retry-After.
+
+        Returns:
+            float: delay in seconds.
+        '''
+
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+
+        cap = min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1))
+        return random.uniform(0, cap) if self.jitter else cap
+
+class RateLimiter:
+    '''
+    Token bucket limiting how many export requests one project starts per minute, so concurrent shards, retries and scheduled runs stay under the project's API quota. Thread-safe.
+
+    Args:
+        requests_per_minute (float): Sustained request rate.
+        burst (int): Requests that may start back to back before the rate applies.
+    '''
+
+    def __init__(self, requests_per_minute: float, burst: int = 1):
+        self.interval = 60.0 / requests_per_minute
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Blocks until a request may start.
+
+        Returns:
+            float: seconds waited.
+        '''
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+            self.updated = now
+            # Take the token now, and wait for it outside the lock if the bucket was empty
+            self.tokens -= 1
+            wait = -self.tokens * self.interval if self.tokens < 0 else 0.0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class _RateLimitedSession(requests.Session):
+    # Session that takes a RateLimiter token before every request
+
+    def __init__(self, rate_limiter: RateLimiter):
+        super().__init__()
+        self.rate_limiter = rate_limiter
+
+    def request(self, *args, **kwargs):
+        self.rate_limiter.acquire()
+        return super().request(*args, **kwargs)
+
+def amplitude_session(pool_maxsize: int = 10, requests_per_minute: float = None):
+    '''
+    Creates a requests.Session whose connection pool is shared by every request made with it, so retries and concurrent shard downloads reuse TCP/TLS connections instead of opening new ones.
+
+    Args:
+        pool_maxsize (int): Connections kept open per host. Should be at least the number of concurrent downloads.
+        requests_per_minute (float): Optional limit on requests started through the session, e.g. one project's export quota.
+
+    Returns:
+        requests.Session: the session.
+    '''
+
+    session = _RateLimitedSession(RateLimiter(requests_per_minute)) if requests_per_minute else requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
@@ -0,0 +1,190 @@
+# Import libraries
+from datetime import datetime
+import os
+import gzip
+import json
+import string
+import hashlib
+import logging
+
+# Import modules
+from modules.amplitude_watermark import AMPLITUDE_FILENAME
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Hive-style layout: one prefix per project and hour, so S3 listings, Snowflake external stages and COPY pattern filters only touch the partitions they need
+HIVE_KEY_TEMPLATE = '{project}/year={year}/month={month}/day={day}/hour={hour}/{filename}'
+
+# Fields available to a key template
+KEY_FIELDS = ('project', 'year', 'month', 'day', 'hour', 'date', 'filename')
+
+# Formats that stay valid when files are concatenated: NDJSON lines, gzip members and zstd frames
+COMPACTABLE_EXTENSIONS = ('.json', '.json.gz', '.json.zst')
+
+# Amplitude export timestamps, used when the filename does not carry the hour
+EVENT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+def amplitude_key_template(key_template: str):
+    '''
+    Validates a key template, resolving the 'hive' shorthand to HIVE_KEY_TEMPLATE.
+
+    Args:
+        key_template (str): e.g. '{project}/dt={date}/{filename}'. Empty keeps every object at the bucket root under its filename.
+
+    Returns:
+        str: the template to use.
+    '''
+
+    if key_template == 'hive':
+        return HIVE_KEY_TEMPLATE
+    if not key_template:
+        return ''
+
+    fields = {field for _, field, _, _ in string.Formatter().parse(key_template) if field is not None}
+    unknown = fields - set(KEY_FIELDS)
+    if unknown:
+        raise ValueError(f"Unsupported key template field(s) {', '.join(sorted(unknown))}. Choose from {', '.join(KEY_FIELDS)}.")
+    # Without the filename, every file of a partition would be written to the same key
+    if 'filename' not in fields:
+        raise ValueError('Key template must include {filename}.')
+    return key_template
+
+def _event_fields(full_path: str):
+    # Read the first event of a raw or gzipped JSON file. Amplitude partitions exports by server upload time
+    opener = gzip.open if full_path.endswith('.gz') else open
+    try:
+        with opener(full_path, 'rb') as f:
+            event = json.loads(f.readline())
+        hour = datetime.strptime(event.get('server_upload_time') or event['event_time'], EVENT_TIME_FORMAT)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return str(event.get('app', 'unknown')), hour
+
+def amplitude_key_fields(filename: str, full_path: str = None):
+    '''
+    Derives the partition fields of an export file from its name ('<project>_<YYYY-MM-DD>_<H>#<n>...'), falling back to the first event in full_path.
+
+    Args:
+        filename (str): file name.
+        full_path (str): Optional local path, read only when the name does not follow the Amplitude pattern.
+
+    Returns:
+        dict: template fields, or None if they cannot be derived.
+    '''
+
+    match = AMPLITUDE_FILENAME.match(os.path.basename(filename))
+    if match:
+        project = match.group('project')
+        hour = datetime.strptime(f"{match.group('date')} {match.group('hour')}", '%Y-%m-%d %H')
+    elif full_path and os.path.exists(full_path):
+        fields = _event_fields(full_path)
+        if fields is None:
+            return None
+        project, hour = fields
+    else:
+        return None
+
+    return {'project': project, 'year': f'{hour:%Y}', 'month': f'{hour:%m}', 'day': f'{hour:%d}', 'hour': f'{hour:%H}', 'date': f'{hour:%Y-%m-%d}', 'filename': os.path.basename(filename)}
+
+def amplitude_object_key(filename: str, key_template: str = '', full_path: str = None):
+    '''
+    Returns the S3 key of a file under key_template. Files whose partition cannot be derived are kept at the bucket root.
+
+    Args:
+        filename (str): file name.
+        key_template (str): validated key template. Empty returns filename unchanged.
+        full_path (str): Optional local path, used to read the event timestamp when the name does not carry it.
+
+    Returns:
+        str: object key.
+    '''
+
+    if not key_template:
+        return filename
+
+    fields = amplitude_key_fields(filename, full_path)
+    if fields is None:
+        logger.warning(f'Could not derive partition for {filename}; uploading to the bucket root.')
+        return filename
+    return key_template.format(**fields)
+
+def _compactable_extension(filename: str):
+    # '.rerun-<timestamp>.json' delta files count as '.json'
+    return next((extension for extension in COMPACTABLE_EXTENSIONS if filename.endswith(extension)), None)
+
+def amplitude_compaction_plan(extract_folder: str, filenames: list, key_template: str, target_size_mb: int):
+    '''
+    Groups files that share a partition and format into batches of up to target_size_mb, so each batch can be uploaded as one object. Files that cannot be concatenated (e.g. parquet) or partitioned stay on their own.
+
+    Args:
+        extract_folder (str): folder holding the files.
+        filenames (list): names of the files to upload.
+        key_template (str): validated key template. Files are only merged when every field of it but the filename is the same. Empty merges files of the same project and hour only.
+        target_size_mb (int): upper bound for the size of a merged object.
+
+    Returns:
+        list: batches, each a list of filenames in name order.
+    '''
+
+    target_bytes = target_size_mb * 1024 * 1024
+    groups = {}
+    batches = []
+    for filename in sorted(filenames):
+        full_path = os.path.join(extract_folder, filename)
+        extension = _compactable_extension(filename)
+        fields = amplitude_key_fields(filename, full_path)
+        if extension is None or fields is None:
+            batches.append([filename])
+            continue
+        # The template with an empty filename names the partition, whatever its separators. Without a template, the bucket root holds files of every hour side by side
+        partition = key_template.format(**{**fields, 'filename': ''}) if key_template else (fields['project'], fields['date'], fields['hour'])
+        groups.setdefault((partition, extension), []).append((filename, os.path.getsize(full_path)))
+
+    # Fill each batch in name order until the next file would push it past the target
+    for members in groups.values():
+        batch, batch_bytes = [], 0
+        for filename, size in members:
+            if batch and batch_bytes + size > target_bytes:
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(filename)
+            batch_bytes += size
+        batches.append(batch)
+
+    return batches
+
+def amplitude_compact_files(extract_folder: str, filenames: list):
+    '''
+    Concatenates a batch of files into one '.part' file in extract_folder. The merged name is derived from the names of its members, so a rerun of the same batch produces the same object key and a different batch never overwrites it.
+
+    Args:
+        extract_folder (str): folder holding the files.
+        filenames (list): batch from amplitude_compaction_plan, all with the same extension.
+
+    Returns:
+        tuple: (filename, part_path) - name of the merged file, and the path it was written to. The caller renames or removes part_path.
+    '''
+
+    extension = _compactable_extension(filenames[0])
+    digest = hashlib.blake2b('\n'.join(filenames).encode('utf-8'), digest_size=4).hexdigest()
+    filename = f"{filenames[0].split('.', 1)[0]}.compact-{len(filenames)}-{digest}{extension}"
+    part_path = os.path.join(extract_folder, f'{filename}.part')
+
+    try:
+        with open(part_path, 'wb') as f_out:
+            for member in filenames:
+                last_byte = b''
+                with open(os.path.join(extract_folder, member), 'rb') as f_in:
+                    while chunk := f_in.read(1024 * 1024):
+                        f_out.write(chunk)
+                        last_byte = chunk[-1:]
+                # NDJSON lines must not run into the next file
+                if extension == '.json' and last_byte not in (b'\n', b''):
+                    f_out.write(b'\n')
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    return filename, part_path
@@ -1,29 +1,188 @@
 # Import libraries
+from concurrent.futures import as_completed
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import boto3
 import os
+import time
 import logging
 
+# Import modules
+from modules.amplitude_watermark import amplitude_watermark_mark_files
+from modules.amplitude_checkpoint import file_s3_etag, amplitude_checkpoint_object_matches
+from modules.amplitude_metrics import metrics_increment
+from modules.amplitude_manifest import amplitude_manifest_add
+from modules.amplitude_cache import amplitude_cache_object_matches, amplitude_cache_record_objects
+from modules.amplitude_s3_layout import amplitude_key_template, amplitude_object_key, amplitude_compaction_plan, amplitude_compact_files
+from modules.amplitude_pools import BoundedExecutor
+
 # Define the logger
 logger = logging.getLogger(__name__)
 
-def amplitude_s3_load(extract_folder, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_BUCKET_NAME):
+MB = 1024 * 1024
+
+def amplitude_s3_client(AWS_ACCESS_KEY, AWS_SECRET_KEY, max_pool_connections: int = 10, endpoint_url: str = None):
     """
-    This function uploads each extracted JSON file to an S3 bucket. Once files are uploaded successfully, the folder is cleaned up.
+    Creates an S3 client whose connection pool is large enough for concurrent uploads. boto3 clients are thread-safe, so one client is shared by every upload thread.
 
     Args:
-        extract_folder (str): Name of the folder containing extracted JSON files.
         AWS_ACCESS_KEY (str): AWS access key from .env file
-        AWS_SECRET_KEY (str): AWS access key from .env file
-        AWS_BUCKET_NAME (str): AWS access key from .env file
+        AWS_SECRET_KEY (str): AWS secret key from .env file
+        max_pool_connections (int): Maximum number of HTTP connections kept open by the client.
+        endpoint_url (str): Optional S3-compatible endpoint, e.g. a local moto server. Defaults to AWS.
+
+    Returns:
+        botocore.client.S3: Configured S3 client.
     """
 
     # S3 client set-up with authentication keys
-    s3_client = boto3.client(
+    return boto3.client(
         's3'
         , aws_access_key_id = AWS_ACCESS_KEY
         , aws_secret_access_key = AWS_SECRET_KEY
+        , endpoint_url = endpoint_url
+        , config = Config(max_pool_connections = max_pool_connections)
     )
 
+def amplitude_transfer_config(multipart_threshold_mb: int = 8, multipart_chunksize_mb: int = 8, multipart_concurrency: int = 4):
+    """
+    Creates the TransferConfig shared by every upload in a run.
+
+    Args:
+        multipart_threshold_mb (int): Files at or above this size in MB are uploaded as multipart uploads.
+        multipart_chunksize_mb (int): Size in MB of each multipart part.
+        multipart_concurrency (int): Number of threads used for the parts of a single file.
+
+    Returns:
+        boto3.s3.transfer.TransferConfig: Shared transfer configuration.
+    """
+
+    return TransferConfig(
+        multipart_threshold = multipart_threshold_mb * MB
+        , multipart_chunksize = multipart_chunksize_mb * MB
+        , max_concurrency = multipart_concurrency
+        , use_threads = multipart_concurrency > 1
+    )
+
+def _upload_and_delete(s3_client, full_path: str, AWS_BUCKET_NAME: str, key: str, transfer_config: TransferConfig, skip_existing: bool = False, cache_dir: str = None):
+    """
+    Uploads one file to S3 and deletes the local copy ONLY if the upload succeeds.
+    With skip_existing, the file's S3 ETag is computed locally and the upload is skipped when S3 already holds an object with the same size and ETag.
+    With cache_dir, the cache index is consulted first, so objects it already records are skipped without a HeadObject call.
+
+    Args:
+        s3_client (botocore.client.S3): Shared S3 client.
+        full_path (str): Local path of the file.
+        AWS_BUCKET_NAME (str): Destination bucket.
+        key (str): Destination object key.
+        transfer_config (TransferConfig): Shared transfer configuration.
+        skip_existing (bool): If True, skip the upload when the identical object is already in S3.
+        cache_dir (str): Optional cache whose index records objects already uploaded. Implies skip_existing.
+
+    Returns:
+        tuple: (bytes, etag, skipped) - size of the file, its computed ETag (None unless skip_existing or cache_dir) and whether the upload was skipped.
+    """
+
+    # Size is read before upload because the file is removed afterwards
+    file_size = os.path.getsize(full_path)
+    etag = None
+    skipped = False
+
+    # Compare with the object already in S3, e.g. one uploaded by a run that crashed before deleting its local copy
+    if skip_existing or cache_dir:
+        etag = file_s3_etag(full_path, transfer_config.multipart_threshold, transfer_config.multipart_chunksize)
+        skipped = amplitude_cache_object_matches(cache_dir, AWS_BUCKET_NAME, key, file_size, etag) or amplitude_checkpoint_object_matches(s3_client, AWS_BUCKET_NAME, key, file_size, etag)
+
+    # Uploads the file to S3 bucket. Args - path of data folder, s3 bucket name, name of the file you want to upload
+    if not skipped:
+        s3_client.upload_file(full_path, AWS_BUCKET_NAME, key, Config = transfer_config)
+
+    # Delete the local file ONLY if the line above succeeds
+    os.remove(full_path)
+
+    return file_size, etag, skipped
+
+def _upload_batch(s3_client, extract_folder: str, batch: list, AWS_BUCKET_NAME: str, key_template: str, transfer_config: TransferConfig, skip_existing: bool = False, cache_dir: str = None):
+    """
+    Uploads one file, or a batch of files merged into one object, under its key_template key. Local files are deleted ONLY if the upload succeeds.
+
+    Args:
+        s3_client (botocore.client.S3): Shared S3 client.
+        extract_folder (str): Folder holding the files.
+        batch (list): Filenames to upload as one object.
+        AWS_BUCKET_NAME (str): Destination bucket.
+        key_template (str): Validated key template. Empty uploads to the bucket root.
+        transfer_config (TransferConfig): Shared transfer configuration.
+        skip_existing (bool): If True, skip the upload when the identical object is already in S3.
+        cache_dir (str): Optional cache whose index records objects already uploaded.
+
+    Returns:
+        tuple: (key, bytes, etag, skipped) - see _upload_and_delete.
+    """
+
+    first_path = os.path.join(extract_folder, batch[0])
+    key = amplitude_object_key(batch[0], key_template, first_path)
+    if len(batch) == 1:
+        return (key, *_upload_and_delete(s3_client, first_path, AWS_BUCKET_NAME, key, transfer_config, skip_existing, cache_dir))
+
+    # Merge the batch into one file under the same prefix as its first member
+    filename, part_path = amplitude_compact_files(extract_folder, batch)
+    key = f"{key.rpartition('/')[0]}/{filename}".lstrip('/')
+    try:
+        file_size, etag, skipped = _upload_and_delete(s3_client, part_path, AWS_BUCKET_NAME, key, transfer_config, skip_existing, cache_dir)
+    except Exception:
+        os.remove(part_path)
+        raise
+
+    # The merged object is in S3, so its members can go
+    for member in batch:
+        os.remove(os.path.join(extract_folder, member))
+
+    return key, file_size, etag, skipped
+
+def amplitude_s3_load(extract_folder, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_BUCKET_NAME, max_workers: int = 8, multipart_threshold_mb: int = 8, multipart_chunksize_mb: int = 8, multipart_concurrency: int = 4, max_pool_connections: int = None, endpoint_url: str = None, state_path: str = None, checkpoint_path: str = None, key_template: str = '', compact_target_mb: int = 0, manifest_path: str = None, s3_client = None, cache_dir: str = None, thread_pool = None):
+    """
+    This function uploads each extracted JSON file to an S3 bucket. Files are uploaded concurrently on a thread pool that shares one S3 client and one TransferConfig. Once files are uploaded successfully, the folder is cleaned up.
+    Objects are keyed by key_template (e.g. Hive-style 'project/year=/month=/day=/hour=' prefixes). With compact_target_mb, small files sharing a prefix and format are merged into objects of up to that size, so fewer, larger objects are written.
+
+    Args:
+        extract_folder (str): Name of the folder containing extracted JSON files.
+        AWS_ACCESS_KEY (str): AWS access key from .env file
+        AWS_SECRET_KEY (str): AWS access key from .env file
+        AWS_BUCKET_NAME (str): AWS access key from .env file
+        max_workers (int): Number of files uploaded at the same time.
+        multipart_threshold_mb (int): Files at or above this size in MB are uploaded as multipart uploads.
+        multipart_chunksize_mb (int): Size in MB of each multipart part.
+        multipart_concurrency (int): Number of threads used for the parts of a single file.
+        max_pool_connections (int): Connection pool size of the S3 client. Defaults to max_workers * multipart_concurrency so no thread waits on a connection.
+        endpoint_url (str): Optional S3-compatible endpoint, e.g. a local moto server. Defaults to AWS.
+        state_path (str): Optional watermark file used to record which export files were uploaded.
+        checkpoint_path (str): Optional checkpoint file. When set, files whose identical object is already in S3 (checked with HeadObject) are not uploaded again.
+        key_template (str): Optional key template ('hive' or a format string, see amplitude_s3_layout). Empty uploads to the bucket root under the filename.
+        compact_target_mb (int): Optional target size in MB of merged objects. 0 uploads every file as its own object.
+        manifest_path (str): Optional manifest file. Uploaded keys are recorded in it for the Snowflake load stage.
+        s3_client (botocore.client.S3): Optional shared client, e.g. one kept warm by the daemon. One is created from the keys and pool settings otherwise.
+        cache_dir (str): Optional cache (see amplitude_cache). Files whose identical object it records are not uploaded again, without asking S3.
+        thread_pool (concurrent.futures.Executor): Optional thread pool shared with other projects. At most max_workers uploads of this call run on it at a time. A private pool is used otherwise.
+
+    Returns:
+        list: Object keys uploaded (or already present) during this call.
+    """
+
+    key_template = amplitude_key_template(key_template)
+
+    # Keys uploaded during this call
+    uploaded_keys = []
+
+    # Size the connection pool so every file worker and part thread can hold a connection
+    if max_pool_connections is None:
+        max_pool_connections = max_workers * multipart_concurrency
+
+    # S3 client and transfer settings shared by every upload
+    if s3_client is None:
+        s3_client = amplitude_s3_client(AWS_ACCESS_KEY, AWS_SECRET_KEY, max_pool_connections, endpoint_url)
+    transfer_config = amplitude_transfer_config(multipart_threshold_mb, multipart_chunksize_mb, multipart_concurrency)
+
     # Check if folder with extracted data exists. If it doesn't, folder is created.
     os.makedirs(extract_folder, exist_ok=True)
 
@@ -49,8 +208,8 @@ def amplitude_s3_load(extract_folder, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_BUCKET
         for item in all_items:
             # Creates filepath for file in the loop
             full_path = os.path.join(extract_folder, item)
-            # If file exists, append to the empty list
-            if os.path.isfile(full_path):
+            # If file exists, append to the empty list. '.part' files are unfinished output of an interrupted run
+            if os.path.isfile(full_path) and not item.endswith('.part'):
                 file_list.append(item)
                 # Increase file_count by 1
                 file_count += 1
@@ -59,31 +218,78 @@ def amplitude_s3_load(extract_folder, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_BUCKET
         print(f"{file_count} files added to upload list.")
         logger.info(f"{file_count} files appended to upload list.")
 
-        # Initialize count for number of files
+        # Files merged into one object travel as one batch
+        if compact_target_mb:
+            batches = amplitude_compaction_plan(extract_folder, file_list, key_template, compact_target_mb)
+            print(f"Compaction: {len(file_list)} files grouped into {len(batches)} object(s) of up to {compact_target_mb}MB.")
+            logger.info(f"Compaction: {len(file_list)} files grouped into {len(batches)} object(s) of up to {compact_target_mb}MB.")
+        else:
+            batches = [[filename] for filename in file_list]
+
+        # Initialize count for number of files and bytes uploaded
         file_count = 0
+        uploaded_files = []
+        skipped_count = 0
+        bytes_uploaded = 0
+        uploaded_objects = []
+        upload_start = time.perf_counter()
 
-        # Loops through all files in the file_list, creates relative path and enters try/except block that will upload to S3 bucket and clean up folder
-        for filename in file_list:
-            # Recreate the full path relative to the script for upload loop
-            full_path = os.path.join(extract_folder, filename)
+        # Submits every batch to the upload pool. Each task uploads to S3 bucket and cleans up its local files
+        with BoundedExecutor(thread_pool, max_workers) as executor:
+            futures = {
+                executor.submit(_upload_batch, s3_client, extract_folder, batch, AWS_BUCKET_NAME, key_template, transfer_config, checkpoint_path is not None, cache_dir): batch
+                for batch in batches
+            }
 
-            try:
-                # Uploads the file to S3 bucket. Args - path of data folder, s3 bucket name, name of the file you want to upload
-                s3_client.upload_file(full_path, AWS_BUCKET_NAME, filename)
+            for future in as_completed(futures):
+                batch = futures[future]
+                filename = batch[0] if len(batch) == 1 else f"{len(batch)} files from {batch[0]}"
 
-                # Delete the local file ONLY if the line above succeeds
-                os.remove(full_path)
-                print(f"Uploaded and deleted local copy: {filename}")
-                logger.info(f"Uploaded and deleted local copy: {filename}")
+                try:
+                    key, file_size, etag, skipped = future.result()
+                    uploaded_keys.append(key)
+                    uploaded_files.extend(batch)
+                    uploaded_objects.append((key, etag, file_size))
 
-                # Increase file_count by 1
-                file_count += 1
+                    # Objects already in S3 are not counted towards upload throughput
+                    if skipped:
+                        skipped_count += 1
+                        metrics_increment('amplitude_s3_load', 'cached')
+                        print(f"Skipped upload, identical object already in S3. Deleted local copy: {filename}")
+                        logger.info(f"Skipped upload, identical object already in S3. Deleted local copy: {filename}")
+                    else:
+                        bytes_uploaded += file_size
+                        metrics_increment('amplitude_s3_load', 'bytes_in', file_size)
+                        metrics_increment('amplitude_s3_load', 'bytes_out', file_size)
+                        metrics_increment('amplitude_s3_load', 'files')
+                        print(f"Uploaded {key} and deleted local copy: {filename}")
+                        logger.info(f"Uploaded {key} and deleted local copy: {filename}")
+
+                    # Increase file_count by the number of files in the object
+                    file_count += len(batch)
+
+                except Exception as e:
+                    # If upload fails, the code jumps here, and the file is NOT deleted
+                    metrics_increment('amplitude_s3_load', 'errors')
+                    print(f"Failed to upload {filename}: {e}")
+                    logger.error(f"Failed to upload {filename}: {e}")
 
-            except Exception as e:
-                # If upload fails, the code jumps here, and the file is NOT deleted
-                print(f"Failed to upload {filename}: {e}")
-                logger.error(f"Failed to upload {filename}: {e}")
+        # Aggregate throughput across all upload threads
+        upload_seconds = max(time.perf_counter() - upload_start, 1e-6)
+        print(f"Uploaded {bytes_uploaded / MB:.1f}MB in {upload_seconds:.2f}s ({bytes_uploaded / MB / upload_seconds:.1f} MB/s, {max_workers} workers).")
+        logger.info(f"Uploaded {bytes_uploaded / MB:.1f}MB in {upload_seconds:.2f}s ({bytes_uploaded / MB / upload_seconds:.1f} MB/s, {max_workers} workers).")
         
         # Print and log number of files uploaded to S3 and cleaned up
-        print(f"{file_count} files uploaded to bucket:{AWS_BUCKET_NAME} and deleted locally.")
-        logger.info(f"{file_count} files uploaded to s3 bucket and delete locally. Process Complete.")
\ No newline at end of file
+        print(f"{file_count} files uploaded to bucket:{AWS_BUCKET_NAME} as {len(uploaded_keys)} object(s) and deleted locally.")
+        logger.info(f"{file_count} files uploaded to s3 bucket and delete locally. Process Complete.")
+
+        if skipped_count:
+            print(f"{skipped_count} of those files were already in S3 and were not uploaded again.")
+            logger.info(f"{skipped_count} of those files were already in S3 and were not uploaded again.")
+
+        # Record uploaded files so later runs skip their hours, and their ETags in the cache so backfills skip identical uploads
+        amplitude_watermark_mark_files(state_path, uploaded_files, 'uploaded')
+        amplitude_cache_record_objects(cache_dir, AWS_BUCKET_NAME, uploaded_objects)
+        amplitude_manifest_add(manifest_path, uploaded_keys)
+
+    return uploaded_keys
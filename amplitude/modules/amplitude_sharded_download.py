@@ -0,0 +1,183 @@
+# Import libraries
+from concurrent.futures import wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+import logging
+
+# Import modules
+from modules.amplitude_api_call import amplitude_api_call, AmplitudeExportError
+from modules.amplitude_watermark import amplitude_hours_between, amplitude_watermark_mark_hours, amplitude_settled_hours, AVAILABILITY_LAG_HOURS
+from modules.amplitude_retry import RetryPolicy, amplitude_session
+from modules.amplitude_pools import BoundedExecutor
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Amplitude export API hour format
+HOUR_FORMAT = '%Y%m%dT%H'
+
+# Status codes that mean the shard is too large for a single export and should be split
+SPLIT_STATUS_CODES = (400, 504)
+
+def amplitude_shard_plan(start_time: str, end_time: str, shard_hours: int):
+    '''
+    Splits the start_time/end_time window into consecutive shards of shard_hours hours. Both ends of the window and of every shard are inclusive, matching the Amplitude export API.
+
+    Args:
+        start_time (str): earliest hour in the window in '%Y%m%dT%H' format.
+        end_time (str): latest hour in the window in '%Y%m%dT%H' format.
+        shard_hours (int): number of hours in each shard. The final shard may be shorter.
+
+    Returns:
+        list: (shard_start, shard_end) tuples in '%Y%m%dT%H' format, in chronological order.
+    '''
+
+    # Validate shard size
+    if shard_hours < 1:
+        raise ValueError(f'shard_hours must be at least 1, got {shard_hours}.')
+
+    # Parse window boundaries
+    window_start = datetime.strptime(start_time, HOUR_FORMAT)
+    window_end = datetime.strptime(end_time, HOUR_FORMAT)
+
+    # Walk the window in shard_hours steps, clipping the final shard to window_end
+    shards = []
+    shard_start = window_start
+    while shard_start <= window_end:
+        shard_end = min(shard_start + timedelta(hours=shard_hours - 1), window_end)
+        shards.append((shard_start.strftime(HOUR_FORMAT), shard_end.strftime(HOUR_FORMAT)))
+        shard_start = shard_end + timedelta(hours=1)
+
+    return shards
+
+def amplitude_bisect_shard(start_time: str, end_time: str):
+    '''
+    Splits a shard into two halves on an hour boundary.
+
+    Args:
+        start_time (str): first hour of the shard in '%Y%m%dT%H' format.
+        end_time (str): last hour of the shard in '%Y%m%dT%H' format.
+
+    Returns:
+        list: two (shard_start, shard_end) tuples, or an empty list if the shard is a single hour and cannot be split.
+    '''
+
+    # Count the hours in the shard
+    shard_start = datetime.strptime(start_time, HOUR_FORMAT)
+    shard_end = datetime.strptime(end_time, HOUR_FORMAT)
+    hours = int((shard_end - shard_start).total_seconds() // 3600) + 1
+
+    # A single hour is the smallest window the export API accepts
+    if hours <= 1:
+        return []
+
+    # Split at the midpoint hour
+    midpoint = shard_start + timedelta(hours=hours // 2)
+    return [
+        (start_time, (midpoint - timedelta(hours=1)).strftime(HOUR_FORMAT)),
+        (midpoint.strftime(HOUR_FORMAT), end_time),
+    ]
+
+def amplitude_sharded_download(url: str, start_time: str, end_time: str, AMP_API_KEY: str, AMP_SECRET_KEY: str, max_attempts: int, shard_hours: int = 6, max_workers: int = 4, ranges: list = None, state_path: str = None, checkpoint_path: str = None, retry_policy: RetryPolicy = None, session = None, download_dir: str = 'downloaded_data', cache_dir: str = None, availability_lag_hours: int = AVAILABILITY_LAG_HOURS, thread_pool = None):
+    '''
+    Splits the start_time/end_time window into shards and downloads them concurrently with amplitude_api_call. Shards that return 400 (4GB limit) or 504 (timeout) are bisected and re-queued until they succeed or reach a single hour.
+
+    Args:
+        url (str): Amplitude API URL.
+        start_time (str): earliest hour in the download date range.
+        end_time (str): latest hour in the download date range.
+        AMP_API_KEY (str): Amplitude API key from .env file.
+        AMP_SECRET_KEY (str): Amplitude secret key from .env file.
+        max_attempts (int): Maximum number of times each shard request will retry in case of timeout.
+        shard_hours (int): Number of hours in each initial shard.
+        max_workers (int): Maximum number of shards downloaded at the same time.
+        ranges (list): Optional (start, end) hour ranges to download instead of the whole start_time/end_time window, e.g. the pending ranges from amplitude_pending_ranges.
+        state_path (str): Optional watermark file. Downloaded shards are marked 'downloaded' and 404 shards 'empty'.
+        checkpoint_path (str): Optional checkpoint file in which each downloaded archive is recorded with its checksum.
+        retry_policy (RetryPolicy): Optional backoff policy used for every shard. Defaults to RetryPolicy(max_attempts).
+        session (requests.Session): Optional pooled session. By default one session sized for max_workers is shared by every shard and closed afterwards.
+        download_dir (str): Folder the archives are written to.
+        cache_dir (str): Optional archive cache. Cached windows are not downloaded again.
+        availability_lag_hours (int): Hours of a 404 shard newer than this lag are not marked 'empty', and windows reaching into them bypass the cache, as their events may still arrive.
+        thread_pool (concurrent.futures.Executor): Optional thread pool shared with other projects. At most max_workers shards of this call run on it at a time. A private pool is used otherwise.
+
+    Returns:
+        bool: True if at least one shard was downloaded.
+              False if no shard was downloaded.
+    '''
+
+    # Plan the initial shards, across every requested range
+    if ranges is None:
+        ranges = [(start_time, end_time)]
+    shards = [shard for range_start, range_end in ranges for shard in amplitude_shard_plan(range_start, range_end, shard_hours)]
+    print(f'Planned {len(shards)} shard(s) of up to {shard_hours} hour(s) across {len(ranges)} range(s) in {start_time}-{end_time}.')
+    logger.info(f'Planned {len(shards)} shard(s) of up to {shard_hours} hour(s) across {len(ranges)} range(s) in {start_time}-{end_time}.')
+
+    # One connection pool for every shard, so retries and later shards reuse open connections
+    own_session = session is None
+    if own_session:
+        session = amplitude_session(pool_maxsize=max_workers)
+
+    # Track shard outcomes
+    downloaded_shards = []
+    empty_shards = []
+    failed_shards = []
+
+    with BoundedExecutor(thread_pool, max_workers) as executor:
+
+        # Submit every initial shard. Dictionary maps each future back to the shard it is downloading
+        pending = {
+            executor.submit(amplitude_api_call, url, shard_start, shard_end, AMP_API_KEY, AMP_SECRET_KEY, max_attempts, raise_on_status=True, checkpoint_path=checkpoint_path, session=session, retry_policy=retry_policy, download_dir=download_dir, cache_dir=cache_dir, availability_lag_hours=availability_lag_hours): (shard_start, shard_end)
+            for shard_start, shard_end in shards
+        }
+
+        # Collect results as they finish, re-queueing bisected shards onto the same pool
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                shard_start, shard_end = pending.pop(future)
+
+                try:
+                    if future.result():
+                        downloaded_shards.append((shard_start, shard_end))
+                    else:
+                        failed_shards.append((shard_start, shard_end))
+
+                except AmplitudeExportError as e:
+                    # No data for this shard is not a failure
+                    if e.status_code == 404:
+                        empty_shards.append((shard_start, shard_end))
+                        continue
+
+                    # Split oversize/timed out shards in half and queue both halves
+                    halves = amplitude_bisect_shard(shard_start, shard_end) if e.status_code in SPLIT_STATUS_CODES else []
+                    if halves:
+                        print(f'Shard {shard_start}-{shard_end} returned {e.status_code}. Splitting into {halves[0][0]}-{halves[0][1]} and {halves[1][0]}-{halves[1][1]}.')
+                        logger.warning(f'Shard {shard_start}-{shard_end} returned {e.status_code}. Splitting into {halves[0][0]}-{halves[0][1]} and {halves[1][0]}-{halves[1][1]}.')
+                        for half_start, half_end in halves:
+                            half_future = executor.submit(amplitude_api_call, url, half_start, half_end, AMP_API_KEY, AMP_SECRET_KEY, max_attempts, raise_on_status=True, checkpoint_path=checkpoint_path, session=session, retry_policy=retry_policy, download_dir=download_dir, cache_dir=cache_dir, availability_lag_hours=availability_lag_hours)
+                            pending[half_future] = (half_start, half_end)
+                    else:
+                        print(f'Shard {shard_start}-{shard_end} returned {e.status_code} and cannot be split further.')
+                        logger.error(f'Shard {shard_start}-{shard_end} returned {e.status_code} and cannot be split further.')
+                        failed_shards.append((shard_start, shard_end))
+
+                except Exception as e:
+                    print(f'Shard {shard_start}-{shard_end} download failed: {e}')
+                    logger.error(f'Shard {shard_start}-{shard_end} download failed: {e}')
+                    failed_shards.append((shard_start, shard_end))
+
+    if own_session:
+        session.close()
+
+    # Log summary of shard outcomes
+    print(f'{len(downloaded_shards)} shard(s) downloaded, {len(empty_shards)} shard(s) had no data, {len(failed_shards)} shard(s) failed.')
+    logger.info(f'{len(downloaded_shards)} shard(s) downloaded, {len(empty_shards)} shard(s) had no data, {len(failed_shards)} shard(s) failed.')
+    for shard_start, shard_end in failed_shards:
+        logger.error(f'Shard {shard_start}-{shard_end} was not downloaded. Re-run for this range.')
+
+    # Record shard outcomes in the watermark so later runs only request what is still missing
+    amplitude_watermark_mark_hours(state_path, [hour for shard in downloaded_shards for hour in amplitude_hours_between(*shard)], 'downloaded')
+    amplitude_watermark_mark_hours(state_path, amplitude_settled_hours([hour for shard in empty_shards for hour in amplitude_hours_between(*shard)], availability_lag_hours), 'empty')
+
+    return len(downloaded_shards) > 0
@@ -0,0 +1,147 @@
+# Import libraries
+import time
+import logging
+
+# Import modules
+from modules.amplitude_manifest import amplitude_manifest_pending, amplitude_manifest_mark_loaded
+from modules.amplitude_metrics import metrics_increment
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Snowflake accepts at most 1000 file names in the FILES option of one COPY INTO
+MAX_FILES_PER_COPY = 1000
+
+# COPY result statuses of files whose rows reached the table
+LOADED_STATUSES = ('LOADED', 'PARTIALLY_LOADED')
+
+def _file_type(key: str):
+    # JSON with COMPRESSION = AUTO also reads the gzip and zstd outputs of amplitude_transform
+    return 'PARQUET' if key.endswith('.parquet') else 'JSON'
+
+def amplitude_copy_statement(table: str, stage: str, keys: list, file_type: str = 'JSON', on_error: str = 'ABORT_STATEMENT', file_format: str = None):
+    '''
+    Builds a COPY INTO statement that loads exactly the listed files, so Snowflake never lists or scans the rest of the stage.
+
+    Args:
+        table (str): target table, e.g. 'RAW.AMPLITUDE.EVENTS'.
+        stage (str): external stage pointing at the bucket root, e.g. '@RAW.AMPLITUDE.S3_STAGE'.
+        keys (list): object keys relative to the stage, at most MAX_FILES_PER_COPY.
+        file_type (str): 'JSON' or 'PARQUET', used when no named file_format is given.
+        on_error (str): COPY ON_ERROR option, e.g. 'ABORT_STATEMENT' or 'CONTINUE'.
+        file_format (str): Optional named file format, replacing the inline file type.
+
+    Returns:
+        str: the statement.
+    '''
+
+    files = ', '.join("'" + key.replace("'", "''") + "'" for key in keys)
+    file_format_clause = f"(FORMAT_NAME = '{file_format}')" if file_format else f"(TYPE = '{file_type}')"
+    return f"COPY INTO {table} FROM {stage} FILES = ({files}) FILE_FORMAT = {file_format_clause} ON_ERROR = '{on_error}'"
+
+def _copy_results(cursor, keys: list):
+    # One result row per file processed. Snowflake reports files by their full stage URL, so each is matched back to its key by path suffix
+    columns = [column[0].lower() for column in cursor.description or []]
+    keys = set(keys)
+    results = {}
+    for row in cursor.fetchall():
+        result = dict(zip(columns, row))
+        if 'file' not in result:
+            continue
+        parts = str(result['file']).split('/')
+        key = next(('/'.join(parts[i:]) for i in range(len(parts)) if '/'.join(parts[i:]) in keys), None)
+        if key is not None:
+            results[key] = result
+    return results
+
+def amplitude_snowflake_load(manifest_path: str, table: str, stage: str, connection_params: dict = None, connect=None, batch_size: int = MAX_FILES_PER_COPY, on_error: str = 'ABORT_STATEMENT', file_format: str = None):
+    '''
+    Loads the objects listed in the upload manifest into Snowflake with batched COPY INTO statements, each naming up to batch_size files. Loaded objects are removed from the manifest; objects of a failed batch stay in it and are retried by the next run.
+    Files missing from a COPY result were already loaded before (Snowflake skips them using its load metadata) and are treated as loaded.
+
+    Args:
+        manifest_path (str): manifest written by the S3 load stage.
+        table (str): target table.
+        stage (str): external stage pointing at the bucket root.
+        connection_params (dict): keyword arguments for connect, e.g. account, user, password, warehouse, database, schema, role.
+        connect (callable): Optional DB-API connect function, e.g. a local stand-in. Defaults to snowflake.connector.connect.
+        batch_size (int): files per COPY statement, at most 1000.
+        on_error (str): COPY ON_ERROR option.
+        file_format (str): Optional named file format used for every file.
+
+    Returns:
+        dict: batches, files_loaded, files_failed, rows_loaded and seconds.
+    '''
+
+    summary = {'batches': 0, 'files_loaded': 0, 'files_failed': 0, 'rows_loaded': 0, 'seconds': 0.0}
+
+    keys = amplitude_manifest_pending(manifest_path)
+    if not keys:
+        print('Snowflake load: no uploaded objects waiting to be loaded.')
+        logger.info('Snowflake load: no uploaded objects waiting to be loaded.')
+        return summary
+
+    # snowflake-connector-python is only needed when no stand-in is passed
+    if connect is None:
+        try:
+            import snowflake.connector
+        except ImportError:
+            raise ImportError('Loading to Snowflake requires snowflake-connector-python: pip install snowflake-connector-python')
+        connect = snowflake.connector.connect
+
+    # One COPY per file type, in batches the FILES option accepts
+    batch_size = max(1, min(batch_size, MAX_FILES_PER_COPY))
+    batches = []
+    for file_type in sorted({_file_type(key) for key in keys}):
+        typed_keys = [key for key in keys if _file_type(key) == file_type]
+        batches.extend((file_type, typed_keys[offset:offset + batch_size]) for offset in range(0, len(typed_keys), batch_size))
+
+    print(f'Snowflake load: {len(keys)} object(s) into {table} in {len(batches)} COPY batch(es) of up to {batch_size} files.')
+    logger.info(f'Snowflake load: {len(keys)} object(s) into {table} in {len(batches)} COPY batch(es) of up to {batch_size} files.')
+
+    load_start = time.perf_counter()
+    connection = connect(**(connection_params or {}))
+    try:
+        cursor = connection.cursor()
+        for number, (file_type, batch) in enumerate(batches, start=1):
+            batch_start = time.perf_counter()
+            try:
+                cursor.execute(amplitude_copy_statement(table, stage, batch, file_type, on_error, file_format))
+                results = _copy_results(cursor, batch)
+            except Exception as e:
+                # The whole batch stays in the manifest for the next run
+                summary['files_failed'] += len(batch)
+                metrics_increment('amplitude_snowflake_load', 'errors')
+                print(f'COPY batch {number}/{len(batches)} failed: {e}')
+                logger.error(f'COPY batch {number}/{len(batches)} failed: {e}')
+                continue
+
+            failed = [key for key, result in results.items() if str(result.get('status', '')).upper() not in LOADED_STATUSES]
+            loaded = [key for key in batch if key not in failed]
+            rows = sum(int(result.get('rows_loaded') or 0) for key, result in results.items() if key not in failed)
+            for key in failed:
+                print(f"Failed to load {key}: {results[key].get('first_error')}")
+                logger.error(f"Failed to load {key}: {results[key].get('first_error')}")
+
+            amplitude_manifest_mark_loaded(manifest_path, loaded)
+            summary['batches'] += 1
+            summary['files_loaded'] += len(loaded)
+            summary['files_failed'] += len(failed)
+            summary['rows_loaded'] += rows
+            metrics_increment('amplitude_snowflake_load', 'files', len(loaded))
+            metrics_increment('amplitude_snowflake_load', 'rows', rows)
+            metrics_increment('amplitude_snowflake_load', 'errors', len(failed))
+
+            batch_seconds = max(time.perf_counter() - batch_start, 1e-6)
+            print(f'COPY batch {number}/{len(batches)}: {len(batch)} file(s), {rows} row(s) in {batch_seconds:.2f}s ({rows / batch_seconds:.0f} rows/s).')
+            logger.info(f'COPY batch {number}/{len(batches)}: {len(batch)} file(s), {rows} row(s) in {batch_seconds:.2f}s ({rows / batch_seconds:.0f} rows/s).')
+        cursor.close()
+    finally:
+        connection.close()
+
+    # Aggregate throughput across all batches
+    summary['seconds'] = max(time.perf_counter() - load_start, 1e-6)
+    print(f"Snowflake load: {summary['rows_loaded']} row(s) from {summary['files_loaded']} file(s) in {summary['seconds']:.2f}s ({summary['rows_loaded'] / summary['seconds']:.0f} rows/s, {summary['files_loaded'] / max(summary['batches'], 1):.0f} files per COPY). {summary['files_failed']} file(s) failed.")
+    logger.info(f"Snowflake load: {summary['rows_loaded']} row(s) from {summary['files_loaded']} file(s) in {summary['seconds']:.2f}s ({summary['rows_loaded'] / summary['seconds']:.0f} rows/s, {summary['files_loaded'] / max(summary['batches'], 1):.0f} files per COPY). {summary['files_failed']} file(s) failed.")
+
+    return summary
@@ -0,0 +1,173 @@
+# Import libraries
+import os
+import gzip
+import time
+import zipfile
+import logging
+
+# Import modules
+from modules.amplitude_zip_file_extract import zip_day_members
+from modules.amplitude_s3_load import amplitude_s3_client, amplitude_transfer_config, MB
+from modules.amplitude_watermark import amplitude_watermark_mark_files, amplitude_watermark_mark_archive
+from modules.amplitude_checkpoint import amplitude_checkpoint_forget_archive
+from modules.amplitude_metrics import metrics_increment
+from modules.amplitude_manifest import amplitude_manifest_add
+from modules.amplitude_s3_layout import amplitude_key_template, amplitude_object_key
+from modules.amplitude_pools import BoundedExecutor
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+def _stream_member_to_s3(s3_client, zip_path: str, member_name: str, AWS_BUCKET_NAME: str, key: str, transfer_config):
+    """
+    Decompresses one .gz member straight out of the zip and sends it to S3 as it is read. upload_fileobj reads the gzip stream one part at a time and uploads parts while later ones are still being decompressed, so only multipart_chunksize x multipart_concurrency bytes are held in memory and nothing is written to local disk.
+
+    Args:
+        s3_client (botocore.client.S3): Shared S3 client.
+        zip_path (str): Path of the downloaded export.
+        member_name (str): Name of the .gz member inside the zip.
+        AWS_BUCKET_NAME (str): Destination bucket.
+        key (str): Destination object key.
+        transfer_config (TransferConfig): Shared transfer configuration.
+
+    Returns:
+        int: Number of decompressed bytes uploaded.
+    """
+
+    # upload_fileobj reports progress from several threads, so bytes are summed afterwards
+    progress = []
+
+    # Chain zip member stream -> gzip stream -> S3 multipart upload
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref, zip_ref.open(member_name) as member, gzip.GzipFile(fileobj=member, mode='rb') as f_in:
+        s3_client.upload_fileobj(f_in, AWS_BUCKET_NAME, key, Config = transfer_config, Callback = progress.append)
+
+    return sum(progress)
+
+def amplitude_stream_to_s3(zip_folder: str, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_BUCKET_NAME, max_workers: int = 8, multipart_chunksize_mb: int = 8, multipart_concurrency: int = 4, max_pool_connections: int = None, endpoint_url: str = None, state_path: str = None, checkpoint_path: str = None, key_template: str = '', manifest_path: str = None, s3_client = None, thread_pool = None):
+    """
+    Streams every .gz member of every downloaded zip to S3 while it is being decompressed, replacing the extract -> 'extracted_data' -> upload round trip. Local disk never holds the uncompressed payload.
+    Source zips are deleted only after ALL of their members have been uploaded.
+
+    Args:
+        zip_folder (str): Name of the folder containing downloaded .zip files.
+        AWS_ACCESS_KEY (str): AWS access key from .env file
+        AWS_SECRET_KEY (str): AWS secret key from .env file
+        AWS_BUCKET_NAME (str): AWS bucket name from .env file
+        max_workers (int): Number of members streamed at the same time.
+        multipart_chunksize_mb (int): Size in MB of each multipart part, and so of each buffer held in memory.
+        multipart_concurrency (int): Number of threads used for the parts of a single member.
+        max_pool_connections (int): Connection pool size of the S3 client. Defaults to max_workers * multipart_concurrency.
+        endpoint_url (str): Optional S3-compatible endpoint, e.g. a local moto server. Defaults to AWS.
+        state_path (str): Optional watermark file used to record which export files were uploaded.
+        checkpoint_path (str): Optional checkpoint file. Archives are dropped from it once every member is uploaded.
+        key_template (str): Optional key template ('hive' or a format string, see amplitude_s3_layout). Empty uploads to the bucket root under the JSON filename.
+        manifest_path (str): Optional manifest file. Uploaded keys are recorded in it for the Snowflake load stage.
+        s3_client (botocore.client.S3): Optional shared client, e.g. one kept warm by the daemon. One is created from the keys and pool settings otherwise.
+        thread_pool (concurrent.futures.Executor): Optional thread pool shared with other projects. At most max_workers members of this call stream on it at a time. A private pool is used otherwise.
+
+    Returns:
+        bool: True if at least one member was uploaded.
+              False if no member was uploaded or no zips were found.
+    """
+
+    key_template = amplitude_key_template(key_template)
+
+    # Check that the zip_folder exists, errors and returns False if it doesn't
+    if not os.path.exists(zip_folder):
+        print(f"Error: Source folder '{zip_folder}' not found.")
+        logger.error(f"Error: Source folder '{zip_folder}' not found.")
+        return False
+
+    # Create list of all .zip files in zip_folder
+    zip_files = [f for f in os.listdir(zip_folder) if f.endswith('.zip')]
+    if not zip_files:
+        print(f"No .zip files found in '{zip_folder}'.")
+        logger.error(f"No .zip files found in '{zip_folder}'.")
+        return False
+
+    # Size the connection pool so every member worker and part thread can hold a connection
+    if max_pool_connections is None:
+        max_pool_connections = max_workers * multipart_concurrency
+
+    # S3 client and transfer settings shared by every upload. Threshold equals the part size, so any member larger than one part goes out as a multipart upload while it is still being decompressed
+    if s3_client is None:
+        s3_client = amplitude_s3_client(AWS_ACCESS_KEY, AWS_SECRET_KEY, max_pool_connections, endpoint_url)
+    transfer_config = amplitude_transfer_config(multipart_chunksize_mb, multipart_chunksize_mb, multipart_concurrency)
+
+    print(f"Starting streaming upload for {len(zip_files)} file(s)...")
+    logger.info(f"Starting streaming upload for {len(zip_files)} file(s)...")
+
+    stream_success = False
+    bytes_uploaded = 0
+    stream_start = time.perf_counter()
+
+    with BoundedExecutor(thread_pool, max_workers) as executor:
+        for zip_filename in zip_files:
+            full_zip_path = os.path.join(zip_folder, zip_filename)
+
+            try:
+                # List .gz members inside the day folder
+                with zipfile.ZipFile(full_zip_path, 'r') as zip_ref:
+                    gz_members = zip_day_members(zip_ref)
+                    zip_sizes = {os.path.basename(member_name)[:-3]: zip_ref.getinfo(member_name).compress_size for member_name in gz_members or []}
+
+                if not gz_members:
+                    print(f"Skipping {zip_filename}: no .gz members found.")
+                    logger.warning(f"Skipping {zip_filename}: no .gz members found.")
+                    continue
+
+                # Submit every member of the archive. Key is the decompressed JSON filename under key_template, matching amplitude_s3_load
+                futures = {}
+                object_keys = {}
+                for member_name in gz_members:
+                    json_name = os.path.basename(member_name)[:-3]
+                    object_keys[json_name] = amplitude_object_key(json_name, key_template)
+                    futures[json_name] = executor.submit(_stream_member_to_s3, s3_client, full_zip_path, member_name, AWS_BUCKET_NAME, object_keys[json_name], transfer_config)
+
+                # Collect member results
+                uploaded_count = 0
+                uploaded_keys = []
+                for key, future in futures.items():
+                    try:
+                        member_bytes = future.result()
+                        bytes_uploaded += member_bytes
+                        metrics_increment('amplitude_stream_to_s3', 'bytes_in', zip_sizes[key])
+                        metrics_increment('amplitude_stream_to_s3', 'bytes_out', member_bytes)
+                        metrics_increment('amplitude_stream_to_s3', 'files')
+                        uploaded_count += 1
+                        uploaded_keys.append(key)
+                        print(f"Streamed {key} to bucket:{AWS_BUCKET_NAME}.")
+                        logger.info(f"Streamed {key} to bucket:{AWS_BUCKET_NAME}.")
+                    except Exception as e:
+                        metrics_increment('amplitude_stream_to_s3', 'errors')
+                        print(f"Failed to stream {key}: {e}")
+                        logger.error(f"Failed to stream {key}: {e}")
+
+                if uploaded_count > 0:
+                    stream_success = True
+
+                # Record uploaded files, and hours of the archive that had no files at all
+                amplitude_watermark_mark_files(state_path, uploaded_keys, 'uploaded')
+                amplitude_manifest_add(manifest_path, [object_keys[key] for key in uploaded_keys])
+                amplitude_watermark_mark_archive(state_path, zip_filename, gz_members)
+
+                # Cleanup .zip file only if every member was uploaded
+                if uploaded_count == len(gz_members):
+                    os.remove(full_zip_path)
+                    amplitude_checkpoint_forget_archive(checkpoint_path, zip_filename)
+                    print(f"Cleanup: deleted files {zip_filename}")
+                    logger.info(f"Cleanup: deleted files {zip_filename}")
+                else:
+                    print(f"Keeping {zip_filename}: {len(gz_members) - uploaded_count} member(s) failed to upload.")
+                    logger.warning(f"Keeping {zip_filename}: {len(gz_members) - uploaded_count} member(s) failed to upload.")
+
+            except Exception as e:
+                print(f"Error processing {zip_filename}: {e}")
+                logger.error(f"Error processing {zip_filename}: {e}")
+
+    # Aggregate throughput across all members
+    stream_seconds = max(time.perf_counter() - stream_start, 1e-6)
+    print(f"Streamed {bytes_uploaded / MB:.1f}MB of decompressed JSON in {stream_seconds:.2f}s ({bytes_uploaded / MB / stream_seconds:.1f} MB/s).")
+    logger.info(f"Streamed {bytes_uploaded / MB:.1f}MB of decompressed JSON in {stream_seconds:.2f}s ({bytes_uploaded / MB / stream_seconds:.1f} MB/s).")
+
+    return stream_success
@@ -0,0 +1,287 @@
+# Import libraries
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from itertools import islice
+import os
+import gzip
+import json
+import shutil
+import time
+import logging
+
+# Import modules
+from modules.amplitude_metrics import metrics_increment
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Output formats and the filename suffix that replaces '.json'
+OUTPUT_EXTENSIONS = {
+    'gzip': '.json.gz',
+    'zstd': '.json.zst',
+    'parquet': '.parquet',
+}
+
+# Size of the buffer used when streaming bytes into a compressor
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Amplitude export event fields grouped by the Parquet type they are written as. Any field not listed is kept in the _extra JSON column
+INT_FIELDS = ['amplitude_id', 'app', 'event_id', 'session_id']
+FLOAT_FIELDS = ['location_lat', 'location_lng', 'sample_rate']
+BOOL_FIELDS = ['is_attribution_event', 'paying']
+TIMESTAMP_FIELDS = ['event_time', 'client_event_time', 'client_upload_time', 'server_received_time', 'server_upload_time', 'processed_time', 'user_creation_time']
+JSON_FIELDS = ['event_properties', 'user_properties', 'group_properties', 'global_user_properties', 'groups', 'data', 'plan', 'amplitude_attribution_ids']
+STRING_FIELDS = [
+    'uuid', '$insert_id', '$insert_key', '$schema', 'event_type', 'amplitude_event_type', 'user_id', 'device_id', 'adid', 'idfa',
+    'city', 'country', 'region', 'dma', 'language', 'ip_address', 'library', 'platform', 'os_name', 'os_version',
+    'device_brand', 'device_carrier', 'device_family', 'device_manufacturer', 'device_model', 'device_type',
+    'start_version', 'version_name', 'partner_id', 'source_id', 'data_type',
+]
+
+# Value converters used when building Parquet columns. Values that do not fit the column type become null rather than failing the batch
+def _to_int(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _to_float(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(value) if value is not None else None
+
+def _to_timestamp(value):
+    # Amplitude timestamps look like '2024-01-01 00:00:00.123000'
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+def _to_json(value):
+    return json.dumps(value, separators=(',', ':')) if value is not None else None
+
+def _to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, separators=(',', ':'))
+
+# Converter for every schema field
+FIELD_CONVERTERS = {}
+FIELD_CONVERTERS.update({name: _to_string for name in STRING_FIELDS})
+FIELD_CONVERTERS.update({name: _to_int for name in INT_FIELDS})
+FIELD_CONVERTERS.update({name: _to_float for name in FLOAT_FIELDS})
+FIELD_CONVERTERS.update({name: _to_bool for name in BOOL_FIELDS})
+FIELD_CONVERTERS.update({name: _to_timestamp for name in TIMESTAMP_FIELDS})
+FIELD_CONVERTERS.update({name: _to_json for name in JSON_FIELDS})
+
+def amplitude_parquet_schema():
+    """
+    Builds the Parquet schema for Amplitude export events. Nested properties are stored as JSON strings so the schema stays fixed across projects.
+
+    Returns:
+        pyarrow.Schema: Schema used for every transformed file.
+    """
+
+    import pyarrow as pa
+
+    fields = (
+        [(name, pa.string()) for name in STRING_FIELDS]
+        + [(name, pa.int64()) for name in INT_FIELDS]
+        + [(name, pa.float64()) for name in FLOAT_FIELDS]
+        + [(name, pa.bool_()) for name in BOOL_FIELDS]
+        + [(name, pa.timestamp('us')) for name in TIMESTAMP_FIELDS]
+        + [(name, pa.string()) for name in JSON_FIELDS]
+        + [('_extra', pa.string())]
+    )
+    return pa.schema(fields)
+
+def _events_to_columns(events: list):
+    """
+    Converts a batch of decoded events into a dictionary of columns matching amplitude_parquet_schema.
+
+    Args:
+        events (list): Decoded event dictionaries.
+
+    Returns:
+        dict: Column name -> list of converted values.
+    """
+
+    columns = {name: [] for name in FIELD_CONVERTERS}
+    columns['_extra'] = []
+
+    for event in events:
+        for name, convert in FIELD_CONVERTERS.items():
+            columns[name].append(convert(event.get(name)))
+
+        # Keep fields that are not part of the schema so nothing is lost
+        extra = {k: v for k, v in event.items() if k not in FIELD_CONVERTERS}
+        columns['_extra'].append(_to_json(extra) if extra else None)
+
+    return columns
+
+def _write_compressed(in_path: str, out_path: str, output_format: str, compresslevel: int):
+    """
+    Streams a JSON file through a gzip or zstd compressor in bounded chunks.
+    """
+
+    if output_format == 'gzip':
+        with open(in_path, 'rb') as f_in, gzip.open(out_path, 'wb', compresslevel=compresslevel or 6) as f_out:
+            shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+
+    elif output_format == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd output requires the 'zstandard' package: pip install zstandard")
+
+        compressor = zstandard.ZstdCompressor(level=compresslevel or 3)
+        with open(in_path, 'rb') as f_in, open(out_path, 'wb') as raw_out, compressor.stream_writer(raw_out) as f_out:
+            shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+
+def _write_parquet(in_path: str, out_path: str, batch_size: int):
+    """
+    Reads newline-delimited JSON in batches of batch_size events and appends each batch as a Parquet row group, so memory is bounded by the batch size rather than the file size.
+
+    Returns:
+        int: Number of events written.
+    """
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("parquet output requires the 'pyarrow' package: pip install pyarrow")
+
+    schema = amplitude_parquet_schema()
+    row_count = 0
+
+    with open(in_path, 'rb') as f_in, pq.ParquetWriter(out_path, schema, compression='zstd') as writer:
+        while True:
+            lines = list(islice(f_in, batch_size))
+            if not lines:
+                break
+
+            events = [json.loads(line) for line in lines if line.strip()]
+            if events:
+                writer.write_table(pa.Table.from_pydict(_events_to_columns(events), schema=schema))
+                row_count += len(events)
+
+    return row_count
+
+def _transform_file(in_path: str, output_format: str, batch_size: int, compresslevel: int):
+    """
+    Re-encodes one JSON file into output_format next to the original. The output is written to a '.part' file and renamed on success, and the source JSON is deleted only once the output is complete.
+
+    Returns:
+        dict: filename, bytes_in, bytes_out and seconds for the file.
+    """
+
+    out_path = in_path[:-len('.json')] + OUTPUT_EXTENSIONS[output_format]
+    part_path = out_path + '.part'
+    bytes_in = os.path.getsize(in_path)
+    start = time.perf_counter()
+
+    try:
+        if output_format == 'parquet':
+            _write_parquet(in_path, part_path, batch_size)
+        else:
+            _write_compressed(in_path, part_path, output_format, compresslevel)
+
+        # Move the completed file into place, then remove the uncompressed source
+        os.replace(part_path, out_path)
+        os.remove(in_path)
+
+    except Exception:
+        # Clean up partial file if it failed mid-stream
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    return {
+        'filename': os.path.basename(out_path),
+        'bytes_in': bytes_in,
+        'bytes_out': os.path.getsize(out_path),
+        'seconds': time.perf_counter() - start,
+    }
+
+def amplitude_transform(extract_folder: str, output_format: str = 'gzip', batch_size: int = 10000, compresslevel: int = None, max_workers: int = 1, executor = None):
+    """
+    Re-encodes every extracted hourly JSON file in extract_folder as gzip NDJSON, zstd NDJSON or Parquet before it is loaded to S3. Each output replaces its source file, so amplitude_s3_load uploads the smaller file under the new extension.
+
+    Args:
+        extract_folder (str): Name of the folder containing extracted JSON files.
+        output_format (str): 'gzip', 'zstd' or 'parquet'.
+        batch_size (int): Number of events held in memory per Parquet row group.
+        compresslevel (int): Compression level for gzip/zstd. Defaults to 6 for gzip and 3 for zstd.
+        max_workers (int): Number of processes used to transform files. Defaults to 1 (no pool).
+        executor (concurrent.futures.Executor): Optional process pool shared with other pipelines, used instead of a pool of max_workers. It is left running.
+
+    Returns:
+        bool: True if every JSON file was transformed.
+              False if ANY file failed.
+    """
+
+    # Validate requested format
+    if output_format not in OUTPUT_EXTENSIONS:
+        raise ValueError(f"Unsupported output_format '{output_format}'. Choose from {', '.join(OUTPUT_EXTENSIONS)}.")
+
+    # Only raw .json files are transformed, so re-running never re-encodes an output
+    json_files = [f for f in os.listdir(extract_folder) if f.endswith('.json')] if os.path.exists(extract_folder) else []
+    if not json_files:
+        print(f"No .json files found in '{extract_folder}'. Nothing to transform.")
+        logger.info(f"No .json files found in '{extract_folder}'. Nothing to transform.")
+        return True
+
+    print(f"Transforming {len(json_files)} file(s) to {output_format}...")
+    logger.info(f"Transforming {len(json_files)} file(s) to {output_format}...")
+
+    # Transform files in a process pool or inline
+    outcomes = {}
+    if executor is not None or max_workers > 1:
+        with (nullcontext(executor) if executor is not None else ProcessPoolExecutor(max_workers=max_workers)) as executor:
+            futures = {f: executor.submit(_transform_file, os.path.join(extract_folder, f), output_format, batch_size, compresslevel) for f in json_files}
+            for filename, future in futures.items():
+                try:
+                    outcomes[filename] = future.result()
+                except Exception as e:
+                    outcomes[filename] = e
+    else:
+        for filename in json_files:
+            try:
+                outcomes[filename] = _transform_file(os.path.join(extract_folder, filename), output_format, batch_size, compresslevel)
+            except Exception as e:
+                outcomes[filename] = e
+
+    # Report compression ratio and throughput per file
+    total_in = 0
+    total_out = 0
+    failed = 0
+    for filename, outcome in outcomes.items():
+        if isinstance(outcome, Exception):
+            failed += 1
+            metrics_increment('amplitude_transform', 'errors')
+            print(f"Failed to transform {filename}: {outcome}")
+            logger.error(f"Failed to transform {filename}: {outcome}")
+            continue
+
+        total_in += outcome['bytes_in']
+        total_out += outcome['bytes_out']
+        metrics_increment('amplitude_transform', 'bytes_in', outcome['bytes_in'])
+        metrics_increment('amplitude_transform', 'bytes_out', outcome['bytes_out'])
+        metrics_increment('amplitude_transform', 'files')
+        ratio = outcome['bytes_in'] / max(outcome['bytes_out'], 1)
+        mbps = outcome['bytes_in'] / 1024 / 1024 / max(outcome['seconds'], 1e-6)
+        print(f"Transformed {filename} -> {outcome['filename']}: {ratio:.1f}x compression, {mbps:.1f} MB/s.")
+        logger.info(f"Transformed {filename} -> {outcome['filename']}: {ratio:.1f}x compression, {mbps:.1f} MB/s.")
+
+    print(f"Transformed {len(json_files) - failed}/{len(json_files)} file(s): {total_in / 1024 / 1024:.1f}MB -> {total_out / 1024 / 1024:.1f}MB ({total_in / max(total_out, 1):.1f}x).")
+    logger.info(f"Transformed {len(json_files) - failed}/{len(json_files)} file(s): {total_in / 1024 / 1024:.1f}MB -> {total_out / 1024 / 1024:.1f}MB ({total_in / max(total_out, 1):.1f}x).")
+
+    return failed == 0
@@ -0,0 +1,238 @@
+# Import libraries
+from datetime import datetime, timedelta, timezone
+import os
+import re
+import json
+import threading
+import logging
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Amplitude export API hour format
+HOUR_FORMAT = '%Y%m%dT%H'
+
+# Amplitude export files are named '<project_id>_<YYYY-MM-DD>_<H>#<partition>.json.gz'
+AMPLITUDE_FILENAME = re.compile(r'^(?P<project>\d+)_(?P<date>\d{4}-\d{2}-\d{2})_(?P<hour>\d{1,2})#(?P<partition>\d+)')
+
+# Archives downloaded by amplitude_api_call are named 'amplitude_<start>_<end>.zip'
+ARCHIVE_FILENAME = re.compile(r'^amplitude_(?P<start>\d{8}T\d{2})_(?P<end>\d{8}T\d{2})')
+
+# Hours after the end of an hour before the export API is assumed to hold all of its events. Until then a 404 or a load does not make the hour complete
+AVAILABILITY_LAG_HOURS = 3
+
+# Serialises read-modify-write cycles on the state file across threads
+_state_lock = threading.Lock()
+
+def amplitude_hours_between(start_time: str, end_time: str):
+    '''
+    Lists every hour between start_time and end_time, both inclusive.
+
+    Args:
+        start_time (str): first hour in '%Y%m%dT%H' format.
+        end_time (str): last hour in '%Y%m%dT%H' format.
+
+    Returns:
+        list: hours in '%Y%m%dT%H' format.
+    '''
+
+    hour = datetime.strptime(start_time, HOUR_FORMAT)
+    last_hour = datetime.strptime(end_time, HOUR_FORMAT)
+    hours = []
+    while hour <= last_hour:
+        hours.append(hour.strftime(HOUR_FORMAT))
+        hour += timedelta(hours=1)
+    return hours
+
+def amplitude_file_hour(filename: str):
+    '''
+    Derives the export hour from an Amplitude export filename, with or without its .gz/.json/.parquet extensions.
+
+    Args:
+        filename (str): file or object name, e.g. '123456_2024-01-01_7#0.json.gz'.
+
+    Returns:
+        str: hour in '%Y%m%dT%H' format, or None if the name does not follow the Amplitude pattern.
+    '''
+
+    match = AMPLITUDE_FILENAME.match(os.path.basename(filename))
+    if not match:
+        return None
+    return f"{match.group('date').replace('-', '')}T{int(match.group('hour')):02d}"
+
+def amplitude_archive_hours(zip_filename: str):
+    '''
+    Lists the hours covered by a downloaded archive, read from its 'amplitude_<start>_<end>.zip' name.
+
+    Args:
+        zip_filename (str): archive filename.
+
+    Returns:
+        list: hours in '%Y%m%dT%H' format, or an empty list if the name does not match.
+    '''
+
+    match = ARCHIVE_FILENAME.match(os.path.basename(zip_filename))
+    if not match:
+        return []
+    return amplitude_hours_between(match.group('start'), match.group('end'))
+
+def amplitude_last_settled_hour(availability_lag_hours: int = AVAILABILITY_LAG_HOURS):
+    '''
+    Returns the last hour whose events should all be available from the export API by now. Export hours are UTC.
+
+    Args:
+        availability_lag_hours (int): hours after the end of an hour before its data is considered complete.
+
+    Returns:
+        str: hour in '%Y%m%dT%H' format.
+    '''
+
+    return (datetime.now(timezone.utc) - timedelta(hours=availability_lag_hours + 1)).strftime(HOUR_FORMAT)
+
+def amplitude_settled_hours(hours: list, availability_lag_hours: int = AVAILABILITY_LAG_HOURS):
+    '''
+    Keeps the hours that are older than the availability lag, so an hour still filling up is never recorded as empty.
+
+    Args:
+        hours (list): hours in '%Y%m%dT%H' format.
+        availability_lag_hours (int): hours after the end of an hour before its data is considered complete.
+
+    Returns:
+        list: the settled hours, in the order given.
+    '''
+
+    last_settled_hour = amplitude_last_settled_hour(availability_lag_hours)
+    return [hour for hour in hours if hour <= last_settled_hour]
+
+def _load_state(state_path: str):
+    # Missing state file means nothing has been fetched yet
+    if not os.path.exists(state_path):
+        return {'hours': {}}
+    with open(state_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _save_state(state_path: str, state: dict):
+    # Write to a temporary file and rename, so a crash never leaves a half-written state file
+    os.makedirs(os.path.dirname(state_path) or '.', exist_ok=True)
+    temp_path = f'{state_path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temp_path, state_path)
+
+def amplitude_watermark_mark_hours(state_path: str, hours: list, status: str):
+    '''
+    Records a status for whole hours: 'downloaded' once an archive covering the hour is on disk, or 'empty' when the export API has no data for it. The time of the request is kept as fetched_at (UTC), so an hour fetched before it settled is fetched again later.
+
+    Args:
+        state_path (str): path of the watermark JSON file.
+        hours (list): hours in '%Y%m%dT%H' format.
+        status (str): 'downloaded' or 'empty'.
+    '''
+
+    if not state_path or not hours:
+        return
+
+    updated_at = datetime.now().isoformat(timespec='seconds')
+    fetched_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    with _state_lock:
+        state = _load_state(state_path)
+        for hour in hours:
+            entry = state['hours'].setdefault(hour, {'files': {}})
+            entry['status'] = status
+            entry['updated_at'] = updated_at
+            entry['fetched_at'] = fetched_at
+        _save_state(state_path, state)
+
+    logger.info(f'Watermark: marked {len(hours)} hour(s) as {status}.')
+
+def amplitude_watermark_mark_files(state_path: str, filenames: list, stage: str):
+    '''
+    Records that individual export files reached a stage: 'extracted', 'uploaded', or 'empty' when filtering and dedup left no event to load. Files are keyed by name without extensions, so a transformed '.json.gz' or '.parquet' object counts for the same export file.
+
+    Args:
+        state_path (str): path of the watermark JSON file.
+        filenames (list): export file or object names.
+        stage (str): 'extracted', 'uploaded' or 'empty'.
+    '''
+
+    if not state_path or not filenames:
+        return
+
+    updated_at = datetime.now().isoformat(timespec='seconds')
+    marked = 0
+    with _state_lock:
+        state = _load_state(state_path)
+        for filename in filenames:
+            hour = amplitude_file_hour(filename)
+            if hour is None:
+                continue
+            file_key = os.path.basename(filename).split('.', 1)[0]
+            entry = state['hours'].setdefault(hour, {'status': 'downloaded', 'files': {}})
+            entry['files'][file_key] = stage
+            entry['updated_at'] = updated_at
+            marked += 1
+        _save_state(state_path, state)
+
+    logger.info(f'Watermark: marked {marked} file(s) as {stage}.')
+
+def amplitude_watermark_mark_archive(state_path: str, zip_filename: str, member_names: list):
+    '''
+    Marks hours covered by an archive that had no member files as 'empty', so they are not requested again.
+
+    Args:
+        state_path (str): path of the watermark JSON file.
+        zip_filename (str): archive filename in 'amplitude_<start>_<end>.zip' format.
+        member_names (list): names of the .gz members found in the archive.
+    '''
+
+    hours_with_files = {amplitude_file_hour(name) for name in member_names}
+    empty_hours = [hour for hour in amplitude_archive_hours(zip_filename) if hour not in hours_with_files]
+    amplitude_watermark_mark_hours(state_path, empty_hours, 'empty')
+
+def _hour_complete(hour: str, entry: dict, availability_lag_hours: int):
+    # Data fetched before the hour settled may be missing late events, so the hour stays pending. Entries without fetched_at predate the lag and are trusted
+    fetched_at = entry.get('fetched_at')
+    if fetched_at and datetime.strptime(fetched_at, '%Y-%m-%dT%H:%M:%S') < datetime.strptime(hour, HOUR_FORMAT) + timedelta(hours=availability_lag_hours + 1):
+        return False
+
+    # An hour is complete when the API had no data for it, or every one of its files has been uploaded or left nothing to upload
+    if entry.get('status') == 'empty':
+        return True
+    files = entry.get('files', {})
+    return bool(files) and all(stage in ('uploaded', 'empty') for stage in files.values())
+
+def amplitude_pending_ranges(start_time: str, end_time: str, state_path: str, exclude_hours: set = None, availability_lag_hours: int = AVAILABILITY_LAG_HOURS):
+    '''
+    Returns the hours in the start_time/end_time window that have not been fully loaded yet, merged into contiguous ranges ready for the export API.
+
+    Args:
+        start_time (str): first hour of the window in '%Y%m%dT%H' format.
+        end_time (str): last hour of the window in '%Y%m%dT%H' format.
+        state_path (str): path of the watermark JSON file.
+        exclude_hours (set): Optional hours to leave out even if incomplete, e.g. hours covered by verified archives already on disk.
+        availability_lag_hours (int): hours after the end of an hour before its data is considered complete. Hours fetched earlier stay pending.
+
+    Returns:
+        list: (range_start, range_end) tuples in '%Y%m%dT%H' format, both inclusive.
+    '''
+
+    with _state_lock:
+        state = _load_state(state_path)
+
+    # Hours that are not complete yet
+    exclude_hours = exclude_hours or set()
+    missing = [hour for hour in amplitude_hours_between(start_time, end_time) if not _hour_complete(hour, state['hours'].get(hour, {}), availability_lag_hours) and hour not in exclude_hours]
+
+    # Merge consecutive hours into ranges
+    ranges = []
+    for hour in missing:
+        if ranges and datetime.strptime(hour, HOUR_FORMAT) - datetime.strptime(ranges[-1][1], HOUR_FORMAT) == timedelta(hours=1):
+            ranges[-1] = (ranges[-1][0], hour)
+        else:
+            ranges.append((hour, hour))
+
+    total_hours = len(amplitude_hours_between(start_time, end_time))
+    print(f'Watermark: {len(missing)}/{total_hours} hour(s) in {start_time}-{end_time} still to fetch, in {len(ranges)} range(s).')
+    logger.info(f'Watermark: {len(missing)}/{total_hours} hour(s) in {start_time}-{end_time} still to fetch, in {len(ranges)} range(s).')
+
+    return ranges
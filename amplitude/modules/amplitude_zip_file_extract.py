@@ -1,21 +1,306 @@
 # Import libraries
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import datetime
+from itertools import islice
 import os
 import zipfile
 import gzip
 import shutil
 import tempfile
+import time
 import logging
 
+# Import modules
+from modules.amplitude_watermark import amplitude_watermark_mark_files, amplitude_watermark_mark_archive, amplitude_file_hour
+from modules.amplitude_checkpoint import amplitude_checkpoint_record_members, amplitude_checkpoint_extracted_members, amplitude_checkpoint_forget_archive
+from modules.amplitude_metrics import metrics_increment
+from modules.amplitude_dedup import DedupIndex
+from modules.amplitude_event_filter import EventFilter
+
 # Define the logger
 logger = logging.getLogger(__name__)
 
-def amplitude_zip_file_extract(zip_folder:str):
+# Size of the buffer used when copying decompressed bytes to the output file
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Number of event lines validated and checked against the dedup index per batch
+LINE_BATCH_SIZE = 10000
+
+def zip_day_members(zip_ref: zipfile.ZipFile):
+    """
+    Lists the .gz members inside the day folder of an Amplitude export without extracting anything to disk.
+    Uses the same folder selection as the temp-directory path: numeric folder first, otherwise the first folder.
+
+    Args:
+        zip_ref (zipfile.ZipFile): Open handle on the downloaded export.
+
+    Returns:
+        list: Member names of the .gz files, or None if the zip has no internal folder.
+    """
+
+    # Top-level folders are the first path component of any member that sits inside a folder
+    internal_folders = []
+    for name in zip_ref.namelist():
+        if '/' in name:
+            folder = name.split('/', 1)[0]
+            if folder not in internal_folders:
+                internal_folders.append(folder)
+
+    # No folders inside the main .zip
+    if not internal_folders:
+        return None
+
+    # Select numeric folder first or first folder if no numeric
+    day_folder = next((f for f in internal_folders if f.isdigit()), internal_folders[0])
+
+    # Every .gz member below the day folder, at any depth
+    return [
+        info.filename for info in zip_ref.infolist()
+        if not info.is_dir() and info.filename.startswith(f'{day_folder}/') and info.filename.endswith('.gz')
+    ]
+
+def _extract_gz_member(zip_path: str, member_name: str, extract_folder: str, dedup_dir: str = None, event_filter: EventFilter = None):
+    """
+    Decompresses a single .gz member straight from the zip into extract_folder. The member is read with ZipFile.open and gunzipped on the fly, so nothing is written to disk except the final JSON file.
+    The output is written to a '.part' file and renamed once complete; the partial file is deleted if decompression fails.
+
+    With event_filter or dedup_dir, events are read in batches of lines. event_filter validates and trims them, writing bad lines to its quarantine folder, and the hour's dedup index drops events emitted before. If some events were already emitted, the file is given a '.rerun-<timestamp>' suffix so it never overwrites the earlier object in S3. If no event is left, no file is written.
+
+    Args:
+        zip_path (str): Path of the downloaded export.
+        member_name (str): Name of the .gz member inside the zip.
+        extract_folder (str): Folder the decompressed JSON file is written to.
+        dedup_dir (str): Optional folder holding the dedup index.
+        event_filter (EventFilter): Optional validation and filtering of events.
+
+    Returns:
+        dict: json_name (None if no event was left), bytes_in (compressed size of the member), bytes_out (decompressed bytes written), duplicates, filtered and quarantined (events removed), seconds (wall time) and cpu_seconds spent on the member.
+    """
+
+    # Create json filename from the member's base name
+    json_name = os.path.basename(member_name)[:-3]
+    out_path = os.path.join(extract_folder, json_name)
+    part_path = f'{out_path}.part'
+    hour = amplitude_file_hour(json_name) if dedup_dir else None
+    by_line = hour is not None or event_filter is not None
+    duplicates = filtered = quarantined = 0
+    quarantine_file = None
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    try:
+        if not by_line:
+            # Chain zip member stream -> gzip stream -> output file, copying in bounded chunks
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref, zip_ref.open(member_name) as member, gzip.GzipFile(fileobj=member, mode='rb') as f_in, open(part_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+                bytes_written = f_out.tell()
+                bytes_read = zip_ref.getinfo(member_name).compress_size
+
+            # Move the complete file into place, so an interrupted run never leaves a truncated JSON file behind
+            os.replace(part_path, out_path)
+
+        else:
+            # Claimed keys are marked seen only after the output file is in place, so a failure never marks events as seen
+            with DedupIndex(dedup_dir, hour, json_name) if hour is not None else nullcontext() as index:
+                events_out = 0
+                with zipfile.ZipFile(zip_path, 'r') as zip_ref, zip_ref.open(member_name) as member, gzip.GzipFile(fileobj=member, mode='rb') as f_in, open(part_path, 'wb') as f_out:
+                    while lines := list(islice(f_in, LINE_BATCH_SIZE)):
+                        if event_filter is not None:
+                            lines, dropped, bad_lines = event_filter.filter_lines(lines)
+                            filtered += dropped
+                            quarantined += len(bad_lines)
+                            if bad_lines:
+                                if quarantine_file is None:
+                                    os.makedirs(event_filter.quarantine_dir, exist_ok=True)
+                                    quarantine_file = open(os.path.join(event_filter.quarantine_dir, json_name), 'wb')
+                                quarantine_file.writelines(bad_lines)
+                        if index is not None:
+                            lines = index.filter_new(lines)
+                        f_out.writelines(lines)
+                        events_out += len(lines)
+                    bytes_written = f_out.tell()
+                    bytes_read = zip_ref.getinfo(member_name).compress_size
+
+                if index is not None:
+                    duplicates = index.events_in - index.events_out
+                if events_out == 0:
+                    os.remove(part_path)
+                    json_name = None
+                else:
+                    if duplicates:
+                        json_name = f"{json_name[:-len('.json')]}.rerun-{datetime.now().strftime('%Y%m%dT%H%M%S')}.json"
+                        out_path = os.path.join(extract_folder, json_name)
+                    os.replace(part_path, out_path)
+
+    except Exception:
+        # Clean up partial file if it failed mid-stream
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    finally:
+        if quarantine_file is not None:
+            quarantine_file.close()
+
+    return {'json_name': json_name, 'bytes_in': bytes_read, 'bytes_out': bytes_written, 'duplicates': duplicates, 'filtered': filtered, 'quarantined': quarantined, 'seconds': time.perf_counter() - start, 'cpu_seconds': time.process_time() - cpu_start}
+
+def _extract_archive(full_zip_path: str, extract_folder: str, executor=None, state_path: str = None, checkpoint_path: str = None, dedup_dir: str = None, event_filter: EventFilter = None):
     """
-    Scans 'downloaded_data' for zips, extracts JSONs to 'extracted_data',
+    Extracts every .gz member of one export into extract_folder. Members are submitted to executor when one is given, otherwise they are decompressed one by one in this process.
+    The source zip is deleted only after ALL members have been extracted.
+
+    Args:
+        full_zip_path (str): Path of the downloaded export.
+        extract_folder (str): Folder the decompressed JSON files are written to.
+        executor (concurrent.futures.Executor): Optional pool used to decompress members in parallel.
+        state_path (str): Optional watermark file. Extracted files are marked 'extracted' and hours without files 'empty'.
+        checkpoint_path (str): Optional checkpoint file. Members are recorded as they finish, and members already extracted by an earlier run are skipped.
+        dedup_dir (str): Optional dedup index folder. Events already emitted by an earlier run are dropped.
+        event_filter (EventFilter): Optional validation and filtering of events.
+
+    Returns:
+        bool: True if at least one member was extracted.
+              False if no member was extracted.
+    """
+
+    zip_filename = os.path.basename(full_zip_path)
+    archive_start = time.perf_counter()
+
+    try:
+        # List .gz members inside the day folder
+        with zipfile.ZipFile(full_zip_path, "r") as zip_ref:
+            gz_members = zip_day_members(zip_ref)
+
+        # Error if there were no folders inside main .zip
+        if gz_members is None:
+            print(f"Skipping {zip_filename} extract process: No internal folder found.")
+            logger.warning(f"Skipping {zip_filename} extract process: No internal folder found.")
+            return False
+
+        # Members finished by an earlier run are resumed rather than decompressed again
+        done_members = amplitude_checkpoint_extracted_members(checkpoint_path, zip_filename, extract_folder)
+        if done_members:
+            print(f"Checkpoint: skipping {len(done_members)} member(s) of {zip_filename} already extracted.")
+            logger.info(f"Checkpoint: skipping {len(done_members)} member(s) of {zip_filename} already extracted.")
+        todo_members = [member_name for member_name in gz_members if member_name not in done_members]
+
+        # Fan members out to the pool, or run them inline when there is no pool. Each member is checkpointed as soon as it finishes
+        outcomes = {}
+        if executor is not None:
+            futures = {executor.submit(_extract_gz_member, full_zip_path, member_name, extract_folder, dedup_dir, event_filter): member_name for member_name in todo_members}
+            for future in as_completed(futures):
+                try:
+                    outcomes[futures[future]] = future.result()
+                    amplitude_checkpoint_record_members(checkpoint_path, zip_filename, [(futures[future], outcomes[futures[future]]['json_name'], outcomes[futures[future]]['bytes_out'])])
+                except Exception as e:
+                    outcomes[futures[future]] = e
+        else:
+            for member_name in todo_members:
+                try:
+                    outcomes[member_name] = _extract_gz_member(full_zip_path, member_name, extract_folder, dedup_dir, event_filter)
+                    amplitude_checkpoint_record_members(checkpoint_path, zip_filename, [(member_name, outcomes[member_name]['json_name'], outcomes[member_name]['bytes_out'])])
+                except Exception as e:
+                    outcomes[member_name] = e
+
+        # Log each member outcome with its throughput
+        file_count = 0
+        member_seconds = 0.0
+        bytes_out = 0
+        duplicates = filtered = quarantined = 0
+        for member_name, outcome in outcomes.items():
+            if isinstance(outcome, Exception):
+                metrics_increment('amplitude_zip_file_extract', 'errors')
+                print(f"Error extracting {member_name}: {outcome}")
+                logger.error(f"Error extracting {member_name}: {outcome}")
+                continue
+
+            # Increment only on file extract success
+            file_count += 1
+            member_seconds += outcome['cpu_seconds']
+            bytes_out += outcome['bytes_out']
+            metrics_increment('amplitude_zip_file_extract', 'bytes_in', outcome['bytes_in'])
+            metrics_increment('amplitude_zip_file_extract', 'bytes_out', outcome['bytes_out'])
+            for counter in ('duplicates', 'filtered', 'quarantined'):
+                metrics_increment('amplitude_zip_file_extract', counter, outcome[counter])
+            duplicates += outcome['duplicates']
+            filtered += outcome['filtered']
+            quarantined += outcome['quarantined']
+
+            # No event of the member was left to load, so there is no file
+            if outcome['json_name'] is None:
+                print(f"Skipped {member_name}: no events left ({outcome['duplicates']} already emitted, {outcome['filtered']} filtered, {outcome['quarantined']} quarantined).")
+                logger.info(f"Skipped {member_name}: no events left ({outcome['duplicates']} already emitted, {outcome['filtered']} filtered, {outcome['quarantined']} quarantined).")
+                continue
+
+            metrics_increment('amplitude_zip_file_extract', 'files')
+            member_mbps = outcome['bytes_out'] / 1024 / 1024 / max(outcome['seconds'], 1e-6)
+            print(f"Extracted {outcome['json_name']} to {extract_folder} in {outcome['seconds']:.2f}s ({member_mbps:.1f} MB/s).")
+            logger.info(f"Extracted {outcome['json_name']} to {extract_folder} in {outcome['seconds']:.2f}s ({member_mbps:.1f} MB/s).")
+
+        # Record extracted files, members that left no events to load, and hours of the archive that had no files at all
+        amplitude_watermark_mark_files(state_path, [outcome['json_name'] for outcome in outcomes.values() if not isinstance(outcome, Exception) and outcome['json_name']], 'extracted')
+        amplitude_watermark_mark_files(state_path, [member_name for member_name, outcome in outcomes.items() if not isinstance(outcome, Exception) and outcome['json_name'] is None], 'empty')
+        amplitude_watermark_mark_archive(state_path, zip_filename, gz_members)
+
+        if duplicates:
+            print(f"Dedup: dropped {duplicates} event(s) of {zip_filename} already emitted by an earlier run.")
+            logger.info(f"Dedup: dropped {duplicates} event(s) of {zip_filename} already emitted by an earlier run.")
+        if filtered or quarantined:
+            print(f"Event filter: dropped {filtered} event(s) of {zip_filename} and quarantined {quarantined} invalid line(s).")
+            logger.info(f"Event filter: dropped {filtered} event(s) of {zip_filename} and quarantined {quarantined} invalid line(s).")
+
+        # Resumed members count towards the archive being complete
+        file_count += len(done_members)
+
+        if file_count == 0:
+            print(f"Warning: {zip_filename} contained no .gz files.")
+            logger.warning(f"Warning: {zip_filename} contained no .gz files.")
+            return False
+
+        # Speedup is the CPU time spent decompressing members divided by the wall time actually spent on the archive
+        archive_seconds = max(time.perf_counter() - archive_start, 1e-6)
+        print(f"Extracted {file_count}/{len(gz_members)} files from {zip_filename} in {archive_seconds:.2f}s ({bytes_out / 1024 / 1024 / archive_seconds:.1f} MB/s, {member_seconds / archive_seconds:.2f}x speedup over serial).")
+        logger.info(f"Extracted {file_count}/{len(gz_members)} files from {zip_filename} in {archive_seconds:.2f}s ({bytes_out / 1024 / 1024 / archive_seconds:.1f} MB/s, {member_seconds / archive_seconds:.2f}x speedup over serial).")
+
+        # Cleanup .zip file only if every member was extracted successfully
+        if file_count == len(gz_members):
+            if os.path.exists(full_zip_path):
+                os.remove(full_zip_path)
+                amplitude_checkpoint_forget_archive(checkpoint_path, zip_filename)
+                print(f"Cleanup: deleted files {zip_filename}")
+                logger.info(f"Cleanup: deleted files {zip_filename}")
+        else:
+            print(f"Keeping {zip_filename}: {len(gz_members) - file_count} member(s) failed to extract.")
+            logger.warning(f"Keeping {zip_filename}: {len(gz_members) - file_count} member(s) failed to extract.")
+
+        return True
+
+    except Exception as e:
+        # Error message if a file extraction fails
+        print(f"Error processing {zip_filename}: {e}")
+        logger.error(f"Error processing {zip_filename}: {e}")
+        return False
+
+def amplitude_zip_file_extract(zip_folder:str, streaming: bool = True, max_workers: int = 1, state_path: str = None, checkpoint_path: str = None, dedup_dir: str = None, event_filter: EventFilter = None, extract_folder: str = 'extracted_data', executor = None):
+    """
+    Scans zip_folder for zips, extracts JSONs to extract_folder,
     and deletes source zips upon success.
+
+    In streaming mode each .gz member is read directly from the zip and decompressed into extract_folder in a single pass.
+    Otherwise the zip is first extracted to a temporary directory and each .gz file is decompressed from there.
+    In streaming mode, max_workers > 1 decompresses members in a process pool so a day's export uses several cores.
     
     Args:
         zip_folder (str): Name of the folder containing downloaded .zip files.
+        streaming (bool): If True, decompress members straight from the zip without the temporary directory round trip. Defaults to True.
+        max_workers (int): Number of processes used to decompress members in streaming mode. Defaults to 1 (no pool).
+        state_path (str): Optional watermark file used to record which export files were extracted.
+        checkpoint_path (str): Optional checkpoint file used to resume partially extracted archives in streaming mode.
+        dedup_dir (str): Optional dedup index folder used in streaming mode to drop events already emitted by an earlier run.
+        event_filter (EventFilter): Optional validation and filtering of events in streaming mode, see amplitude_event_filter.
+        extract_folder (str): Folder the JSON files are written to. Defaults to 'extracted_data'.
+        executor (concurrent.futures.Executor): Optional process pool shared with other pipelines, used in streaming mode instead of a pool of max_workers. It is left running.
 
     Returns:
         bool: True if ALL found files were processed and cleaned up successfully.
@@ -28,8 +313,7 @@ def amplitude_zip_file_extract(zip_folder:str):
         logger.error(f"Error: Source folder '{zip_folder}' not found.")
         return False
 
-    # Create extracted_data folder if it doesn't already exist
-    extract_folder = "extracted_data"
+    # Create extract folder if it doesn't already exist
     os.makedirs(extract_folder, exist_ok=True)
 
     # Create list of all .zip files in zip_folder
@@ -48,10 +332,20 @@ def amplitude_zip_file_extract(zip_folder:str):
     # Set extract success flag - defaults to False, becomes True if we successfully write even a single file to destination.
     extract_success = False
 
+    # Single-pass path: decompress members straight from the zip, fanned out across processes when max_workers > 1
+    if streaming:
+        with (nullcontext(executor) if executor is not None else ProcessPoolExecutor(max_workers=max_workers) if max_workers > 1 else nullcontext()) as executor:
+            for zip_filename in zip_files:
+                if _extract_archive(os.path.join(zip_folder, zip_filename), extract_folder, executor, state_path, checkpoint_path, dedup_dir, event_filter):
+                    extract_success = True
+
+        # Return extract_success status - this will inform logic in main.py
+        return extract_success
+
     # Loop that extracts json files from nested .zip files. If successful, cleans the .zip file by deletion.
     for zip_filename in zip_files:
         full_zip_path = os.path.join(zip_folder, zip_filename)
-
+        
         # Create temporary directory
         temp_dir = tempfile.mkdtemp()
         print("Created temporary directory to extract .zip files to")
@@ -102,8 +396,13 @@ def amplitude_zip_file_extract(zip_folder:str):
                             
                             # Increment only on file extract success
                             file_count += 1
+                            amplitude_watermark_mark_files(state_path, [json_name], 'extracted')
+                            metrics_increment('amplitude_zip_file_extract', 'bytes_in', os.path.getsize(gz_path))
+                            metrics_increment('amplitude_zip_file_extract', 'bytes_out', os.path.getsize(out_path))
+                            metrics_increment('amplitude_zip_file_extract', 'files')
                             
                         except Exception as e:
+                            metrics_increment('amplitude_zip_file_extract', 'errors')
                             print(f"Error extracting {file}: {e}")
                             logger.error(f"Error extracting {file}: {e}")
                             # Clean up partial file if it failed mid-stream
@@ -0,0 +1,6 @@
+# Import libraries
+import os
+import sys
+
+# Modules are imported as 'modules.<name>', as main.py does, so the project folder goes on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
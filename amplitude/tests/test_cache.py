@@ -0,0 +1,132 @@
+# Import libraries
+from datetime import datetime, timedelta, timezone
+import json
+import os
+
+# Import modules
+from benchmarks.mock_export_server import MockExportServer
+from modules.amplitude_api_call import amplitude_api_call
+from modules.amplitude_watermark import HOUR_FORMAT
+from modules.amplitude_cache import amplitude_cache_store_archive, amplitude_cache_fetch_archive, amplitude_cache_evict, amplitude_cache_record_objects, amplitude_cache_object_matches, CACHE_INDEX, ARCHIVES_DIR
+from modules.amplitude_checkpoint import file_sha256
+
+def _archive(folder, zip_filename: str, data: bytes):
+    os.makedirs(folder, exist_ok=True)
+    filepath = os.path.join(folder, zip_filename)
+    with open(filepath, 'wb') as f:
+        f.write(data)
+    return filepath
+
+def _store(cache_dir: str, filepath: str, AMP_API_KEY: str = 'key-web'):
+    amplitude_cache_store_archive(cache_dir, filepath, file_sha256(filepath), os.path.getsize(filepath), AMP_API_KEY)
+
+def _index(cache_dir: str):
+    with open(os.path.join(cache_dir, CACHE_INDEX), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _set_used_at(cache_dir: str, used_at: dict):
+    # Orders entries for LRU eviction without waiting between stores
+    index = _index(cache_dir)
+    for archive_key, record in index['archives'].items():
+        record['used_at'] = used_at[archive_key.split('/', 1)[1]]
+    with open(os.path.join(cache_dir, CACHE_INDEX), 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+
+def test_archive_is_only_served_to_the_project_that_stored_it(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    _store(cache_dir, _archive(tmp_path / 'web', 'amplitude_20240101T00_20240101T05.zip', b'web export'), 'key-web')
+
+    target = str(tmp_path / 'downloaded_data' / 'amplitude_20240101T00_20240101T05.zip')
+    os.makedirs(os.path.dirname(target))
+    assert amplitude_cache_fetch_archive(cache_dir, target, 'key-app') is None
+    assert not os.path.exists(target)
+
+    assert amplitude_cache_fetch_archive(cache_dir, target, 'key-web') == (file_sha256(target), len(b'web export'))
+    with open(target, 'rb') as f:
+        assert f.read() == b'web export'
+
+    # The API key itself is never written to the index
+    assert 'key-web' not in json.dumps(_index(cache_dir))
+
+def test_damaged_entry_is_dropped(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    filepath = _archive(tmp_path / 'web', 'amplitude_20240101T00_20240101T05.zip', b'web export')
+    _store(cache_dir, filepath)
+
+    # Same size, different content, so only the checksum catches it
+    archive_path = os.path.join(cache_dir, ARCHIVES_DIR, f'{file_sha256(filepath)}.zip')
+    os.remove(archive_path)
+    with open(archive_path, 'wb') as f:
+        f.write(b'web exporT')
+
+    target = str(tmp_path / 'amplitude_20240101T00_20240101T05.zip')
+    assert amplitude_cache_fetch_archive(cache_dir, target, 'key-web') is None
+    assert not os.path.exists(target)
+    assert _index(cache_dir)['archives'] == {}
+
+def test_eviction_counts_shared_content_once(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    shared = b's' * 400 * 1024
+    _store(cache_dir, _archive(tmp_path / 'a', 'amplitude_20240101T00_20240101T05.zip', shared))
+    _store(cache_dir, _archive(tmp_path / 'b', 'amplitude_20240101T06_20240101T11.zip', shared))
+    _store(cache_dir, _archive(tmp_path / 'c', 'amplitude_20240101T12_20240101T17.zip', b'u' * 400 * 1024))
+    _set_used_at(cache_dir, {'amplitude_20240101T00_20240101T05.zip': '2024-01-01T00:00:00', 'amplitude_20240101T06_20240101T11.zip': '2024-01-03T00:00:00', 'amplitude_20240101T12_20240101T17.zip': '2024-01-02T00:00:00'})
+
+    # 800KB of distinct content fits in 1MB, although the three windows add up to 1.2MB
+    assert amplitude_cache_evict(cache_dir, max_size_mb=1)['archives'] == 0
+    assert len(_index(cache_dir)['archives']) == 3
+
+def test_eviction_drops_least_recently_used_and_deletes_unreferenced_files(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    old = _archive(tmp_path / 'a', 'amplitude_20240101T00_20240101T05.zip', b'o' * 700 * 1024)
+    new = _archive(tmp_path / 'b', 'amplitude_20240101T06_20240101T11.zip', b'n' * 700 * 1024)
+    _store(cache_dir, old)
+    _store(cache_dir, new)
+    _set_used_at(cache_dir, {'amplitude_20240101T00_20240101T05.zip': '2024-01-01T00:00:00', 'amplitude_20240101T06_20240101T11.zip': '2024-01-02T00:00:00'})
+
+    # A file left by an entry evicted earlier
+    orphan = os.path.join(cache_dir, ARCHIVES_DIR, f"{'0' * 64}.zip")
+    with open(orphan, 'wb') as f:
+        f.write(b'orphan')
+
+    summary = amplitude_cache_evict(cache_dir, max_size_mb=1)
+
+    assert summary['archives'] == 1
+    assert [key.split('/', 1)[1] for key in _index(cache_dir)['archives']] == ['amplitude_20240101T06_20240101T11.zip']
+    assert sorted(os.listdir(os.path.join(cache_dir, ARCHIVES_DIR))) == [f'{file_sha256(new)}.zip']
+    assert not os.path.exists(orphan)
+
+def test_expired_entries_are_evicted(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    _store(cache_dir, _archive(tmp_path / 'a', 'amplitude_20240101T00_20240101T05.zip', b'export'))
+    amplitude_cache_record_objects(cache_dir, 'bucket', [('key.json', '"etag"', 10)])
+    assert amplitude_cache_object_matches(cache_dir, 'bucket', 'key.json', 10, '"etag"')
+
+    index = _index(cache_dir)
+    for section in ('archives', 'objects'):
+        for record in index[section].values():
+            record['cached_at'] = '2024-01-01T00:00:00'
+    with open(os.path.join(cache_dir, CACHE_INDEX), 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+
+    assert amplitude_cache_evict(cache_dir, max_age_days=7) == {'archives': 1, 'objects': 1, 'mb_freed': len(b'export') / 1024 / 1024}
+    assert not amplitude_cache_object_matches(cache_dir, 'bucket', 'key.json', 10, '"etag"')
+    assert os.listdir(os.path.join(cache_dir, ARCHIVES_DIR)) == []
+
+def test_only_settled_windows_go_through_the_cache(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    download_dir = str(tmp_path / 'downloaded_data')
+
+    with MockExportServer(events_per_hour=10) as server:
+        # A settled window is exported once, then served from the cache
+        for _ in range(2):
+            assert amplitude_api_call(server.url, '20240101T00', '20240101T01', 'key-web', 'secret', 1, download_dir=download_dir, cache_dir=cache_dir)
+        assert server.requests['total'] == 1
+
+        # A window still inside the availability lag is exported every time and never cached
+        recent_hour = (datetime.now(timezone.utc) - timedelta(hours=1)).strftime(HOUR_FORMAT)
+        for _ in range(2):
+            assert amplitude_api_call(server.url, recent_hour, recent_hour, 'key-web', 'secret', 1, download_dir=download_dir, cache_dir=cache_dir, availability_lag_hours=3)
+        assert server.requests['total'] == 3
+
+    assert [key.split('/', 1)[1] for key in _index(cache_dir)['archives']] == ['amplitude_20240101T00_20240101T01.zip']
@@ -0,0 +1,93 @@
+# Import libraries
+import gzip
+import json
+import os
+import zipfile
+
+# Import modules
+from modules import amplitude_zip_file_extract as zip_file_extract
+from modules.amplitude_checkpoint import amplitude_checkpoint_record_archive, amplitude_checkpoint_record_members, amplitude_checkpoint_extracted_members, amplitude_checkpoint_verified_hours, file_sha256
+from modules.amplitude_zip_file_extract import amplitude_zip_file_extract
+
+ZIP_FILENAME = 'amplitude_20240101T00_20240101T01.zip'
+MEMBERS = ['123456/123456_2024-01-01_0#0.json.gz', '123456/123456_2024-01-01_1#0.json.gz']
+
+def _build_export(download_dir):
+    # Two hourly members with two events each, laid out like an Amplitude export
+    os.makedirs(download_dir, exist_ok=True)
+    zip_path = os.path.join(download_dir, ZIP_FILENAME)
+    with zipfile.ZipFile(zip_path, 'w') as zip_ref:
+        for hour, member_name in enumerate(MEMBERS):
+            events = [json.dumps({'uuid': f'{hour}-{event}', 'event_type': 'click'}) for event in range(2)]
+            zip_ref.writestr(member_name, gzip.compress(('\n'.join(events) + '\n').encode('utf-8')))
+    return zip_path
+
+def test_rerun_resumes_at_the_member_that_failed(monkeypatch, tmp_path):
+    download_dir = str(tmp_path / 'downloaded_data')
+    extract_folder = str(tmp_path / 'extracted_data')
+    checkpoint_path = str(tmp_path / 'state' / 'checkpoint.json')
+    zip_path = _build_export(download_dir)
+
+    # The first run fails on the second member
+    extract_member = zip_file_extract._extract_gz_member
+    extracted = []
+
+    def failing_extract(zip_path, member_name, *args):
+        extracted.append(member_name)
+        if member_name == MEMBERS[1]:
+            raise OSError('disk full')
+        return extract_member(zip_path, member_name, *args)
+
+    monkeypatch.setattr(zip_file_extract, '_extract_gz_member', failing_extract)
+    amplitude_zip_file_extract(download_dir, checkpoint_path=checkpoint_path, extract_folder=extract_folder)
+
+    assert os.path.exists(zip_path)
+    assert amplitude_checkpoint_extracted_members(checkpoint_path, ZIP_FILENAME, extract_folder) == {MEMBERS[0]}
+
+    # The rerun only extracts the member that failed, then deletes the archive and forgets it
+    extracted.clear()
+    monkeypatch.setattr(zip_file_extract, '_extract_gz_member', lambda zip_path, member_name, *args: extracted.append(member_name) or extract_member(zip_path, member_name, *args))
+    assert amplitude_zip_file_extract(download_dir, checkpoint_path=checkpoint_path, extract_folder=extract_folder)
+
+    assert extracted == [MEMBERS[1]]
+    assert not os.path.exists(zip_path)
+    assert sorted(os.listdir(extract_folder)) == ['123456_2024-01-01_0#0.json', '123456_2024-01-01_1#0.json']
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        assert json.load(f)['archives'] == {}
+
+def test_member_is_extracted_again_when_its_output_changed(tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    extract_folder = tmp_path / 'extracted_data'
+    extract_folder.mkdir()
+    amplitude_checkpoint_record_members(checkpoint_path, ZIP_FILENAME, [
+        (MEMBERS[0], '123456_2024-01-01_0#0.json', 10),
+        (MEMBERS[1], '123456_2024-01-01_1#0.rerun-20240102T000000.json', 10),
+        ('123456/123456_2024-01-01_1#1.json.gz', None, 0),
+        ('123456/123456_2024-01-01_1#2.json.gz', '123456_2024-01-01_1#2.json', 10),
+    ])
+
+    # Truncated output, output re-encoded by the transform stage, member that left no events, output gone
+    (extract_folder / '123456_2024-01-01_0#0.json').write_bytes(b'12345')
+    (extract_folder / '123456_2024-01-01_1#0.rerun-20240102T000000.parquet').write_bytes(b'parquet')
+
+    assert amplitude_checkpoint_extracted_members(checkpoint_path, ZIP_FILENAME, str(extract_folder)) == {MEMBERS[1], '123456/123456_2024-01-01_1#1.json.gz'}
+
+def test_only_archives_matching_their_checksum_are_kept(tmp_path):
+    download_dir = str(tmp_path / 'downloaded_data')
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    zip_path = _build_export(download_dir)
+    amplitude_checkpoint_record_archive(checkpoint_path, zip_path, file_sha256(zip_path), os.path.getsize(zip_path))
+
+    # A second archive was left half-written and never recorded
+    partial_path = os.path.join(download_dir, 'amplitude_20240101T02_20240101T03.zip')
+    with open(partial_path, 'wb') as f:
+        f.write(b'PK')
+
+    assert amplitude_checkpoint_verified_hours(checkpoint_path, download_dir) == {'20240101T00', '20240101T01'}
+    assert os.path.exists(zip_path) and not os.path.exists(partial_path)
+
+    # A recorded archive whose content changed is deleted too
+    with open(zip_path, 'ab') as f:
+        f.write(b'x')
+    assert amplitude_checkpoint_verified_hours(checkpoint_path, download_dir) == set()
+    assert not os.path.exists(zip_path)
@@ -0,0 +1,64 @@
+# Import libraries
+import json
+import pytest
+
+# Import modules
+from modules.amplitude_dedup import event_key, DedupIndex
+
+def _line(event: dict):
+    return json.dumps(event).encode('utf-8') + b'\n'
+
+def test_key_uses_top_level_uuid_not_nested_ones():
+    # Property objects may carry their own 'uuid', which must not decide the key
+    first = _line({'event_properties': {'uuid': 'shared'}, 'uuid': 'a'})
+    second = _line({'event_properties': {'uuid': 'shared'}, 'uuid': 'b'})
+    nested_only = _line({'user_properties': {'uuid': 'a'}})
+
+    assert event_key(first) != event_key(second)
+    assert event_key(first) == event_key(_line({'uuid': 'a', 'event_type': 'other'}))
+    assert event_key(nested_only) is None
+
+def test_key_falls_back_to_insert_id():
+    assert event_key(_line({'$insert_id': 'x'})) == event_key(_line({'uuid': 'x'}))
+    assert event_key(_line({'uuid': None, '$insert_id': 'x'})) == event_key(_line({'$insert_id': 'x'}))
+
+def test_key_of_invalid_line_is_none():
+    assert event_key(b'not json\n') is None
+    assert event_key(b'[1, 2]\n') is None
+
+def test_events_seen_by_an_earlier_member_are_dropped(tmp_path):
+    lines = [_line({'uuid': 'a'}), _line({'uuid': 'b'}), _line({'uuid': 'a'}), _line({'event_type': 'no id'})]
+
+    with DedupIndex(str(tmp_path), '20240101T00', 'first.json') as index:
+        assert index.filter_new(lines) == [lines[0], lines[1], lines[3]]
+
+    with DedupIndex(str(tmp_path), '20240101T00', 'second.json') as index:
+        assert index.filter_new([_line({'uuid': 'b'}), _line({'uuid': 'c'})]) == [_line({'uuid': 'c'})]
+        assert (index.events_in, index.events_out) == (2, 1)
+
+    # Other hours have their own partition
+    with DedupIndex(str(tmp_path), '20240101T01', 'third.json') as index:
+        assert index.filter_new([_line({'uuid': 'a'})]) == [_line({'uuid': 'a'})]
+
+def test_keys_claimed_by_a_running_partition_are_not_emitted_twice(tmp_path):
+    with DedupIndex(str(tmp_path), '20240101T00', 'part0.json') as first, DedupIndex(str(tmp_path), '20240101T00', 'part1.json') as second:
+        assert first.filter_new([_line({'uuid': 'a'})]) == [_line({'uuid': 'a'})]
+        assert second.filter_new([_line({'uuid': 'a'}), _line({'uuid': 'b'})]) == [_line({'uuid': 'b'})]
+
+def test_failed_extraction_does_not_mark_events_seen(tmp_path):
+    with pytest.raises(OSError):
+        with DedupIndex(str(tmp_path), '20240101T00', 'failed.json') as index:
+            index.filter_new([_line({'uuid': 'a'})])
+            raise OSError('disk full')
+
+    with DedupIndex(str(tmp_path), '20240101T00', 'failed.json') as index:
+        assert index.filter_new([_line({'uuid': 'a'})]) == [_line({'uuid': 'a'})]
+
+def test_claims_left_by_a_crashed_run_are_released_on_rerun(tmp_path):
+    # A crash leaves the claims behind without running __exit__
+    crashed = DedupIndex(str(tmp_path), '20240101T00', 'member.json').__enter__()
+    crashed.filter_new([_line({'uuid': 'a'})])
+    crashed.connection.close()
+
+    with DedupIndex(str(tmp_path), '20240101T00', 'member.json') as index:
+        assert index.filter_new([_line({'uuid': 'a'})]) == [_line({'uuid': 'a'})]
@@ -0,0 +1,50 @@
+# Import libraries
+import json
+import pytest
+
+# Import modules
+from modules.amplitude_event_filter import amplitude_event_filter, EventFilter
+
+def _line(event: dict):
+    return json.dumps(event).encode('utf-8') + b'\n'
+
+def test_invalid_lines_and_missing_fields_are_quarantined():
+    event_filter = EventFilter(required_fields=('event_type', 'uuid'))
+    kept, dropped, quarantined = event_filter.filter_lines([b'not json\n', b'[1]\n', _line({'event_type': 'click', 'uuid': ''}), _line({'event_type': 'click', 'uuid': 'a'}), b'\n'])
+
+    assert kept == [_line({'event_type': 'click', 'uuid': 'a'})]
+    assert dropped == 0
+    assert [json.loads(record)['reason'] for record in quarantined] == ['invalid_json', 'invalid_json', 'missing:uuid']
+    assert json.loads(quarantined[0])['line'] == 'not json'
+
+def test_dropped_event_types_and_values():
+    event_filter = amplitude_event_filter(drop_event_types='test_event', drop_where='device_id=qa-device,app=123456,is_test=true')
+    lines = [
+        _line({'event_type': 'test_event'}),
+        _line({'event_type': 'click', 'device_id': 'qa-device'}),
+        _line({'event_type': 'click', 'app': 123456}),
+        _line({'event_type': 'click', 'is_test': True}),
+        _line({'event_type': 'click', 'app': 654321, 'is_test': False}),
+    ]
+
+    kept, dropped, quarantined = event_filter.filter_lines(lines)
+    assert kept == [lines[4]]
+    assert (dropped, quarantined) == (4, [])
+
+def test_object_values_never_match():
+    event_filter = amplitude_event_filter(drop_where="device_id={'id': 1}")
+    line = _line({'event_type': 'click', 'device_id': {'id': 1}})
+
+    assert event_filter.filter_lines([line]) == ([line], 0, [])
+
+def test_dropped_columns_are_removed_from_kept_events():
+    event_filter = amplitude_event_filter(drop_columns='user_properties,data')
+    kept, _, _ = event_filter.filter_lines([_line({'uuid': 'a', 'user_properties': {'plan': 'pro'}, 'data': {}}), b'{"uuid": "b"}'])
+
+    assert [json.loads(line) for line in kept] == [{'uuid': 'a'}, {'uuid': 'b'}]
+    assert all(line.endswith(b'\n') for line in kept)
+
+def test_settings_build_no_filter_when_empty():
+    assert amplitude_event_filter() is None
+    with pytest.raises(ValueError):
+        amplitude_event_filter(drop_where='device_id')
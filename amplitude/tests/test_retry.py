@@ -0,0 +1,81 @@
+# Import libraries
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import os
+import requests
+
+# Import modules
+from benchmarks.mock_export_server import MockExportServer
+from modules.amplitude_api_call import amplitude_api_call
+from modules.amplitude_retry import RetryPolicy, amplitude_session
+
+def _response(headers: dict):
+    response = requests.Response()
+    response.headers.update(headers)
+    return response
+
+def test_delay_is_jittered_below_the_exponential_cap():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0, multiplier=2.0)
+
+    for attempt, cap in ((1, 1.0), (2, 2.0), (3, 4.0), (4, 5.0), (10, 5.0)):
+        delays = [policy.delay(attempt) for _ in range(200)]
+        assert all(0 <= delay <= cap for delay in delays)
+        assert max(delays) > cap / 2
+
+def test_delay_without_jitter_is_the_cap():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0, multiplier=2.0, jitter=False)
+    assert [policy.delay(attempt) for attempt in range(1, 6)] == [1.0, 2.0, 4.0, 5.0, 5.0]
+
+def test_retry_after_takes_precedence_up_to_max_delay():
+    policy = RetryPolicy(base_delay=1.0, max_delay=30.0)
+
+    assert policy.delay(1, _response({'Retry-After': '12'})) == 12.0
+    assert policy.delay(1, _response({'Retry-After': '120'})) == 30.0
+    assert policy.delay(1, _response({'Retry-After': '-5'})) == 0.0
+
+    http_date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=20), usegmt=True)
+    assert 15.0 <= policy.delay(1, _response({'Retry-After': http_date})) <= 20.0
+
+    # Unreadable headers fall back to the computed delay
+    assert 0 <= policy.delay(1, _response({'Retry-After': 'soon'})) <= 1.0
+
+class _ServerRecovers(RetryPolicy):
+    # Backoff policy that stops the server dropping transfers once the first one was dropped, and does not wait
+
+    def __init__(self, server: MockExportServer):
+        super().__init__(max_attempts=3, base_delay=0.0)
+        self.server = server
+
+    def delay(self, attempt: int, response=None):
+        self.server.rate_drop = 0.0
+        return 0.0
+
+def _download(server: MockExportServer, download_dir: str):
+    session = amplitude_session(pool_maxsize=1)
+    accept_encodings = []
+    session.hooks['response'].append(lambda response, *args, **kwargs: accept_encodings.append(response.request.headers.get('Accept-Encoding')))
+    assert amplitude_api_call(server.url, '20240101T00', '20240101T01', 'key', 'secret', 3, chunk_size=4096, session=session, retry_policy=_ServerRecovers(server), download_dir=download_dir)
+    session.close()
+    return os.path.join(download_dir, 'amplitude_20240101T00_20240101T01.zip'), accept_encodings
+
+def test_dropped_transfer_resumes_with_a_range_request(tmp_path):
+    with MockExportServer(events_per_hour=2000, rate_drop=1.0) as server:
+        filepath, accept_encodings = _download(server, str(tmp_path))
+        body = server._export_body('20240101T00', '20240101T01')
+
+    assert (server.requests['dropped'], server.requests['200'], server.requests['206']) == (1, 1, 1)
+    with open(filepath, 'rb') as f:
+        assert f.read() == body
+    assert not os.path.exists(f'{filepath}.part')
+
+    # Lengths and Range offsets refer to the raw archive bytes
+    assert accept_encodings == ['identity', 'identity']
+
+def test_server_without_range_support_sends_the_whole_file_again(tmp_path):
+    with MockExportServer(events_per_hour=2000, rate_drop=1.0, support_range=False) as server:
+        filepath, _ = _download(server, str(tmp_path))
+        body = server._export_body('20240101T00', '20240101T01')
+
+    assert (server.requests['dropped'], server.requests['200'], server.requests['206']) == (1, 2, 0)
+    with open(filepath, 'rb') as f:
+        assert f.read() == body
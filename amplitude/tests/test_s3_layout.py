@@ -0,0 +1,69 @@
+# Import libraries
+import gzip
+import os
+
+# Import modules
+from modules.amplitude_s3_layout import amplitude_compaction_plan, amplitude_compact_files, amplitude_object_key, HIVE_KEY_TEMPLATE
+
+def _write(folder, filename: str, data: bytes):
+    with open(os.path.join(folder, filename), 'wb') as f:
+        f.write(data)
+    return filename
+
+def test_without_template_only_files_of_one_hour_are_merged(tmp_path):
+    filenames = [_write(tmp_path, name, b'{}\n') for name in ('123456_2024-01-01_0#0.json', '123456_2024-01-01_0#1.json', '123456_2024-01-01_1#0.json', '123456_2024-01-02_0#0.json', '654321_2024-01-01_0#0.json')]
+
+    assert sorted(amplitude_compaction_plan(str(tmp_path), filenames, '', 1)) == [
+        ['123456_2024-01-01_0#0.json', '123456_2024-01-01_0#1.json'],
+        ['123456_2024-01-01_1#0.json'],
+        ['123456_2024-01-02_0#0.json'],
+        ['654321_2024-01-01_0#0.json'],
+    ]
+
+def test_day_template_merges_a_days_hours_by_format(tmp_path):
+    filenames = [_write(tmp_path, name, b'{}\n') for name in ('123456_2024-01-01_0#0.json', '123456_2024-01-01_1#0.json', '123456_2024-01-01_2#0.json.gz', '123456_2024-01-02_0#0.json', '123456_2024-01-01_3#0.parquet')]
+
+    assert sorted(amplitude_compaction_plan(str(tmp_path), filenames, 'dt={date}_{filename}', 1)) == [
+        ['123456_2024-01-01_0#0.json', '123456_2024-01-01_1#0.json'],
+        ['123456_2024-01-01_2#0.json.gz'],
+        ['123456_2024-01-01_3#0.parquet'],
+        ['123456_2024-01-02_0#0.json'],
+    ]
+
+def test_batches_stay_within_the_target_size(tmp_path):
+    filenames = [_write(tmp_path, f'123456_2024-01-01_0#{partition}.json', b'x' * 400 * 1024 + b'\n') for partition in range(5)]
+
+    assert amplitude_compaction_plan(str(tmp_path), filenames, HIVE_KEY_TEMPLATE, 1) == [
+        ['123456_2024-01-01_0#0.json', '123456_2024-01-01_0#1.json'],
+        ['123456_2024-01-01_0#2.json', '123456_2024-01-01_0#3.json'],
+        ['123456_2024-01-01_0#4.json'],
+    ]
+
+def test_files_without_a_partition_stay_on_their_own(tmp_path):
+    filenames = [_write(tmp_path, name, b'not json\n') for name in ('export_a.json', 'export_b.json')]
+
+    assert sorted(amplitude_compaction_plan(str(tmp_path), filenames, '', 1)) == [['export_a.json'], ['export_b.json']]
+
+def test_compacted_json_keeps_one_event_per_line(tmp_path):
+    batch = [_write(tmp_path, '123456_2024-01-01_0#0.json', b'{"a": 1}'), _write(tmp_path, '123456_2024-01-01_0#1.json', b'{"a": 2}\n')]
+
+    filename, part_path = amplitude_compact_files(str(tmp_path), batch)
+
+    assert filename.startswith('123456_2024-01-01_0#0.compact-2-') and filename.endswith('.json')
+    assert part_path == os.path.join(str(tmp_path), f'{filename}.part')
+    with open(part_path, 'rb') as f:
+        assert f.read() == b'{"a": 1}\n{"a": 2}\n'
+
+    # The merged file lands in the partition of its members, under the same name on every rerun of the batch
+    assert amplitude_object_key(filename, HIVE_KEY_TEMPLATE) == f'123456/year=2024/month=01/day=01/hour=00/{filename}'
+    assert amplitude_compact_files(str(tmp_path), batch)[0] == filename
+    assert amplitude_compact_files(str(tmp_path), batch[:1])[0] != filename
+
+def test_compacted_gzip_members_decompress_as_one_stream(tmp_path):
+    batch = [_write(tmp_path, f'123456_2024-01-01_0#{partition}.json.gz', gzip.compress(f'{{"a": {partition}}}\n'.encode('utf-8'))) for partition in range(2)]
+
+    filename, part_path = amplitude_compact_files(str(tmp_path), batch)
+
+    assert filename.endswith('.json.gz')
+    with gzip.open(part_path, 'rb') as f:
+        assert f.read() == b'{"a": 0}\n{"a": 1}\n'
@@ -0,0 +1,76 @@
+# Import libraries
+import json
+import threading
+
+# Import modules
+from modules import amplitude_sharded_download
+from modules.amplitude_api_call import AmplitudeExportError
+from modules.amplitude_sharded_download import amplitude_shard_plan, amplitude_bisect_shard, amplitude_sharded_download as sharded_download
+
+def test_shard_plan_covers_window_with_inclusive_shards():
+    assert amplitude_shard_plan('20240101T00', '20240101T06', 3) == [
+        ('20240101T00', '20240101T02'),
+        ('20240101T03', '20240101T05'),
+        ('20240101T06', '20240101T06'),
+    ]
+
+def test_bisect_shard_splits_on_hour_boundary():
+    assert amplitude_bisect_shard('20240101T00', '20240101T04') == [('20240101T00', '20240101T01'), ('20240101T02', '20240101T04')]
+    assert amplitude_bisect_shard('20231231T23', '20240101T00') == [('20231231T23', '20231231T23'), ('20240101T00', '20240101T00')]
+
+def test_bisect_single_hour_cannot_split():
+    assert amplitude_bisect_shard('20240101T05', '20240101T05') == []
+
+def _fake_export(monkeypatch, status_for):
+    # Replaces the export call with one answering by shard, recording every shard requested
+    calls = []
+    lock = threading.Lock()
+
+    def fake_api_call(url, start_time, end_time, *args, **kwargs):
+        with lock:
+            calls.append((start_time, end_time))
+        status_code = status_for(start_time, end_time)
+        if status_code:
+            raise AmplitudeExportError(status_code, f'{start_time}-{end_time} returned {status_code}')
+        return True
+
+    monkeypatch.setattr(amplitude_sharded_download, 'amplitude_api_call', fake_api_call)
+    return calls
+
+def test_oversize_shards_are_bisected_until_they_download(monkeypatch, tmp_path):
+    # Shards longer than two hours exceed the export size limit
+    calls = _fake_export(monkeypatch, lambda start, end: 400 if len(amplitude_shard_plan(start, end, 1)) > 2 else None)
+    state_path = tmp_path / 'watermark.json'
+
+    assert sharded_download('http://export', '20240101T00', '20240101T07', 'key', 'secret', 1, shard_hours=8, max_workers=2, state_path=str(state_path), download_dir=str(tmp_path))
+
+    assert calls[0] == ('20240101T00', '20240101T07')
+    assert ('20240101T00', '20240101T03') in calls and ('20240101T04', '20240101T07') in calls
+    downloaded = sorted(shard for shard in calls if len(amplitude_shard_plan(*shard, 1)) <= 2)
+    assert downloaded == [('20240101T00', '20240101T01'), ('20240101T02', '20240101T03'), ('20240101T04', '20240101T05'), ('20240101T06', '20240101T07')]
+
+    hours = json.loads(state_path.read_text())['hours']
+    assert sorted(hours) == [f'20240101T0{hour}' for hour in range(8)]
+    assert all(entry['status'] == 'downloaded' for entry in hours.values())
+
+def test_single_hour_timeout_fails_without_marking_hours(monkeypatch, tmp_path):
+    calls = _fake_export(monkeypatch, lambda start, end: 504)
+    state_path = tmp_path / 'watermark.json'
+
+    assert not sharded_download('http://export', '20240101T00', '20240101T01', 'key', 'secret', 1, shard_hours=2, state_path=str(state_path), download_dir=str(tmp_path))
+
+    assert sorted(calls) == [('20240101T00', '20240101T00'), ('20240101T00', '20240101T01'), ('20240101T01', '20240101T01')]
+    assert not state_path.exists()
+
+def test_empty_shards_are_marked_only_once_settled(monkeypatch, tmp_path):
+    _fake_export(monkeypatch, lambda start, end: 404)
+    state_path = tmp_path / 'watermark.json'
+
+    # 2024 hours are long settled
+    sharded_download('http://export', '20240101T00', '20240101T01', 'key', 'secret', 1, shard_hours=2, state_path=str(state_path), download_dir=str(tmp_path))
+    hours = json.loads(state_path.read_text())['hours']
+    assert {hour: entry['status'] for hour, entry in hours.items()} == {'20240101T00': 'empty', '20240101T01': 'empty'}
+
+    # Hours still inside the availability lag are left unmarked
+    sharded_download('http://export', '20990101T00', '20990101T01', 'key', 'secret', 1, shard_hours=2, state_path=str(state_path), download_dir=str(tmp_path))
+    assert sorted(json.loads(state_path.read_text())['hours']) == ['20240101T00', '20240101T01']
@@ -0,0 +1,103 @@
+# Import libraries
+import boto3
+import gzip
+import pytest
+from moto import mock_aws
+
+# Import modules
+from benchmarks.mock_snowflake import MockSnowflake
+from modules.amplitude_manifest import amplitude_manifest_add, amplitude_manifest_pending
+from modules.amplitude_snowflake_load import amplitude_snowflake_load, amplitude_copy_statement
+
+BUCKET = 'amplitude-test'
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+def _upload(s3_client, manifest_path: str, objects: dict):
+    for key, body in objects.items():
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=body)
+    amplitude_manifest_add(manifest_path, list(objects))
+
+def _load(snowflake: MockSnowflake, manifest_path: str, batch_size: int = 1000):
+    return amplitude_snowflake_load(manifest_path, 'RAW.AMPLITUDE.EVENTS', '@RAW.AMPLITUDE.S3_STAGE', connect=snowflake.connect, batch_size=batch_size)
+
+def test_objects_are_loaded_in_batches_and_leave_the_manifest(s3_client, tmp_path):
+    manifest_path = str(tmp_path / 'manifest.json')
+    _upload(s3_client, manifest_path, {f'123456/hour={hour:02d}/events.json': b'{"a": 1}\n{"a": 2}\n' for hour in range(5)})
+    _upload(s3_client, manifest_path, {'123456/hour=05/events.json.gz': gzip.compress(b'{"a": 1}\n')})
+    snowflake = MockSnowflake(s3_client, BUCKET)
+
+    summary = _load(snowflake, manifest_path, batch_size=2)
+
+    assert (summary['batches'], summary['files_loaded'], summary['files_failed'], summary['rows_loaded']) == (3, 6, 0, 11)
+    assert len(snowflake.statements) == 3
+    assert amplitude_manifest_pending(manifest_path) == []
+
+def test_result_rows_are_matched_to_keys_by_path_suffix(s3_client, tmp_path):
+    # 'events.json' is a suffix of the other key, which must not take its result
+    manifest_path = str(tmp_path / 'manifest.json')
+    _upload(s3_client, manifest_path, {'events.json': b'{"a": 1}\n', '123456/events.json': b'{"a": 1}\n{"a": 2}\n{"a": 3}\n'})
+    s3_client.delete_object(Bucket=BUCKET, Key='events.json')
+    snowflake = MockSnowflake(s3_client, BUCKET)
+
+    summary = _load(snowflake, manifest_path)
+
+    assert (summary['files_loaded'], summary['files_failed'], summary['rows_loaded']) == (1, 1, 3)
+    assert amplitude_manifest_pending(manifest_path) == ['events.json']
+
+def test_failed_files_stay_in_the_manifest_for_the_next_run(s3_client, tmp_path):
+    manifest_path = str(tmp_path / 'manifest.json')
+    _upload(s3_client, manifest_path, {'123456/a.json': b'{"a": 1}\n', '123456/b.json': b'{"a": 1}\n'})
+    amplitude_manifest_add(manifest_path, ['123456/missing.json'])
+    snowflake = MockSnowflake(s3_client, BUCKET)
+
+    assert _load(snowflake, manifest_path)['files_failed'] == 1
+    assert amplitude_manifest_pending(manifest_path) == ['123456/missing.json']
+
+    # Once the object is there, the next run loads it and nothing else
+    s3_client.put_object(Bucket=BUCKET, Key='123456/missing.json', Body=b'{"a": 1}\n{"a": 2}\n')
+    summary = _load(snowflake, manifest_path)
+    assert (summary['files_loaded'], summary['rows_loaded']) == (1, 2)
+    assert amplitude_manifest_pending(manifest_path) == []
+
+def test_files_missing_from_the_result_count_as_already_loaded(s3_client, tmp_path):
+    manifest_path = str(tmp_path / 'manifest.json')
+    _upload(s3_client, manifest_path, {'123456/a.json': b'{"a": 1}\n'})
+    snowflake = MockSnowflake(s3_client, BUCKET)
+    _load(snowflake, manifest_path)
+
+    # A run interrupted after COPY but before the manifest was saved lists the file again. Snowflake skips it and leaves it out of the result
+    amplitude_manifest_add(manifest_path, ['123456/a.json'])
+    summary = _load(snowflake, manifest_path)
+
+    assert (summary['files_loaded'], summary['files_failed'], summary['rows_loaded']) == (1, 0, 0)
+    assert amplitude_manifest_pending(manifest_path) == []
+
+def test_failed_statement_keeps_its_whole_batch(s3_client, tmp_path, monkeypatch):
+    manifest_path = str(tmp_path / 'manifest.json')
+    _upload(s3_client, manifest_path, {f'123456/{name}.json': b'{"a": 1}\n' for name in 'abcd'})
+    snowflake = MockSnowflake(s3_client, BUCKET)
+    copy_into = snowflake.copy_into
+
+    def failing_copy_into(statement: str):
+        if "'123456/a.json'" in statement:
+            raise RuntimeError('warehouse suspended')
+        return copy_into(statement)
+
+    monkeypatch.setattr(snowflake, 'copy_into', failing_copy_into)
+    summary = _load(snowflake, manifest_path, batch_size=2)
+
+    assert (summary['batches'], summary['files_loaded'], summary['files_failed']) == (1, 2, 2)
+    assert amplitude_manifest_pending(manifest_path) == ['123456/a.json', '123456/b.json']
+
+def test_copy_statement_names_each_file_and_escapes_quotes():
+    statement = amplitude_copy_statement('EVENTS', '@STAGE', ["a/it's.json", 'b.parquet'], 'PARQUET', 'CONTINUE')
+    assert statement == "COPY INTO EVENTS FROM @STAGE FILES = ('a/it''s.json', 'b.parquet') FILE_FORMAT = (TYPE = 'PARQUET') ON_ERROR = 'CONTINUE'"
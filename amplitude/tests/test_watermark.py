@@ -0,0 +1,61 @@
+# Import libraries
+from datetime import datetime, timedelta, timezone
+import json
+
+# Import modules
+from modules.amplitude_watermark import amplitude_pending_ranges, amplitude_watermark_mark_hours, amplitude_watermark_mark_files, amplitude_watermark_mark_archive, amplitude_last_settled_hour, HOUR_FORMAT
+
+def test_missing_state_leaves_whole_window_pending(tmp_path):
+    assert amplitude_pending_ranges('20240101T00', '20240101T05', str(tmp_path / 'watermark.json')) == [('20240101T00', '20240101T05')]
+
+def test_hour_is_complete_once_every_file_is_uploaded_or_empty(tmp_path):
+    state_path = str(tmp_path / 'watermark.json')
+    amplitude_watermark_mark_hours(state_path, ['20240101T01', '20240101T02'], 'downloaded')
+    amplitude_watermark_mark_files(state_path, ['123456_2024-01-01_1#0.json', '123456_2024-01-01_2#0.json'], 'extracted')
+    amplitude_watermark_mark_files(state_path, ['123456_2024-01-01_1#0.parquet', '123456_2024-01-01_2#1.json'], 'uploaded')
+    amplitude_watermark_mark_files(state_path, ['123456_2024-01-01_2#0'], 'empty')
+
+    # Hour 1 is uploaded, hour 2 has one file uploaded and one left empty by filtering
+    assert amplitude_pending_ranges('20240101T00', '20240101T03', state_path) == [('20240101T00', '20240101T00'), ('20240101T03', '20240101T03')]
+
+def test_extracted_files_keep_the_hour_pending(tmp_path):
+    state_path = str(tmp_path / 'watermark.json')
+    amplitude_watermark_mark_hours(state_path, ['20240101T01'], 'downloaded')
+    amplitude_watermark_mark_files(state_path, ['123456_2024-01-01_1#0.json', '123456_2024-01-01_1#1.json'], 'extracted')
+    amplitude_watermark_mark_files(state_path, ['123456_2024-01-01_1#0.json'], 'uploaded')
+
+    assert amplitude_pending_ranges('20240101T01', '20240101T01', state_path) == [('20240101T01', '20240101T01')]
+
+def test_archive_hours_without_members_are_empty(tmp_path):
+    state_path = str(tmp_path / 'watermark.json')
+    amplitude_watermark_mark_archive(state_path, 'amplitude_20240101T00_20240101T02.zip', ['123456/123456_2024-01-01_1#0.json.gz'])
+
+    hours = json.loads((tmp_path / 'watermark.json').read_text())['hours']
+    assert {hour: entry['status'] for hour, entry in hours.items()} == {'20240101T00': 'empty', '20240101T02': 'empty'}
+    assert amplitude_pending_ranges('20240101T00', '20240101T02', state_path) == [('20240101T01', '20240101T01')]
+
+def test_hour_fetched_before_it_settled_stays_pending(tmp_path):
+    state_path = str(tmp_path / 'watermark.json')
+    hour = (datetime.now(timezone.utc) - timedelta(hours=2)).strftime(HOUR_FORMAT)
+    amplitude_watermark_mark_hours(state_path, [hour], 'empty')
+
+    assert amplitude_pending_ranges(hour, hour, state_path, availability_lag_hours=3) == [(hour, hour)]
+    assert amplitude_pending_ranges(hour, hour, state_path, availability_lag_hours=0) == []
+
+def test_hour_fetched_after_it_settled_is_complete(tmp_path):
+    state_path = tmp_path / 'watermark.json'
+    state_path.write_text(json.dumps({'hours': {
+        '20240101T00': {'status': 'empty', 'files': {}, 'fetched_at': '2024-01-01T03:59:59'},
+        '20240101T01': {'status': 'empty', 'files': {}, 'fetched_at': '2024-01-01T05:00:00'},
+        '20240101T02': {'status': 'empty', 'files': {}},
+    }}))
+
+    # Hour 0 was fetched a second before its lag ran out; entries without fetched_at predate the lag and are trusted
+    assert amplitude_pending_ranges('20240101T00', '20240101T02', str(state_path), availability_lag_hours=3) == [('20240101T00', '20240101T00')]
+
+def test_last_settled_hour_trails_now_by_the_lag():
+    # Computed on both sides of the call, in case the hour turns in between
+    before = (datetime.now(timezone.utc) - timedelta(hours=4)).strftime(HOUR_FORMAT)
+    last_settled_hour = amplitude_last_settled_hour(3)
+    after = (datetime.now(timezone.utc) - timedelta(hours=4)).strftime(HOUR_FORMAT)
+    assert last_settled_hour in (before, after)